@@ -0,0 +1,243 @@
+""" Fixed-seed benchmarks of the inversion pipeline
+
+Usage:
+    python benchmark.py run <out.json> [--only=name,name] [--repeats=1]
+    python benchmark.py compare <baseline.json> <new.json> [--tolerance=0.1]
+
+Each workload records wall time, forward-model evaluations per second, peak memory and the number of forward
+runs it needed. compare flags any workload that got slower, lost throughput, used more memory or needed more
+forward runs than the baseline by more than the tolerance (as a fraction), and exits non-zero if any did.
+"""
+
+import datetime
+import json
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+import numpy as np
+from scipy.optimize import basinhopping, minimize
+import inverter_tools
+from inverter_classes import BoundedTakeStep, LeastSquaresMinimizer, MyBounds
+from observations import ObservationCube
+
+path_to_obs = 'vishnu_real_data'
+start_date, end_date = '2019-11-29 09:00:00', '2019-12-01 06:00:00'
+site_no = 2
+seed = 42
+
+canonical_params = list(inverter_tools.parameter_space.default)
+
+
+def _obs_dict():
+    return (inverter_tools.get_obs_dict(start_date, end_date, site_no, path_to_obs))
+
+
+def bench_run_model_canonical():
+    inverter_tools.run_from_params(canonical_params, cache=False)
+    return ({'evaluations': 1})
+
+
+def bench_run_model_edges():
+    bounds = np.array(inverter_tools.get_initial_bounds())
+    for corner in (bounds[:, 0], bounds[:, 1], bounds.mean(axis=1)):
+        inverter_tools.run_from_params(corner, cache=False)
+
+    return ({'evaluations': 3})
+
+
+def bench_run_model_batch():
+    rng = np.random.default_rng(seed)
+    lows, highs = np.array(inverter_tools.get_initial_bounds()).T
+    inverter_tools.run_model_batch(rng.uniform(lows, highs, size=(8, len(lows))))
+
+    return ({'evaluations': 8})
+
+
+def bench_cost_fn():
+    # Pure cost arithmetic on fixed arrays, no SMRT
+    rng = np.random.default_rng(seed)
+    obs = {f'{channel}_Mean': rng.normal(-15, 5, 11) for channel in inverter_tools.channels}
+    res = {channel: rng.normal(-15, 5, 11) for channel in inverter_tools.channels}
+
+    n = 10000
+    for _ in range(n):
+        inverter_tools.cost_fn(res, obs)
+
+    return ({'evaluations': n})
+
+
+def bench_calculate_cost():
+    obs_dict = _obs_dict()
+    rng = np.random.default_rng(seed)
+    lows, highs = np.array(inverter_tools.get_initial_bounds()).T
+
+    n = 5
+    for params in rng.uniform(lows, highs, size=(n, len(lows))):
+        inverter_tools.calculate_cost(params, obs_dict)
+
+    return ({'evaluations': n})
+
+
+def bench_search():
+    obs_dict = _obs_dict()
+    bounds = inverter_tools.get_initial_bounds()
+    np.random.seed(seed)
+
+    fit = basinhopping(inverter_tools.calculate_cost,
+                       x0=canonical_params,
+                       T=5,
+                       niter=2,
+                       minimizer_kwargs={'method': 'SLSQP', 'args': (obs_dict,), 'bounds': bounds},
+                       take_step=BoundedTakeStep(bounds),
+                       accept_test=MyBounds(bounds),
+                       seed=seed)
+
+    return ({'cost': float(fit.fun)})
+
+
+def _local_fit(method):
+    # One local fit from the canonical start, as search mode runs after every hop
+    obs_dict = _obs_dict()
+    bounds = inverter_tools.get_initial_bounds()
+
+    fit = minimize(inverter_tools.calculate_cost, canonical_params, args=(obs_dict,), bounds=bounds,
+                   method=method if isinstance(method, str) else method(bounds))
+
+    return ({'cost': float(fit.fun), 'nfev': int(fit.nfev)})
+
+
+def bench_local_scalar():
+    return (_local_fit('SLSQP'))
+
+
+def bench_local_lsq():
+    return (_local_fit(LeastSquaresMinimizer))
+
+
+def bench_track():
+    signatures, _, _ = inverter_tools.prep_obs(path_to_obs, sites=[site_no], start_date=start_date,
+                                               end_date=end_date)
+    cube = ObservationCube.from_signatures(signatures, site_no, start_date, end_date)
+    bounds = inverter_tools.get_initial_bounds()
+
+    x, costs = np.array(canonical_params, dtype=float), []
+    for timestep in range(5):
+        fit = minimize(inverter_tools.calculate_cost, x, args=(cube.obs_dict(timestep),), bounds=bounds,
+                       method='L-BFGS-B')
+        x = fit.x
+        costs.append(float(fit.fun))
+
+    return ({'cost': costs[-1]})
+
+
+workloads = {'run_model_canonical': bench_run_model_canonical,
+             'run_model_edges': bench_run_model_edges,
+             'run_model_batch': bench_run_model_batch,
+             'cost_fn': bench_cost_fn,
+             'calculate_cost': bench_calculate_cost,
+             'local_scalar': bench_local_scalar,
+             'local_lsq': bench_local_lsq,
+             'search': bench_search,
+             'track': bench_track}
+
+
+def run_workload(fn, repeats=1):
+    """Times a workload with the forward cache off and returns its best-of-repeats metrics
+
+    The sub-model caches are cleared before every repeat, so no repeat or workload starts with media built by an
+    earlier one. tracemalloc stays on during the timed region so that memory and time come from the same run; its
+    overhead is the same for every baseline.
+    """
+
+    cache, inverter_tools.forward_cache = inverter_tools.forward_cache, None
+    results = []
+
+    try:
+        for _ in range(repeats):
+            inverter_tools.clear_submodel_caches()
+            runs_before = inverter_tools.forward_runs
+            tracemalloc.start()
+            t0 = time.perf_counter()
+
+            info = fn()
+
+            wall = time.perf_counter() - t0
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            forward_runs = inverter_tools.forward_runs - runs_before
+            evaluations = info.pop('evaluations', forward_runs)
+            results.append({'wall_s': wall,
+                            'evals_per_s': evaluations / wall if wall else 0.0,
+                            'peak_traced_mb': peak / 2 ** 20,
+                            'forward_runs': forward_runs,
+                            **info})
+    finally:
+        inverter_tools.forward_cache = cache
+
+    best = min(results, key=lambda r: r['wall_s'])
+    best['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    return (best)
+
+
+def run(out_file, only=None, repeats=1):
+    names = only or list(workloads)
+    report = {'created': datetime.datetime.now().isoformat(),
+              'python': platform.python_version(),
+              'machine': platform.machine(),
+              'seed': seed,
+              'workloads': {}}
+
+    for name in names:
+        print(f'{name}...', flush=True)
+        report['workloads'][name] = run_workload(workloads[name], repeats)
+        print(f"  {report['workloads'][name]}")
+
+    json.dump(report, open(out_file, 'w'), indent=1)
+
+    return (report)
+
+
+# metric -> +1 if bigger is worse, -1 if smaller is worse
+compared_metrics = {'wall_s': 1, 'evals_per_s': -1, 'peak_traced_mb': 1, 'forward_runs': 1}
+
+
+def compare(baseline_file, new_file, tolerance=0.1):
+    """Prints a metric-by-metric comparison and returns the list of regressions"""
+
+    baseline = json.load(open(baseline_file))['workloads']
+    new = json.load(open(new_file))['workloads']
+    regressions = []
+
+    for name in sorted(set(baseline) & set(new)):
+        for metric, direction in compared_metrics.items():
+            old_value, new_value = baseline[name].get(metric), new[name].get(metric)
+            if not old_value or new_value is None:
+                continue
+
+            change = (new_value - old_value) / old_value
+            flag = ''
+            if direction * change > tolerance:
+                flag = '  REGRESSION'
+                regressions.append((name, metric, old_value, new_value))
+
+            print(f'{name:<22} {metric:<16} {old_value:>12.4g} -> {new_value:>12.4g} ({100 * change:+.1f}%){flag}')
+
+    return (regressions)
+
+
+if __name__ == '__main__':
+    positional, options = inverter_tools.parse_options(sys.argv)
+
+    if positional[0] == 'run':
+        run(positional[1],
+            only=options['only'].split(',') if 'only' in options else None,
+            repeats=int(options.get('repeats', 1)))
+    elif positional[0] == 'compare':
+        regressions = compare(positional[1], positional[2], tolerance=float(options.get('tolerance', 0.1)))
+        sys.exit(1 if regressions else 0)
+    else:
+        print(__doc__)
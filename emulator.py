@@ -0,0 +1,184 @@
+import numpy as np
+import inverter_tools
+from lookup_table import sample_parameter_space
+
+
+class RBFEmulator(object):
+    """NumPy-only Gaussian radial-basis-function surrogate for the forward model
+
+    Maps a parameter vector (scaled to the unit box of `bounds`) to the (channel, angle) backscatter array. The
+    same kernel gives a kriging-style predictive standard deviation, which is what the adaptive refinement uses to
+    decide where new forward runs are most informative.
+
+    Args:
+        bounds: list of (low, high) tuples, defaults to get_initial_bounds().
+        length_scale: kernel width in unit-box coordinates. If None it is chosen on each fit by leave-one-out error.
+        nugget: diagonal regularisation added to the kernel matrix.
+    """
+
+    length_scale_grid = (0.1, 0.15, 0.2, 0.3, 0.45, 0.7, 1.0)
+
+    def __init__(self, bounds=None, length_scale=None, nugget=1e-6):
+        if bounds is None:
+            bounds = inverter_tools.get_initial_bounds()
+
+        self.lows, self.highs = np.array(bounds, dtype=float).T
+        self.fixed_length_scale = length_scale
+        self.length_scale = length_scale
+        self.nugget = nugget
+        self.params = np.empty((0, len(bounds)))
+        self.sigma = None
+
+    def _scale(self, params):
+        return ((np.atleast_2d(params) - self.lows) / (self.highs - self.lows))
+
+    def _kernel(self, a, b, length_scale):
+        d2 = np.sum(a ** 2, axis=1)[:, None] + np.sum(b ** 2, axis=1)[None, :] - 2 * a @ b.T
+        return (np.exp(-np.maximum(d2, 0) / (2 * length_scale ** 2)))
+
+    def fit(self, params, sigma):
+        """Fits the emulator to forward runs, dropping any run with NaN output"""
+
+        params = np.atleast_2d(np.asarray(params, dtype=float))
+        sigma = np.asarray(sigma, dtype=float).reshape(len(params), *np.shape(sigma)[-2:])
+
+        valid = ~np.isnan(sigma).any(axis=(1, 2))
+        self.params, self.sigma = params[valid], sigma[valid]
+        self.output_shape = self.sigma.shape[1:]
+
+        x = self._scale(self.params)
+        y = self.sigma.reshape(len(x), -1)
+        self.y_mean = y.mean(axis=0)
+        self.y_scale = np.std(y - self.y_mean) or 1.0
+        y = (y - self.y_mean) / self.y_scale
+
+        if self.fixed_length_scale is None:
+            self.length_scale = min(self.length_scale_grid, key=lambda ls: self._loo_error(x, y, ls))
+
+        K = self._kernel(x, x, self.length_scale) + self.nugget * np.eye(len(x))
+        self._chol = np.linalg.cholesky(K)
+        self._weights = np.linalg.solve(self._chol.T, np.linalg.solve(self._chol, y))
+
+        return (self)
+
+    def _loo_error(self, x, y, length_scale):
+        # Closed-form leave-one-out residuals: e_i = (K^-1 y)_i / (K^-1)_ii
+        K = self._kernel(x, x, length_scale) + self.nugget * np.eye(len(x))
+        try:
+            K_inv = np.linalg.inv(K)
+        except np.linalg.LinAlgError:
+            return (np.inf)
+
+        residuals = (K_inv @ y) / np.diag(K_inv)[:, None]
+
+        return (np.mean(residuals ** 2))
+
+    def add(self, params, sigma):
+        """Adds forward runs to the training set and refits"""
+
+        sigma = np.asarray(sigma, dtype=float).reshape(-1, *np.shape(sigma)[-2:])
+        all_params = np.concatenate([self.params, np.atleast_2d(params)])
+        all_sigma = sigma if self.sigma is None else np.concatenate([self.sigma, sigma])
+
+        return (self.fit(all_params, all_sigma))
+
+    def predict(self, params, return_std=False):
+        """Predicts the (N, channel, angle) output; with return_std also an (N,) predictive standard deviation (dB)"""
+
+        x = self._scale(params)
+        k = self._kernel(x, self._scale(self.params), self.length_scale)
+        y = (k @ self._weights) * self.y_scale + self.y_mean
+        prediction = y.reshape(len(x), *self.output_shape)
+
+        if not return_std:
+            return (prediction)
+
+        v = np.linalg.solve(self._chol, k.T)
+        variance = np.maximum(1 - np.sum(v ** 2, axis=0), 0)
+
+        return (prediction, np.sqrt(variance) * self.y_scale)
+
+    def validate(self, params, sigma, obs=None):
+        """Reports the emulator error against held-out true forward runs
+
+        Args:
+            params: (N, 12) held-out parameter vectors.
+            sigma: (N, channel, angle) true SMRT output for them.
+            obs: optional (channel, angle) observation array; if given the cost error is reported too.
+
+        Returns:
+            A dictionary of RMSE per channel and overall (dB), maximum absolute error and, with obs, the RMS
+            difference between emulated and true cost.
+        """
+
+        sigma = np.asarray(sigma, dtype=float)
+        valid = ~np.isnan(sigma).any(axis=(1, 2))
+        prediction = self.predict(np.atleast_2d(params)[valid])
+        error = prediction - sigma[valid]
+
+        report = {f'rmse_{channel}': float(np.sqrt(np.mean(error[:, c] ** 2)))
+                  for c, channel in enumerate(inverter_tools.channels)}
+        report['rmse'] = float(np.sqrt(np.mean(error ** 2)))
+        report['max_abs_error'] = float(np.max(np.abs(error)))
+        report['n_holdout'] = int(np.sum(valid))
+
+        if obs is not None:
+            cost_error = inverter_tools.batch_cost(prediction, obs) - inverter_tools.batch_cost(sigma[valid], obs)
+            report['cost_rmse'] = float(np.sqrt(np.mean(cost_error ** 2)))
+
+        return (report)
+
+    def refine(self, n_new, n_candidates=2000, seed=None, processes=None):
+        """Runs SMRT at the n_new candidate points where the emulator is least certain and adds them"""
+
+        candidates = sample_parameter_space(n_candidates,
+                                            bounds=list(zip(self.lows, self.highs)),
+                                            seed=seed)
+        _, std = self.predict(candidates, return_std=True)
+        new_params = candidates[np.argsort(std)[::-1][:n_new]]
+
+        return (self.add(new_params, inverter_tools.run_model_pool(new_params, processes=processes)))
+
+
+class EmulatorCost(object):
+    """Drop-in replacement for calculate_cost that scores the emulator instead of SMRT
+
+    verify() runs the real forward model at a point (e.g. a candidate minimum), adds it to the training set and
+    returns the true cost, so the emulator sharpens where the search is actually looking.
+    """
+
+    def __init__(self, emulator):
+        self.emulator = emulator
+        self.n_verified = 0
+
+    def __call__(self, params, l):
+        obs = inverter_tools.obs_dict_to_array(l)
+        return (float(inverter_tools.batch_cost(self.emulator.predict(params)[0], obs)))
+
+    def verify(self, params, l):
+        obs = inverter_tools.obs_dict_to_array(l)
+        sigma = inverter_tools.results_to_array(inverter_tools.run_from_params(params))
+        self.n_verified += 1
+
+        if not np.isnan(sigma).any():
+            self.emulator.add(params, sigma)
+
+        return (float(inverter_tools.batch_cost(sigma, obs)))
+
+
+def train_emulator(n_train, n_holdout=50, seed=0, processes=None, obs=None):
+    """Trains an RBFEmulator on n_train Sobol samples and checks it on n_holdout independent Latin hypercube runs
+
+    Returns:
+        (emulator, validation report)
+    """
+
+    train_params = sample_parameter_space(n_train, method='sobol', seed=seed)
+    holdout_params = sample_parameter_space(n_holdout, method='lhs', seed=seed + 1)
+
+    sigma = inverter_tools.run_model_pool(np.concatenate([train_params, holdout_params]), processes=processes)
+
+    emulator = RBFEmulator().fit(train_params, sigma[:n_train])
+    report = emulator.validate(holdout_params, sigma[n_train:], obs=obs)
+
+    return (emulator, report)
@@ -0,0 +1,210 @@
+from multiprocessing import Pool
+import numpy as np
+from scipy.optimize import minimize
+import inverter_tools
+import profiling
+from minima_log import distinct_minima
+from track_log import TrackLog, read_track, resume_point
+
+
+def ensemble_starts(minima, n_members, space, n_reserve=None, tolerance=0.05):
+    """Members and reserve for an ensemble track: the best distinct search-mode minima, pulled into the space
+
+    Returns:
+        (members, reserve): full vectors of the n_members best distinct minima and of up to n_reserve more, which
+        are used to respawn members.
+    """
+
+    n_reserve = n_members if n_reserve is None else n_reserve
+    params, _ = distinct_minima(minima, n_members + n_reserve, space.bounds, tolerance)
+
+    lows, highs = np.array(space.bounds, dtype=float).T
+    params = [space.to_full(space.to_free(np.clip(p, lows, highs))) for p in params]
+
+    return (params[:n_members], params[n_members:])
+
+
+def refine_member(task):
+    """One warm-started local fit of one member, executed in a pool worker"""
+
+    profiling.start_task(task['profile'])
+
+    space = task['space']
+    fit = minimize(task['cost_function'],
+                   space.to_free(task['x0']),
+                   args=(task['obs_dict'],),
+                   bounds=space.free_bounds,
+                   jac=task['jac'],
+                   method=task['local_method'])
+
+    return (space.to_full(fit.x), float(fit.fun), int(fit.nfev), inverter_tools.forward_runs, profiling.collect())
+
+
+def unit_distance(a, b, bounds):
+    """Largest parameter difference as a fraction of that parameter's range"""
+
+    lows, highs = np.array(bounds, dtype=float).T
+
+    return (np.max(np.abs(np.asarray(a) - np.asarray(b)) / (highs - lows), axis=-1))
+
+
+def members_to_respawn(params, costs, bounds, tolerance=0.05, prune_ratio=10):
+    """Indices of members that fell into a better member's basin or cost more than prune_ratio times the best"""
+
+    order = np.argsort(costs)
+    best = costs[order[0]]
+    respawn = []
+
+    for rank, j in enumerate(order[1:], start=1):
+        collapsed = any(unit_distance(params[j], params[i], bounds) <= tolerance for i in order[:rank]
+                        if i not in respawn)
+        if collapsed or (costs[j] > prune_ratio * best):
+            respawn.append(j)
+
+    return (respawn)
+
+
+def spawn_candidates(n, reserve, best, space, rng, step_fraction=0.1):
+    """n respawn candidates: unused reserve minima first, then random hops around the best member"""
+
+    candidates = [reserve.pop(0) for _ in range(min(n, len(reserve)))]
+
+    lows, highs = np.array(space.bounds, dtype=float).T
+    while len(candidates) < n:
+        hop = best + rng.uniform(-step_fraction, step_fraction, len(lows)) * (highs - lows)
+        candidates.append(space.to_full(space.to_free(np.clip(hop, lows, highs))))
+
+    return (candidates)
+
+
+def track_ensemble(cube, members, reserve, space, cost_function, stem, local_method='L-BFGS-B', jac=False,
+                   processes=None, max_steps=None, tolerance=0.05, prune_ratio=10, n_candidates=4, seed=0):
+    """Ensemble (multi-basin) track mode
+
+    Carries len(members) parameter vectors through the series together instead of one. At each timestep every member
+    is refined by a warm-started local fit, the fits running concurrently on a process pool. Members that have
+    fallen into a better member's basin, or whose cost is more than prune_ratio times the best, are then respawned:
+    n_candidates candidates per slot (unused reserve minima, then hops around the best member) are scored in one
+    batched forward run and the best are refined in their place. A track that loses its basin can so be taken
+    over by another member.
+
+    Member j is checkpointed to {stem}_m{j}.track after every timestep; a rerun resumes from the earliest
+    timestep any member is missing.
+
+    Args:
+        members: full vectors to start from (e.g. from ensemble_starts).
+        reserve: full vectors to respawn from, consumed in order.
+
+    Returns:
+        The next timestep to run (len(cube) once the series is complete).
+    """
+
+    rng = np.random.default_rng(seed)
+    reserve = list(reserve)
+    paths = [f'{stem}_m{j}.track' for j in range(len(members))]
+
+    resumed = [resume_point(path, cube) for path in paths]
+    first_timestep = min(first for first, _ in resumed)
+    members = [np.asarray(x if x is not None else member, dtype=float) for (_, x), member in zip(resumed, members)]
+    if first_timestep:
+        print(f'resuming ensemble at timestep {first_timestep}')
+
+    empty = set(cube.empty_timesteps())
+    last = len(cube) if max_steps is None else min(len(cube), first_timestep + max_steps)
+    logs = [TrackLog(path, n_params=len(space)) for path in paths]
+
+    def refine(xs, obs_dict):
+        tasks = [{'x0': x, 'obs_dict': obs_dict, 'space': space, 'cost_function': cost_function,
+                  'local_method': local_method, 'jac': jac, 'profile': profiling.enabled} for x in xs]
+
+        # The fits ran in the workers, so their timings and counters are gathered here
+        fits = pool.map(refine_member, tasks)
+        for fit in fits:
+            profiling.absorb(fit[-1])
+
+        return ([fit[:-1] for fit in fits])
+
+    try:
+        with Pool(processes or len(members)) as pool:
+            for timestep in range(first_timestep, last):
+                obs_time = cube.times[timestep]
+
+                if timestep in empty:
+                    print(f'Timestep {timestep} ({obs_time}): no observations, skipped')
+                    for log, x in zip(logs, members):
+                        log.append(timestep, obs_time, x, np.nan, skipped=True, n_evals=inverter_tools.forward_runs)
+                    continue
+
+                obs_dict = cube.obs_dict(timestep)
+                fits = refine(members, obs_dict)
+
+                params = [x for x, _, _, _ in fits]
+                costs = np.array([f for _, f, _, _ in fits])
+                respawn = members_to_respawn(params, costs, space.bounds, tolerance, prune_ratio)
+
+                if respawn:
+                    candidates = np.array(spawn_candidates(n_candidates * len(respawn), reserve,
+                                                           params[int(np.argmin(costs))], space, rng))
+                    candidate_costs = cube.cost(inverter_tools.run_model_batch(candidates), timestep)
+                    chosen = candidates[np.argsort(candidate_costs)[:len(respawn)]]
+
+                    for j, fit in zip(respawn, refine(chosen, obs_dict)):
+                        fits[j] = fit
+                        params[j], costs[j] = fit[0], fit[1]
+
+                members = params
+                for log, (x, f, nfev, n_evals) in zip(logs, fits):
+                    log.append(timestep, obs_time, x, f, nfev=nfev, n_evals=n_evals)
+
+                print(f'Timestep {timestep} ({obs_time}): member costs {np.round(costs, 3)}, '
+                      f'{len(respawn)} respawned')
+                profiling.count('ensemble_respawns', len(respawn))
+                profiling.maybe_report()
+    finally:
+        for log in logs:
+            log.close()
+
+    return (last)
+
+
+def best_trajectories(stem, n_members, n_timesteps, bounds, tolerance=0.05):
+    """Best and runner-up trajectory of an ensemble track, read back from its member logs
+
+    At each timestep the best trajectory takes the lowest-cost member and the runner-up the lowest-cost member in a
+    different basin (further than tolerance from the best), so the runner-up shows the alternative the data
+    could not rule out.
+
+    Returns:
+        A dictionary with best_params, best_costs, runner_up_params and runner_up_costs ((T, n_params) and (T,)
+        arrays, NaN where no member qualifies).
+    """
+
+    n_params = len(bounds)
+    params = np.full((n_members, n_timesteps, n_params), np.nan)
+    costs = np.full((n_members, n_timesteps), np.nan)
+
+    for j in range(n_members):
+        df = read_track(f'{stem}_m{j}.track')
+        if not df.empty:
+            params[j, df['timestep'].values] = np.stack(df['params'].values)
+            costs[j, df['timestep'].values] = df['cost'].values
+
+    result = {'best_params': np.full((n_timesteps, n_params), np.nan),
+              'best_costs': np.full(n_timesteps, np.nan),
+              'runner_up_params': np.full((n_timesteps, n_params), np.nan),
+              'runner_up_costs': np.full(n_timesteps, np.nan)}
+
+    for t in range(n_timesteps):
+        order = [j for j in np.argsort(costs[:, t]) if not np.isnan(costs[j, t])]
+        if not order:
+            continue
+
+        best = order[0]
+        result['best_params'][t], result['best_costs'][t] = params[best, t], costs[best, t]
+
+        for j in order[1:]:
+            if unit_distance(params[j, t], params[best, t], bounds) > tolerance:
+                result['runner_up_params'][t], result['runner_up_costs'][t] = params[j, t], costs[j, t]
+                break
+
+    return (result)
@@ -0,0 +1,177 @@
+import sys
+import numpy as np
+from scipy.stats import qmc
+import inverter_tools
+from lookup_table import run_checkpointed
+
+parameter_names = inverter_tools.parameter_space.names
+
+
+def _scale(unit, bounds):
+    lows, highs = np.array(bounds, dtype=float).T
+    return (lows + unit * (highs - lows))
+
+
+def morris_design(n_trajectories, bounds=None, levels=4, seed=0):
+    """One-at-a-time trajectories for Morris elementary effects
+
+    Each trajectory starts on a random point of a `levels`-level grid and moves every parameter once, in random
+    order, by delta = levels / (2 (levels - 1)) of its range (downwards if upwards would leave the box).
+
+    Returns:
+        (params, steps): (n_trajectories * (k + 1), k) design and the signed step of each move as a
+        (n_trajectories, k) array indexed by parameter.
+    """
+
+    if bounds is None:
+        bounds = inverter_tools.get_initial_bounds()
+
+    k = len(bounds)
+    rng = np.random.default_rng(seed)
+    delta = levels / (2 * (levels - 1))
+    grid = np.arange(levels) / (levels - 1)
+
+    points, steps = [], np.zeros((n_trajectories, k))
+    for t in range(n_trajectories):
+        x = rng.choice(grid, size=k)
+        trajectory = [x.copy()]
+        for i in rng.permutation(k):
+            step = delta if x[i] + delta <= 1 else -delta
+            x[i] += step
+            steps[t, i] = step
+            trajectory.append(x.copy())
+        points.extend(trajectory)
+
+    return (_scale(np.array(points), bounds), steps)
+
+
+def morris_indices(params, sigma, steps, bounds=None):
+    """Elementary-effect statistics per parameter, channel and angle
+
+    Args:
+        params: the design from morris_design.
+        sigma: (N, channel, angle) model output for it.
+        steps: the step array from morris_design.
+
+    Returns:
+        A dictionary with mu_star (mean absolute effect), mu and sigma (std of effects), each (k, channel, angle),
+        in dB per unit of the parameter's normalised range.
+    """
+
+    if bounds is None:
+        bounds = inverter_tools.get_initial_bounds()
+
+    n_trajectories, k = steps.shape
+    lows, highs = np.array(bounds, dtype=float).T
+    unit = (np.asarray(params) - lows) / (highs - lows)
+    sigma = np.asarray(sigma, dtype=float).reshape(n_trajectories, k + 1, *np.shape(sigma)[1:])
+    unit = unit.reshape(n_trajectories, k + 1, k)
+
+    effects = np.full((n_trajectories, k) + sigma.shape[2:], np.nan)
+    for t in range(n_trajectories):
+        for j in range(k):
+            i = np.argmax(np.abs(unit[t, j + 1] - unit[t, j]))
+            effects[t, i] = (sigma[t, j + 1] - sigma[t, j]) / steps[t, i]
+
+    return ({'mu_star': np.nanmean(np.abs(effects), axis=0),
+             'mu': np.nanmean(effects, axis=0),
+             'sigma': np.nanstd(effects, axis=0)})
+
+
+def sobol_design(n, bounds=None, seed=0):
+    """Saltelli design for first-order and total Sobol indices
+
+    Returns:
+        An (n * (k + 2), k) design laid out as [A, B, AB_1, ..., AB_k], where AB_i is A with column i from B.
+    """
+
+    if bounds is None:
+        bounds = inverter_tools.get_initial_bounds()
+
+    k = len(bounds)
+    base = qmc.Sobol(d=2 * k, scramble=True, seed=seed).random(n)
+    A, B = base[:, :k], base[:, k:]
+
+    blocks = [A, B]
+    for i in range(k):
+        AB = A.copy()
+        AB[:, i] = B[:, i]
+        blocks.append(AB)
+
+    return (_scale(np.concatenate(blocks), bounds))
+
+
+def sobol_indices(sigma, n, k):
+    """First-order (Saltelli 2010) and total (Jansen) Sobol indices per parameter, channel and angle
+
+    Samples where any of the k + 2 runs failed (NaN) are dropped before estimating.
+
+    Returns:
+        A dictionary with S1 and ST, each (k, channel, angle).
+    """
+
+    sigma = np.asarray(sigma, dtype=float).reshape(k + 2, n, *np.shape(sigma)[1:])
+    valid = ~np.isnan(sigma).any(axis=tuple([0] + list(range(2, sigma.ndim))))
+    sigma = sigma[:, valid]
+
+    fA, fB, fAB = sigma[0], sigma[1], sigma[2:]
+    variance = np.var(np.concatenate([fA, fB]), axis=0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        S1 = np.mean(fB * (fAB - fA), axis=1) / variance
+        ST = 0.5 * np.mean((fA - fAB) ** 2, axis=1) / variance
+
+    return ({'S1': S1, 'ST': ST, 'n_valid': int(np.sum(valid))})
+
+
+def run_morris(path, n_trajectories, levels=4, seed=0, processes=None, chunk_size=26):
+    """Runs (or resumes) a Morris screening in `path` and returns its indices"""
+
+    params, steps = morris_design(n_trajectories, levels=levels, seed=seed)
+    params, sigma, done = run_checkpointed(path, params, chunk_size, processes,
+                                           meta={'analysis': 'morris', 'levels': levels, 'seed': seed})
+
+    return (morris_indices(np.array(params), np.array(sigma), steps))
+
+
+def run_sobol(path, n, seed=0, processes=None, chunk_size=28):
+    """Runs (or resumes) a Sobol analysis in `path` and returns its indices"""
+
+    k = len(inverter_tools.get_initial_bounds())
+    params = sobol_design(n, seed=seed)
+    params, sigma, done = run_checkpointed(path, params, chunk_size, processes,
+                                           meta={'analysis': 'sobol', 'seed': seed})
+
+    return (sobol_indices(np.array(sigma), n, k))
+
+
+def rank_parameters(index):
+    """Orders parameters by their largest index over all channels and angles
+
+    Args:
+        index: a (k, channel, angle) array such as mu_star or ST.
+
+    Returns:
+        List of (parameter name, max index) from most to least influential. Parameters at the bottom of this list
+        are candidates for freezing.
+    """
+
+    peak = np.nanmax(np.asarray(index).reshape(len(parameter_names), -1), axis=1)
+
+    return (sorted(zip(parameter_names, peak), key=lambda item: -item[1]))
+
+
+if __name__ == '__main__':
+    # python global_sensitivity.py morris <path> <n_trajectories> [processes]
+    # python global_sensitivity.py sobol <path> <n> [processes]
+    processes = int(sys.argv[4]) if len(sys.argv) > 4 else None
+
+    if sys.argv[1] == 'morris':
+        indices = run_morris(sys.argv[2], int(sys.argv[3]), processes=processes)
+        ranking = rank_parameters(indices['mu_star'])
+    else:
+        indices = run_sobol(sys.argv[2], int(sys.argv[3]), processes=processes)
+        ranking = rank_parameters(indices['ST'])
+
+    for name, value in ranking:
+        print(f'{name:<20} {value:.3f}')
@@ -0,0 +1,289 @@
+""" Long-lived inversion service: warm worker processes behind a local socket
+
+Usage:
+    python inversion_daemon.py serve [--socket=inverter.sock] [--workers=n] [--obs=vishnu_real_data]
+    python inversion_daemon.py submit '<json job>' [--socket=inverter.sock]
+
+Starting an array task pays for the interpreter, the smrt/scipy/pandas imports and the observation files on every
+job. The daemon pays once: its workers import everything and build the SMRT sensor and model when the pool
+starts, and keep parsed observations between jobs.
+
+Jobs are single-line JSON objects sent over a Unix socket (several per connection are allowed):
+    {"type": "forward", "params": [...] or [[...], ...]}
+    {"type": "search", "site": 2, "start": "...", "end": "...", "niter": 10, "x0": [...], "fix": "name:value"}
+    {"type": "track", "site": 2, "start": "...", "end": "...", "x0": [...], "fix": "name:value"}
+Each reply is a JSON line tagged with the job id the daemon assigned: "accepted" first, then "progress" events as
+they happen (every basinhopping minimum, every tracked timestep) and finally "result" or "error".
+"""
+
+import asyncio
+import functools
+import itertools
+import json
+import multiprocessing
+import os
+import socket
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy.optimize import basinhopping
+import inverter_tools
+from inverter_classes import BoundedTakeStep, MyBounds
+from parameter_space import parse_space_options
+from track_mode import load_cube, track, track_space
+
+default_socket = 'inverter.sock'
+
+# Worker-process state, set by _init_worker
+_events = None
+_path_to_obs = None
+
+
+def _jsonable(value):
+    if isinstance(value, np.ndarray):
+        return (value.tolist())
+    if isinstance(value, np.generic):
+        return (value.item())
+    if isinstance(value, pd.Timestamp):
+        return (value.isoformat())
+
+    raise TypeError(f'{type(value)} is not JSON serialisable')
+
+
+def encode(message):
+    return ((json.dumps(message, default=_jsonable) + '\n').encode())
+
+
+def _init_worker(events, path_to_obs):
+    """Pool initializer: keeps the event queue and builds the SMRT sensor and model before any job arrives"""
+
+    global _events, _path_to_obs
+    _events, _path_to_obs = events, path_to_obs
+
+    inverter_tools.get_sensor()
+    inverter_tools.get_model()
+
+
+def _progress(job_id, **event):
+    _events.put({'id': job_id, 'event': 'progress', **event})
+
+
+@functools.lru_cache(maxsize=32)
+def _obs_dict(site_no, start_date=None, end_date=None):
+    # A job without dates gets get_obs_dict's default window rather than None
+    dates = {key: value for key, value in (('start_date', start_date), ('end_date', end_date)) if value is not None}
+
+    return (inverter_tools.get_obs_dict(site_no=site_no, path_to_obs=_path_to_obs, **dates))
+
+
+@functools.lru_cache(maxsize=8)
+def _cube(site_no, start_date, end_date):
+    return (load_cube(_path_to_obs, site_no, start_date, end_date))
+
+
+class _StreamingLog(object):
+    """Stands in for a TrackLog, sending each tracked timestep back as a progress event"""
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.params, self.costs = [], []
+
+    def append(self, timestep, obs_time, params, cost, nfev=0, n_evals=-1, skipped=False):
+        self.params.append(params)
+        self.costs.append(cost)
+        _progress(self.job_id, timestep=timestep, time=pd.Timestamp(obs_time), params=params, cost=cost,
+                  nfev=nfev, skipped=skipped)
+
+
+def forward_job(job_id, job):
+    params = np.atleast_2d(np.asarray(job['params'], dtype=float))
+
+    return ({'sigma': inverter_tools.run_model_batch(params),
+             'channels': inverter_tools.channels,
+             'angles': inverter_tools.default_angles})
+
+
+def search_job(job_id, job):
+    space = parse_space_options(job)
+    obs_dict = _obs_dict(int(job.get('site', 2)), job.get('start'), job.get('end'))
+    x0 = space.to_free(job.get('x0', space.default))
+    bounds = space.free_bounds
+
+    def report(x, f, accepted):
+        _progress(job_id, params=space.to_full(x), cost=f, accepted=accepted)
+
+    # BoundedTakeStep draws from np.random, not from basinhopping's seeded generator (as in multistart.run_chain)
+    seed = job.get('seed')
+    if seed is not None:
+        np.random.seed(int(seed))
+
+    fit = basinhopping(space.wrap(inverter_tools.calculate_cost),
+                       x0=x0,
+                       T=float(job.get('T', 5)),
+                       niter=int(job.get('niter', 10)),
+                       minimizer_kwargs={'method': job.get('method', 'SLSQP'), 'args': (obs_dict,),
+                                         'bounds': bounds},
+                       take_step=BoundedTakeStep(bounds),
+                       accept_test=MyBounds(bounds),
+                       callback=report,
+                       seed=seed)
+
+    return ({'params': space.to_full(fit.x), 'cost': fit.fun, 'nfev': fit.nfev})
+
+
+def track_job(job_id, job):
+    space = track_space(job)
+    cube = _cube(int(job.get('site', 2)), job.get('start'), job.get('end'))
+    log = _StreamingLog(job_id)
+
+    track(cube, job['x0'], log, space, space.wrap(inverter_tools.calculate_cost))
+
+    return ({'params': log.params, 'costs': log.costs, 'times': list(cube.times)})
+
+
+job_types = {'forward': forward_job,
+             'search': search_job,
+             'track': track_job}
+
+
+def run_job(job_id, job):
+    """Runs one job in a worker, sending the result (or error) through the event queue after its progress events"""
+
+    try:
+        _events.put({'id': job_id, 'event': 'result', 'result': job_types[job['type']](job_id, job)})
+    except Exception as e:
+        _events.put({'id': job_id, 'event': 'error', 'error': f'{type(e).__name__}: {e}'})
+
+
+class InversionDaemon(object):
+    """asyncio front end that hands JSON jobs to a warm process pool and streams the replies back
+
+    Args:
+        socket_path: Unix socket to listen on.
+        workers: worker processes (defaults to the CPU count).
+        path_to_obs: observation directory the workers load from.
+    """
+
+    def __init__(self, socket_path=default_socket, workers=None, path_to_obs='vishnu_real_data'):
+        self.socket_path = socket_path
+        self.workers = workers or os.cpu_count()
+        self.events = multiprocessing.Queue()
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                            initargs=(self.events, path_to_obs))
+        self.job_ids = itertools.count()
+        self.writers = {}
+        self.finished = {}
+
+    async def _forward_events(self):
+        # Workers send progress, results and errors through one queue, so each job's events arrive in order
+        loop = asyncio.get_running_loop()
+        while True:
+            event = await loop.run_in_executor(None, self.events.get)
+            if event is None:
+                return
+
+            writer = self.writers.get(event['id'])
+            if writer is not None:
+                writer.write(encode(event))
+                await writer.drain()
+
+            if event['event'] in ('result', 'error'):
+                self._finish(event['id'])
+
+    def _finish(self, job_id):
+        self.writers.pop(job_id, None)
+        finished = self.finished.pop(job_id, None)
+        if (finished is not None) and not finished.done():
+            finished.set_result(True)
+
+    async def _run(self, job_id, job, writer):
+        loop = asyncio.get_running_loop()
+        self.writers[job_id] = writer
+        self.finished[job_id] = finished = loop.create_future()
+
+        try:
+            await loop.run_in_executor(self.executor, run_job, job_id, job)
+        except Exception as e:
+            # The worker itself died (run_job reports the job's own exceptions)
+            writer.write(encode({'id': job_id, 'event': 'error', 'error': f'{type(e).__name__}: {e}'}))
+            self._finish(job_id)
+
+        await finished
+
+    async def _handle(self, reader, writer):
+        tasks = []
+
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+
+            job_id = next(self.job_ids)
+            try:
+                job = json.loads(line)
+                if not isinstance(job, dict):
+                    raise ValueError(f'a job must be a JSON object, got {type(job).__name__}')
+                if job.get('type') not in job_types:
+                    raise ValueError(f"unknown job type {job.get('type')}, expected one of {list(job_types)}")
+            except ValueError as e:
+                writer.write(encode({'id': job_id, 'event': 'error', 'error': str(e)}))
+                continue
+
+            writer.write(encode({'id': job_id, 'event': 'accepted', 'type': job['type']}))
+            tasks.append(asyncio.ensure_future(self._run(job_id, job, writer)))
+
+        await asyncio.gather(*tasks)
+        writer.close()
+
+    async def serve(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        # Start the workers (and their warm-up) now rather than on the first job
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.executor, int) for _ in range(self.workers)])
+
+        forwarder = asyncio.ensure_future(self._forward_events())
+        server = await asyncio.start_unix_server(self._handle, path=self.socket_path)
+        print(f'listening on {self.socket_path}', flush=True)
+
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.events.put(None)
+            await forwarder
+            self.executor.shutdown()
+            os.remove(self.socket_path)
+
+
+def submit(job, socket_path=default_socket):
+    """Sends one job to a running daemon and yields its replies until the result (or error) arrives"""
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(socket_path)
+        s.sendall((json.dumps(job, default=_jsonable) + '\n').encode())
+        s.shutdown(socket.SHUT_WR)
+
+        for line in s.makefile('r'):
+            message = json.loads(line)
+            yield (message)
+            if message['event'] in ('result', 'error'):
+                return
+
+
+if __name__ == '__main__':
+    positional, options = inverter_tools.parse_options(sys.argv)
+    socket_path = options.get('socket', default_socket)
+
+    if positional[0] == 'serve':
+        daemon = InversionDaemon(socket_path,
+                                 workers=int(options['workers']) if 'workers' in options else None,
+                                 path_to_obs=options.get('obs', 'vishnu_real_data'))
+        asyncio.run(daemon.serve())
+    elif positional[0] == 'submit':
+        for message in submit(json.loads(positional[1]), socket_path):
+            print(json.dumps(message))
+    else:
+        print(__doc__)
@@ -1,5 +1,8 @@
-from inverter_tools import check_valid_bounds
+from multiprocessing import Pool
+from inverter_tools import batch_cost, calculate_residuals, check_valid_bounds, obs_dict_to_array, residual_fn, \
+    run_model_batch
 import numpy as np
+from scipy.optimize import OptimizeResult, least_squares
 
 class MyTakeStep(object):
     def __init__(self, bounds, stepsize=1):
@@ -13,6 +16,81 @@ class MyTakeStep(object):
             x[i] += np.random.uniform(-b_r * s, b_r * s)
         return x
 
+class BoundedTakeStep(object):
+    """Basinhopping step-taker that only proposes in-bounds points and adapts its step per dimension
+
+    Each hop perturbs a random subset of the parameters (each with probability dim_fraction, at least one) by up
+    to +/- step_fractions[i] of that parameter's range, and folds any overshoot back into the box by reflection,
+    so no local minimization is spent on a point MyBounds would reject.
+
+    basinhopping reports the outcome of every hop to report(). Each dimension keeps its own acceptance record over
+    the hops in which it was perturbed; every `interval` such hops its step is widened if it is accepted more often
+    than target_accept_rate and narrowed otherwise. The per-dimension steps are deliberately not called `stepsize`,
+    which would make basinhopping wrap this object in its own single-scale AdaptiveStepsize.
+    """
+
+    def __init__(self, bounds, step_fraction=0.5, dim_fraction=0.5, target_accept_rate=0.5, factor=0.9,
+                 interval=10, min_fraction=0.01):
+        self.lows, self.highs = np.array(bounds, dtype=float).T
+        self.step_fractions = np.full(len(bounds), float(step_fraction))
+        self.dim_fraction = dim_fraction
+        self.target_accept_rate = target_accept_rate
+        self.factor = factor
+        self.interval = interval
+        self.min_fraction = min_fraction
+
+        self.n_proposed = 0
+        self.n_accepted = 0
+        self.dim_proposed = np.zeros(len(bounds), dtype=int)
+        self.dim_accepted = np.zeros(len(bounds), dtype=int)
+        self._window_proposed = np.zeros(len(bounds), dtype=int)
+        self._window_accepted = np.zeros(len(bounds), dtype=int)
+        self._moved = np.zeros(len(bounds), dtype=bool)
+
+    def __call__(self, x):
+        ranges = self.highs - self.lows
+
+        moved = np.random.uniform(size=len(x)) < self.dim_fraction
+        if not moved.any():
+            moved[np.random.randint(len(x))] = True
+
+        step = np.random.uniform(-1, 1, size=len(x)) * self.step_fractions * ranges
+        x_new = np.where(moved, np.asarray(x, dtype=float) + step, x)
+
+        # Reflect off the bounds (folding repeatedly for steps longer than the range)
+        folded = np.mod(x_new - self.lows, 2 * ranges)
+        x_new = self.lows + np.where(folded > ranges, 2 * ranges - folded, folded)
+
+        self._moved = moved
+
+        return (x_new)
+
+    def report(self, accept, **kwargs):
+        self.n_proposed += 1
+        self.n_accepted += int(accept)
+        self.dim_proposed += self._moved
+        self.dim_accepted += self._moved & bool(accept)
+        self._window_proposed += self._moved
+        self._window_accepted += self._moved & bool(accept)
+
+        for i in np.flatnonzero(self._window_proposed >= self.interval):
+            if self._window_accepted[i] / self._window_proposed[i] > self.target_accept_rate:
+                self.step_fractions[i] = min(self.step_fractions[i] / self.factor, 1.0)
+            else:
+                self.step_fractions[i] = max(self.step_fractions[i] * self.factor, self.min_fraction)
+            self._window_proposed[i], self._window_accepted[i] = 0, 0
+
+    def acceptance_stats(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            dim_rates = self.dim_accepted / self.dim_proposed
+
+        return ({'proposed': self.n_proposed,
+                 'accepted': self.n_accepted,
+                 'accept_rate': self.n_accepted / self.n_proposed if self.n_proposed else np.nan,
+                 'dim_accept_rates': dim_rates,
+                 'step_fractions': self.step_fractions.copy()})
+
+
 class MyBounds(object):
     def __init__(self, bounds):
         self.bounds = bounds
@@ -22,3 +100,176 @@ class MyBounds(object):
         valid_bounds = check_valid_bounds(params, self.bounds)
         return valid_bounds
 
+
+class FiniteDifferenceJacobian(object):
+    """Cost and finite-difference gradient from one batched evaluation of all perturbed points
+
+    Replaces SciPy's serial gradient (one SMRT run per parameter, per iteration). Calling the object returns
+    (cost, gradient), so it plugs into minimize/basinhopping with jac=True in the minimizer kwargs. The base point
+    and the 12 (forward) or 24 (central) perturbed points are sent through run_model_batch in one call, or spread over
+    a worker pool when `processes` is set.
+
+    Steps are rel_step times each parameter's range in `bounds`; a forward step that would leave the box is taken
+    backwards instead, and central steps are clipped to the box. With a ParameterSpace, x, bounds and the gradient
+    are in its free coordinates and each point is mapped to the full vector before running. The pool is started on
+    first use and released by close() (or by using the object in a with block).
+    """
+
+    def __init__(self, bounds, rel_step=1e-3, central=False, processes=None, space=None):
+        self.bounds = bounds
+        self.space = space
+        self.steps = rel_step * np.array([abs(b[1] - b[0]) for b in bounds])
+        self.lows, self.highs = np.array(bounds, dtype=float).T
+        self.central = central
+        self.processes = processes
+        self.n_calls = 0
+        self._pool = None
+
+    def points(self, x):
+        x = np.asarray(x, dtype=float)
+        eye = np.eye(len(x))
+
+        if self.central:
+            upper = np.minimum(x + eye * self.steps, self.highs)
+            lower = np.maximum(x - eye * self.steps, self.lows)
+        else:
+            forward = (x + self.steps <= self.highs)[:, None]
+            upper = np.where(forward, x + eye * self.steps, x)
+            lower = np.where(forward, x, x - eye * self.steps)
+
+        return (np.vstack([x, upper, lower]))
+
+    def __call__(self, params, l):
+        n = len(params)
+        points = self.points(params)
+        costs = batch_cost(self.evaluate(points), obs_dict_to_array(l))
+        self.n_calls += 1
+
+        upper, lower = points[1:n + 1], points[n + 1:]
+        h = np.diag(upper - lower)
+        gradient = (costs[1:n + 1] - costs[n + 1:]) / h
+
+        return (costs[0], np.nan_to_num(gradient))
+
+    def evaluate(self, points):
+        """Returns the (N, channel, angle) model output for an array of points, running each distinct point once"""
+
+        unique, inverse = np.unique(points, axis=0, return_inverse=True)
+        if self.space is not None:
+            unique = np.array([self.space.to_full(point) for point in unique])
+
+        if self.processes and self.processes > 1:
+            if self._pool is None:
+                self._pool = Pool(self.processes)
+            chunk_size = int(np.ceil(len(unique) / self.processes))
+            chunks = [unique[i:i + chunk_size] for i in range(0, len(unique), chunk_size)]
+            sigma = np.concatenate(self._pool.map(run_model_batch, chunks))
+        else:
+            sigma = run_model_batch(unique)
+
+        return (sigma[np.ravel(inverse)])
+
+    def jac(self, params, l):
+        return (self(params, l)[1])
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return (self)
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getstate__(self):
+        # Pools can't be pickled (e.g. when sent to a multistart worker); the copy builds its own if needed
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        return (state)
+
+class LeastSquaresMinimizer(object):
+    """Bounded Gauss-Newton/Levenberg-Marquardt local minimizer on the 44-element residual vector
+
+    Usable wherever SciPy accepts a custom minimizer, i.e. minimize(calculate_cost, x0, args=(obs,), method=this)
+    or as minimizer_kwargs['method'] in basinhopping. The scalar function passed in is ignored; the fit runs
+    scipy.optimize.least_squares (trust-region reflective, so bounds are respected) on calculate_residuals.
+
+    The Jacobian is built by one batched finite-difference evaluation and afterwards updated by Broyden rank-one
+    updates from the residuals already computed at each accepted step, with a fresh finite-difference Jacobian every
+    `refresh_every` Jacobian requests. n_forward counts the SMRT runs, for comparison with the scalar path.
+    With a ParameterSpace the fit runs in its free coordinates (bounds must then be space.free_bounds).
+    """
+
+    def __init__(self, bounds, rel_step=1e-3, refresh_every=10, max_nfev=None, space=None):
+        self.bounds = bounds
+        self.space = space
+        self.differences = FiniteDifferenceJacobian(bounds, rel_step=rel_step, space=space)
+        self.refresh_every = refresh_every
+        self.max_nfev = max_nfev
+        self.n_forward = 0
+
+    def residuals(self, x, l):
+        r = calculate_residuals(x if self.space is None else self.space.to_full(x), l)
+        self.n_forward += 1
+        self._last = (np.array(x), r)
+
+        return (r)
+
+    def jacobian(self, x, l):
+        x = np.array(x)
+        r = self._last[1] if np.array_equal(self._last[0], x) else self.residuals(x, l)
+
+        if (self._jac is None) or (self._n_jac % self.refresh_every == 0):
+            self._jac = self._finite_difference(x, r, l)
+        else:
+            dx = x - self._jac_x
+            if np.dot(dx, dx) > 0:
+                self._jac = self._jac + np.outer(r - self._jac_r - self._jac @ dx, dx) / np.dot(dx, dx)
+
+        self._jac_x, self._jac_r = x, r
+        self._n_jac += 1
+
+        return (self._jac)
+
+    def _finite_difference(self, x, r_x, l):
+        # The residuals at x are already known, so only the perturbed points are run
+        n = len(x)
+        points = self.differences.points(x)
+        perturbed = np.any(points != x, axis=1)
+
+        r = np.empty((len(points), len(r_x)))
+        r[~perturbed] = r_x
+        if perturbed.any():
+            sigma = self.differences.evaluate(points[perturbed])
+            r[perturbed] = [residual_fn(s, l) for s in sigma]
+            self.n_forward += len(np.unique(points[perturbed], axis=0))
+
+        h = np.diag(points[1:n + 1] - points[n + 1:])
+
+        return (np.nan_to_num(((r[1:n + 1] - r[n + 1:]) / h[:, None]).T))
+
+    def __call__(self, fun, x0, args=(), **kwargs):
+        l = args[0]
+        self._jac, self._n_jac, self._last = None, 0, (None, None)
+        n_forward_start = self.n_forward
+
+        lows, highs = np.array(self.bounds, dtype=float).T
+        fit = least_squares(self.residuals,
+                            np.clip(x0, lows, highs),
+                            jac=self.jacobian,
+                            bounds=(lows, highs),
+                            method='trf',
+                            x_scale='jac',
+                            max_nfev=self.max_nfev,
+                            args=(l,))
+
+        return (OptimizeResult(x=fit.x,
+                               fun=float(np.sum(fit.fun ** 2)),
+                               success=fit.success,
+                               status=fit.status,
+                               message=fit.message,
+                               nfev=self.n_forward - n_forward_start,
+                               njev=fit.njev))
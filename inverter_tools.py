@@ -1,26 +1,29 @@
 import numpy as np
-import pandas as pd
 from smrt import make_snowpack, make_model, make_ice_column, PSU
 from smrt.interface.iem_fung92_brogioni10 import IEM_Fung92_Briogoni10
 from smrt.permittivity.saline_ice import saline_ice_permittivity_pvs_mixing
 import itertools
+import functools
+from multiprocessing import Pool
 import smrt
-import matplotlib.pyplot as plt
+from model_cache import ForwardCache
+from model_result import ModelResult
+import obs_store
+import profiling
+from parameter_space import default_space
+
+# Shared by every caller of run_from_params in this process. Set to None to disable caching.
+forward_cache = ForwardCache()
+
+# Optional minima_log.ForwardLog that every full-fidelity forward run is archived to (for signature_index)
+forward_log = None
+
+# Declarative description of the parameter vector; every positional vector in this package follows its order
+parameter_space = default_space()
+
 
 def get_initial_bounds():
-    initial_bounds = [(0.08, 0.6),  # Snow Depth
-                      (0.6, 2.5),  # Ice Thickness
-                      (0.05, 3),  # Ice Salinity
-                      (790, 920),  # Ice Density
-                      (255, 270),  # Temperature
-                      (0.1, 0.4),  # Snow MCL
-                      (0.1, 1),  # Ice MCL
-                      (250, 400),  # Snow Density
-                      #                  (0,1), # Snow Salinity
-                      (0.3, 1.5),  # Snow RMS
-                      (8, 120),  # Snow RCL
-                      (0.1, 2.3),  # Ice RMS
-                      (10, 150)]  # Ice RCL
+    initial_bounds = parameter_space.bounds
 
     return(initial_bounds)
 
@@ -41,7 +44,8 @@ def CL_parse(arguments):
         arguments: the arguments given in the command line.
 
     Returns:
-        A dictionary with info on the computer type and which tracks the job should run.
+        A dictionary with info on the computer type and which tracks the job should run, plus any --name=value
+        options.
 
     """
 
@@ -49,25 +53,64 @@ def CL_parse(arguments):
                    'niter':int(arguments[2]),
                    'hpc':('-hpc' in arguments)}
 
+    # Optional settings are passed as --name=value (e.g. --lut=output/lut)
+    return_dict.update(parse_options(arguments)[1])
+
     return(return_dict)
 
-def prep_obs(path_to_obs,resampler='3H',interpolate=False):
+
+def parse_options(arguments):
+    """Splits command line arguments into positional arguments and --name=value options
+
+    Args:
+        arguments: the arguments given in the command line (sys.argv; the script name is skipped).
+
+    Returns:
+        (positional, options): the arguments not starting with '--', and a dictionary of the --name=value options
+        with any dashes in the names replaced by underscores.
+    """
+
+    positional, options = [], {}
+
+    for argument in arguments[1:]:
+        if not argument.startswith('--'):
+            positional.append(argument)
+        elif '=' in argument:
+            name, value = argument[2:].split('=', 1)
+            options[name.replace('-', '_')] = value
+
+    return (positional, options)
+
+def prep_obs(path_to_obs,resampler='3H',interpolate=False,sites=(1, 2, 3),start_date=None,end_date=None,
+             use_cache=True):
+    """Loads the resampled KuKa signatures, keyed like 'Ku_HH_RS2'
+
+    By default the Excel files are parsed once per site and resampler and kept as .npy arrays under
+    {path_to_obs}/cache (see obs_store), rebuilt whenever a source file changes. Only the requested sites and the
+    window between start_date and end_date are loaded.
+    """
+
     signatures, start_dates, end_dates = {}, {}, {}
 
-    for site_number, band, pol in itertools.product([1, 2, 3], ['Ka', 'Ku'], ['VV', 'HH', 'HV']):
-        df = pd.read_excel(f'{path_to_obs}/{band}_RS{site_number} Site.xlsx',
-                           index_col='Unnamed: 0',
-                           sheet_name=pol,
-                           parse_dates=True)
+    if use_cache:
+        for site_number in sites:
+            site_signatures, site_starts, site_ends = obs_store.load_site(path_to_obs, site_number, resampler,
+                                                                          start_date, end_date, interpolate)
+            signatures.update(site_signatures)
+            start_dates.update(site_starts)
+            end_dates.update(site_ends)
+
+        return (signatures, start_dates, end_dates)
 
-        df_resampled = df.resample(resampler).mean()
+    for site_number, band, pol in itertools.product(sites, ['Ka', 'Ku'], ['VV', 'HH', 'HV']):
+        df_resampled = obs_store.read_sheet(path_to_obs, site_number, band, pol, resampler)
 
         key = f'{band}_{pol}_RS{site_number}'
 
         if interpolate:
-            signatures[key] = df_resampled.interpolate(method='linear')
+            signatures[key] = df_resampled.interpolate(method='linear').loc[start_date:end_date]
         else:
-            signatures[key] = df_resampled
+            signatures[key] = df_resampled.loc[start_date:end_date]
 
         start_dates[key] = df_resampled.index[0]
         end_dates[key] = df_resampled.index[-1]
@@ -93,6 +136,176 @@ def check_guess_in_bounds(initial_guess, initial_bounds):
     return (0)
 
 
+K_u = 13.575e9
+K_a = 35e9
+freqs = {K_u: 'Ku', K_a: 'Ka'}
+
+# Order of the channel axis in every array-valued model output
+channels = [f'{freqs[freq]}_{pol_inc}{pol}' for pol_inc, pol, freq in itertools.product(['H'], ['V', 'H'], [K_a, K_u])]
+
+default_angles = np.arange(0, 51, 5)
+
+# Cheaper model settings for coarse search phases. Low fidelity runs DORT with fewer streams at every other angle
+# and interpolates back onto the requested angles, so its output has the same shape as a full run.
+fidelity_levels = {'full': {'angles': None, 'n_max_stream': None},
+                   'low': {'angles': np.arange(0, 51, 10), 'n_max_stream': 16}}
+
+_sensors = {}
+_models = {}
+
+# Number of SMRT media run by this process (pool workers keep their own count)
+forward_runs = 0
+
+
+def get_sensor(angles=default_angles):
+    """Returns the KuKa sensor for a set of incidence angles, building it only once per angle set"""
+
+    key = tuple(np.atleast_1d(angles).tolist())
+    if key not in _sensors:
+        _sensors[key] = smrt.sensor.active([K_u, K_a], angles, polarization_inc=['H'], polarization=['V', 'H'])
+
+    return (_sensors[key])
+
+
+def get_model(emmodel="iba", rtsolver="dort", n_max_stream=None):
+    """Returns an SMRT model, building it only once per (emmodel, rtsolver, n_max_stream)"""
+
+    key = (emmodel, rtsolver, n_max_stream)
+    if key not in _models:
+        rtsolver_options = None if n_max_stream is None else {'n_max_stream': n_max_stream}
+        _models[key] = make_model(emmodel, rtsolver, rtsolver_options=rtsolver_options)
+
+    return (_models[key])
+
+
+def cached_permittivity(permittivity_model, maxsize=4096):
+    """Memoizes a permittivity function on its (hashable) arguments
+
+    Repeated evaluations at the same frequency, temperature, salinity and density (the common case while only
+    snow or roughness parameters change) return the stored value. functools.wraps keeps the wrapped signature and
+    attributes visible to SMRT's layer-property introspection.
+    """
+
+    cached = functools.lru_cache(maxsize=maxsize)(permittivity_model)
+
+    @functools.wraps(permittivity_model)
+    def wrapper(*args, **kwargs):
+        try:
+            return (cached(*args, **kwargs))
+        except TypeError:
+            # Unhashable arguments (e.g. arrays of frequencies) bypass the cache
+            return (permittivity_model(*args, **kwargs))
+
+    wrapper.cache_info = cached.cache_info
+    wrapper.cache_clear = cached.cache_clear
+
+    return (wrapper)
+
+
+ice_permittivity_model = cached_permittivity(saline_ice_permittivity_pvs_mixing)
+
+# Sub-model caches: each piece of the medium is rebuilt only when a parameter it depends on changes
+submodel_caching = True
+
+
+@functools.lru_cache(maxsize=256)
+def _make_interface(roughness_rms, roughness_CL):
+    with profiling.timer('interfaces'):
+        interface = IEM_Fung92_Briogoni10(roughness_rms=roughness_rms * 1e-3,
+                                          corr_length=roughness_CL * 1e-3)
+
+    return (interface)
+
+
+@functools.lru_cache(maxsize=256)
+def _make_ice_column(ice_thickness, temp, ice_CL_e3, ice_density, ice_salinity, ice_roughness_rms, ice_roughness_CL):
+    snow_ice_interface = _make_interface(ice_roughness_rms, ice_roughness_CL)
+
+    with profiling.timer('make_ice_column'):
+        ice_column = make_ice_column(ice_type='multiyear',
+                                     thickness=[ice_thickness],
+                                     temperature=temp,
+                                     brine_inclusion_shape='needles',
+                                     corr_length=ice_CL_e3 / 1000,
+                                     density=ice_density,
+                                     salinity=ice_salinity * PSU,
+                                     microstructure_model='exponential',
+                                     add_water_substrate='ocean',
+                                     ice_permittivity_model=ice_permittivity_model,
+                                     interface=snow_ice_interface,
+
+                                     )
+
+    return (ice_column)
+
+
+@functools.lru_cache(maxsize=256)
+def _make_snowpack(snow_depth, snow_density, temp, snow_CL_e3, snow_sal, snow_roughness_rms, snow_roughness_CL):
+    snow_air_interface = _make_interface(snow_roughness_rms, snow_roughness_CL)
+
+    with profiling.timer('make_snowpack'):
+        snowpack = make_snowpack(thickness=[snow_depth],
+                                 microstructure_model="exponential",
+                                 density=snow_density,
+                                 temperature=temp,
+                                 corr_length=snow_CL_e3 / 1000,
+                                 salinity=snow_sal,
+                                 #                              ice_permittivity_model = saline_snow_permittivity_geldsetzer09,
+                                 interface=snow_air_interface,
+                                 )
+
+    return (snowpack)
+
+
+def submodel_cache_info():
+    return ({'interfaces': _make_interface.cache_info(),
+             'ice_columns': _make_ice_column.cache_info(),
+             'snowpacks': _make_snowpack.cache_info(),
+             'ice_permittivity': ice_permittivity_model.cache_info()})
+
+
+def clear_submodel_caches():
+    for cached in (_make_interface, _make_ice_column, _make_snowpack, ice_permittivity_model):
+        cached.cache_clear()
+
+
+def make_medium(snow_depth,
+                ice_thickness,
+                ice_salinity,
+                ice_density,
+                temp,
+                snow_CL_e3,
+                ice_CL_e3,
+                snow_density,
+                snow_sal,
+                snow_roughness_rms,
+                snow_roughness_CL,
+                ice_roughness_rms,
+                ice_roughness_CL,
+                ):
+    """Builds the two-layer snow on sea ice medium from geophysical variables
+
+    The ice column, snowpack and interfaces come from caches keyed on only the parameters each depends on, so e.g. a
+    snow roughness change rebuilds the snow-air interface and snowpack but reuses the ice column.
+    """
+
+    ice_args = tuple(float(p) for p in (ice_thickness, temp, ice_CL_e3, ice_density, ice_salinity,
+                                        ice_roughness_rms, ice_roughness_CL))
+    snow_args = tuple(float(p) for p in (snow_depth, snow_density, temp, snow_CL_e3, snow_sal,
+                                         snow_roughness_rms, snow_roughness_CL))
+
+    if submodel_caching:
+        ice_column = _make_ice_column(*ice_args)
+        snowpack = _make_snowpack(*snow_args)
+    else:
+        ice_column = _make_ice_column.__wrapped__(*ice_args)
+        snowpack = _make_snowpack.__wrapped__(*snow_args)
+
+    medium = snowpack + ice_column
+
+    return (medium)
+
+
 def run_model(snow_depth,
               ice_thickness,
               ice_salinity,
@@ -106,73 +319,167 @@ def run_model(snow_depth,
               snow_roughness_CL,
               ice_roughness_rms,
               ice_roughness_CL,
-              angles= np.arange(0, 51, 5),
+              angles= default_angles,
+              fidelity='full',
               ):
-    """Runs SMRT from geophysical variables and returns a dictionary of results"""
+    """Runs SMRT from geophysical variables and returns a ModelResult (readable like a dictionary of results)
 
-    K_u = 13.575e9
-    K_a = 35e9
-    freqs = {K_u: 'Ku', K_a: 'Ka'}
+    fidelity selects one of fidelity_levels; anything but 'full' trades accuracy for speed.
+    """
 
-    snow_air_interface = IEM_Fung92_Briogoni10(roughness_rms=snow_roughness_rms * 1e-3,
-                                               corr_length=snow_roughness_CL * 1e-3)
+    medium = make_medium(snow_depth=snow_depth,
+                         ice_thickness=ice_thickness,
+                         ice_salinity=ice_salinity,
+                         ice_density=ice_density,
+                         temp=temp,
+                         snow_CL_e3=snow_CL_e3,
+                         ice_CL_e3=ice_CL_e3,
+                         snow_density=snow_density,
+                         snow_sal=snow_sal,
+                         snow_roughness_rms=snow_roughness_rms,
+                         snow_roughness_CL=snow_roughness_CL,
+                         ice_roughness_rms=ice_roughness_rms,
+                         ice_roughness_CL=ice_roughness_CL,
+                         )
 
-    snow_ice_interface = IEM_Fung92_Briogoni10(roughness_rms=ice_roughness_rms * 1e-3,
-                                               corr_length=ice_roughness_CL * 1e-3)
+    level = fidelity_levels[fidelity]
+    run_angles = angles if level['angles'] is None else level['angles']
 
-    ice_column = make_ice_column(ice_type='multiyear',
-                                 thickness=[ice_thickness],
-                                 temperature=temp,
-                                 brine_inclusion_shape='needles',
-                                 corr_length=ice_CL_e3 / 1000,
-                                 density=ice_density,
-                                 salinity=ice_salinity * PSU,
-                                 microstructure_model='exponential',
-                                 add_water_substrate='ocean',
-                                 ice_permittivity_model=saline_ice_permittivity_pvs_mixing,
-                                 interface=snow_ice_interface,
+    sensor = get_sensor(run_angles)
 
-                                 )
+    m = get_model("iba", "dort", level['n_max_stream'])
 
-    snowpack = make_snowpack(thickness=[snow_depth],
-                             microstructure_model="exponential",
-                             density=snow_density,
-                             temperature=temp,
-                             corr_length=snow_CL_e3 / 1000,
-                             salinity=snow_sal,
-                             #                              ice_permittivity_model = saline_snow_permittivity_geldsetzer09,
-                             interface=snow_air_interface,
-                             )
+    results = run_model_from_medium(medium, sensor, m, run_angles)
 
-    medium = snowpack + ice_column
+    if run_angles is not angles:
+        sigma = np.array([np.interp(angles, run_angles, row) for row in results.sigma])
+        results = ModelResult(sigma, channels, np.atleast_1d(angles))
+
+    return (results)
 
-    sensor = smrt.sensor.active([K_u, K_a], angles, polarization_inc=['H'], polarization=['V', 'H'])
 
-    m = make_model("iba", "dort")
+def medium_from_params(params):
+    """Builds the medium for a full parameter vector (ordered as parameter_space)"""
 
-    res = m.run(sensor, medium)
+    medium = make_medium(**parameter_space.as_dict(params),
+                         snow_sal=0,
+                         )
 
-    results = {}
+    return (medium)
 
-    for pol_inc, pol, freq in itertools.product(['H'], ['V', 'H'], [K_a, K_u]):
-        # Turn SMRT results object into a sliced dataframe
 
-        s_res = res.sigma_dB_as_dataframe(polarization_inc=pol_inc,
-                                          polarization=pol,
-                                          frequency=freq)
+def run_model_batch(params_array, angles=default_angles):
+    """Runs SMRT for many parameter vectors in one call
 
-        # Process slice into dictionary
+    The sensor and model are built once and the N media are sent through a single m.run call. If the batched run
+    fails (e.g. one medium is unphysical) the batch is re-run member by member and the failed members are NaN-filled,
+    which the cost functions already treat as a penalty.
 
-        results[f'{freqs[freq]}_{pol_inc}{pol}'] = np.array(s_res['sigma'])
+    Args:
+        params_array: (N, 12) array of parameter vectors, ordered as in get_initial_bounds.
+        angles: incidence angles in degrees.
+
+    Returns:
+        An (N, channel, angle) array of backscatter in dB with channels ordered as in `channels`.
+    """
+
+    params_array = np.atleast_2d(np.asarray(params_array, dtype=float))
+    n = params_array.shape[0]
+    sigma = np.full((n, len(channels), len(np.atleast_1d(angles))), np.nan)
+
+    if n == 0:
+        return (sigma)
+
+    sensor = get_sensor(angles)
+    m = get_model("iba", "dort")
+
+    try:
+        media = [medium_from_params(params) for params in params_array]
+        with profiling.timer('dort_solve_batch'):
+            res = m.run(sensor, media if n > 1 else media[0])
+        count_forward_runs(n)
+
+        with profiling.timer('extract_results_batch'):
+            for c, (pol_inc, pol, freq) in enumerate(itertools.product(['H'], ['V', 'H'], [K_a, K_u])):
+                s = res.sigma_dB(polarization_inc=pol_inc, polarization=pol, frequency=freq)
+                sigma[:, c, :] = np.asarray(s.transpose('snowpack', ...) if n > 1 else s).reshape(n, -1)
+
+    except Exception as e:
+        print(e)
+        profiling.count('batch_fallbacks')
+        for i, params in enumerate(params_array):
+            try:
+                sigma[i] = results_to_array(run_model_from_medium(medium_from_params(params), sensor, m, angles))
+            except Exception as e:
+                print(e)
+
+    if np.array_equal(angles, default_angles):
+        archive_forward_runs(params_array, sigma)
+
+    return (sigma)
+
+
+def run_model_pool(params_array, processes=None, chunk_size=8):
+    """Runs run_model_batch over a process pool, chunk_size vectors per task, and returns an (N, channel, angle) array"""
+
+    params_array = np.atleast_2d(np.asarray(params_array, dtype=float))
+    chunks = [params_array[i:i + chunk_size] for i in range(0, len(params_array), chunk_size)]
+
+    with Pool(processes) as pool:
+        sigmas = pool.map(run_model_batch, chunks)
+
+    return (np.concatenate(sigmas) if sigmas else run_model_batch(params_array))
+
+
+def run_model_from_medium(medium, sensor, m, angles=default_angles):
+    """Runs SMRT on a prepared medium and returns a ModelResult"""
+
+    with profiling.timer('dort_solve'):
+        res = m.run(sensor, medium)
+    count_forward_runs(1)
+
+    with profiling.timer('extract_results'):
+        results = ModelResult(extract_sigma(res), channels, np.atleast_1d(angles))
 
     return (results)
 
+
+def extract_sigma(res):
+    """Reads the (channel, angle) backscatter in dB straight from an SMRT result, without DataFrames"""
+
+    return (np.array([np.asarray(res.sigma_dB(polarization_inc=pol_inc, polarization=pol, frequency=freq),
+                                 dtype=float).ravel()
+                      for pol_inc, pol, freq in itertools.product(['H'], ['V', 'H'], [K_a, K_u])]))
+
+
+def count_forward_runs(n):
+    global forward_runs
+    forward_runs += n
+    profiling.count('forward_runs', n)
+
+
+def results_to_array(results):
+    """Stacks a results dictionary (or ModelResult) from run_model into a (channel, angle) array"""
+
+    if isinstance(results, ModelResult):
+        return (results.sigma)
+
+    return (np.array([results[channel] for channel in channels], dtype=float))
+
+
+def array_to_results(sigma, angles=default_angles):
+    """Inverse of results_to_array: wraps a (channel, angle) array (without copying) as a ModelResult"""
+
+    return (ModelResult(np.asarray(sigma, dtype=float), channels, angles))
+
+
 def get_obs_dict(start_date='2019-11-29 09:00:00',
                  end_date='2019-12-01 06:00:00',
                  site_no=2,
                  path_to_obs='../vishnu_real_data'):
 
-    signatures, start_dates, end_dates = prep_obs(path_to_obs)
+    signatures, start_dates, end_dates = prep_obs(path_to_obs, sites=[site_no],
+                                                  start_date=start_date, end_date=end_date)
 
     obs_dict = {}
     for i, j in itertools.product(['Ku', 'Ka'], ['VV', 'HV', 'HH']):
@@ -190,7 +497,15 @@ def plot_mod_and_obs(mod,
                      legend=False,
                      angles = np.arange(0, 51, 5),
                      shade_cost=True,
-                     show=True):
+                     show=True,
+                     timestep=0):
+
+    # Imported here so that headless runs never load matplotlib
+    import matplotlib.pyplot as plt
+
+    # An ObservationCube is plotted at one timestep
+    if hasattr(obs, 'obs_dict'):
+        obs = obs.obs_dict(timestep)
 
     fig, ax = plt.subplots(1,1,figsize=(8,5))
 
@@ -231,7 +546,32 @@ def plot_mod_and_obs(mod,
 
 
 
+def obs_dict_to_array(obs_dict):
+    """Stacks the modelled channels of an observation dictionary into a (channel, angle) array"""
+
+    if isinstance(obs_dict, np.ndarray):
+        return (obs_dict)
+
+    return (np.array([obs_dict[f'{channel}_Mean'] for channel in channels], dtype=float))
+
+
+def batch_cost(sigma, obs):
+    """Vectorized cost_fn for an (..., channel, angle) array of model output against a (channel, angle) obs array
+
+    Gives the same value as cost_fn for each leading index, including the 1000 penalty for any NaN.
+    """
+
+    sigma = np.asarray(sigma, dtype=float)
+    cost = np.sum(np.mean((sigma - obs) ** 2, axis=-1), axis=-1)
+    cost = np.where(np.isnan(cost), 1000., cost)
+
+    return (cost)
+
+
 def cost_fn(res, l):
+    if isinstance(res, ModelResult):
+        return (float(batch_cost(res.sigma, obs_dict_to_array(l))))
+
     rmsds = []
     for key in res.keys():
         model = np.array(res[key])
@@ -251,57 +591,105 @@ def cost_fn(res, l):
     return (cost)
 
 
-def calculate_cost(params, l):
+def calculate_cost(params, l, fidelity='full'):
+
+    profiling.count('calculate_cost')
 
     try:
-        trial_res = run_from_params(params)
+        with profiling.timer('calculate_cost'):
+            trial_res = run_from_params(params, fidelity=fidelity)
 
-        cost = cost_fn(trial_res, l)
+            cost = cost_fn(trial_res, l)
     except Exception as e:
         print(e)
+        profiling.count('swallowed_exceptions')
+        profiling.count(f'swallowed_{type(e).__name__}')
         cost = 1000
 
+    profiling.maybe_report(forward_cache.stats() if forward_cache is not None else None)
+
     return (cost)
 
 
+def residual_fn(sigma, l):
+    """Residual vector whose sum of squares equals cost_fn
+
+    Args:
+        sigma: a ModelResult or results dictionary from run_model, or a (channel, angle) array.
+        l: observation dictionary (or (channel, angle) array).
+
+    Returns:
+        A flat (channel * angle) array of (model - obs) / sqrt(n_angles). If anything is NaN every element is set so
+        that the sum of squares is the usual 1000 penalty.
+    """
+
+    if not isinstance(sigma, np.ndarray):
+        sigma = results_to_array(sigma)
+
+    diff = np.asarray(sigma, dtype=float) - obs_dict_to_array(l)
+    residuals = (diff / np.sqrt(diff.shape[-1])).ravel()
+
+    if np.isnan(residuals).any():
+        residuals = np.full(residuals.shape, np.sqrt(1000 / residuals.size))
+
+    return (residuals)
+
+
+def calculate_residuals(params, l):
+
+    try:
+        trial_res = run_from_params(params)
+
+        residuals = residual_fn(trial_res, l)
+    except Exception as e:
+        print(e)
+        profiling.count('swallowed_exceptions')
+        profiling.count(f'swallowed_{type(e).__name__}')
+        residuals = residual_fn(np.full((len(channels), len(default_angles)), np.nan), l)
+
+    return (residuals)
+
+
 def print_params(params):
-    params_dict = {'snow_depth': np.round(params[0],2),
-                   'ice_thickness': np.round(params[1],2),
-                   'ice_salinity': np.round(params[2],2),
-                   'ice_density': np.round(params[3],2),
-                   'temp': np.round(params[4],2),
-                   'snow_CL_e3': np.round(params[5],2),
-                   'ice_CL_e3': np.round(params[6],2),
-                   'snow_density': np.round(params[7],2),
-                   'snow_roughness_rms': np.round(params[8],2),
-                   'snow_roughness_CL': np.round(params[9],2),
-                   'ice_roughness_rms': np.round(params[10],2),
-                   'ice_roughness_CL': np.round(params[11],2),
-                   }
+    params_dict = {name: np.round(value, 2) for name, value in zip(parameter_space.names, params)}
 
     return (params_dict)
 
 
-def run_from_params(params):
+def run_from_params(params, cache=True, fidelity='full'):
+
+    if cache and (forward_cache is not None):
+        return (forward_cache.cached_call(lambda p: _run_from_params(p, fidelity), params,
+                                          extra=None if fidelity == 'full' else fidelity))
+
+    return (_run_from_params(params, fidelity))
+
+
+def _run_from_params(params, fidelity='full'):
 
-    trial_res = run_model(snow_depth=params[0],
-                          ice_thickness=params[1],
-                          ice_salinity=params[2],
-                          ice_density=params[3],
-                          temp=params[4],
-                          snow_CL_e3=params[5],
-                          ice_CL_e3=params[6],
-                          snow_density=params[7],
+    trial_res = run_model(**parameter_space.as_dict(params),
                           snow_sal=0,
-                          snow_roughness_rms=params[8],
-                          snow_roughness_CL=params[9],
-                          ice_roughness_rms=params[10],
-                          ice_roughness_CL=params[11],
+                          fidelity=fidelity,
                           )
 
+    if fidelity == 'full':
+        archive_forward_runs(params, trial_res.sigma)
+
     return (trial_res)
 
 
+def archive_forward_runs(params, sigma):
+    """Appends forward runs to forward_log (if set), skipping failed runs"""
+
+    if forward_log is None:
+        return
+
+    sigma = np.asarray(sigma).reshape(len(np.atleast_2d(params)), -1)
+    for p, s in zip(np.atleast_2d(params), sigma):
+        if not np.isnan(s).any():
+            forward_log.append(p, s)
+
+
 def plot_fit(fit, l):
     tuned_res = run_from_params(fit.x)
     plot_mod_and_obs(tuned_res, l)
@@ -0,0 +1,226 @@
+import json
+import os
+import sys
+from multiprocessing import Pool
+import numpy as np
+from scipy.stats import qmc
+import inverter_tools
+from observations import ObservationCube
+
+
+def sample_parameter_space(n_samples, bounds=None, method='sobol', seed=0):
+    """Draws a space-filling sample of the parameter box
+
+    Args:
+        n_samples: number of parameter vectors to draw.
+        bounds: list of (low, high) tuples, defaults to get_initial_bounds().
+        method: 'sobol' (scrambled Sobol sequence) or 'lhs' (Latin hypercube).
+        seed: seed for the sampler so the table can be rebuilt exactly.
+
+    Returns:
+        An (n_samples, n_params) array.
+    """
+
+    if bounds is None:
+        bounds = inverter_tools.get_initial_bounds()
+
+    lows, highs = np.array(bounds, dtype=float).T
+
+    if method == 'sobol':
+        sampler = qmc.Sobol(d=len(bounds), scramble=True, seed=seed)
+    elif method == 'lhs':
+        sampler = qmc.LatinHypercube(d=len(bounds), seed=seed)
+    else:
+        raise ValueError(f'Unknown sampling method {method}')
+
+    unit_sample = sampler.random(n_samples)
+
+    return (qmc.scale(unit_sample, lows, highs))
+
+
+def _run_chunk(task):
+    chunk_no, params = task
+    return (chunk_no, inverter_tools.run_model_batch(params))
+
+
+def run_checkpointed(path, params, chunk_size=64, processes=None, meta=None):
+    """Runs the forward model over a fixed design on a process pool, checkpointing every chunk to disk
+
+    The design and results live in `path` as .npy files opened as memory maps: params (N, 12),
+    sigma (N, channel, angle) and done (one flag per chunk). Each chunk is flushed to disk and flagged as soon as a
+    worker returns it, so a pre-empted run picks up from the first unfinished chunk when called again with the same
+    path and design.
+
+    Args:
+        path: directory for the run.
+        params: (N, 12) design.
+        chunk_size: number of vectors per worker task (and per checkpoint).
+        processes: size of the process pool, defaults to os.cpu_count().
+        meta: extra JSON-serialisable description stored (and checked on resume) in meta.json.
+
+    Returns:
+        (params, sigma, done) memory maps.
+    """
+
+    os.makedirs(path, exist_ok=True)
+    meta_file = f'{path}/meta.json'
+    params = np.asarray(params, dtype=float)
+    n_samples = len(params)
+    n_chunks = int(np.ceil(n_samples / chunk_size))
+    n_angles = len(inverter_tools.default_angles)
+
+    meta = dict(meta or {})
+    meta.update({'n_samples': n_samples,
+                 'chunk_size': chunk_size,
+                 'bounds': inverter_tools.get_initial_bounds(),
+                 'channels': inverter_tools.channels,
+                 'angles': inverter_tools.default_angles.tolist()})
+
+    if os.path.exists(meta_file):
+        stored_meta = json.load(open(meta_file))
+        stored_params = np.load(f'{path}/params.npy', mmap_mode='r')
+        if (json.loads(json.dumps(meta)) != stored_meta) or not np.array_equal(stored_params, params):
+            raise ValueError(f'{path} holds a different run: {stored_meta}')
+
+        params = stored_params
+        sigma = np.load(f'{path}/sigma.npy', mmap_mode='r+')
+        done = np.load(f'{path}/done.npy', mmap_mode='r+')
+    else:
+        stored_params = np.lib.format.open_memmap(f'{path}/params.npy', mode='w+', dtype=np.float64,
+                                                  shape=params.shape)
+        stored_params[:] = params
+        stored_params.flush()
+        params = stored_params
+
+        sigma = np.lib.format.open_memmap(f'{path}/sigma.npy', mode='w+', dtype=np.float32,
+                                          shape=(n_samples, len(inverter_tools.channels), n_angles))
+        sigma[:] = np.nan
+        sigma.flush()
+
+        done = np.lib.format.open_memmap(f'{path}/done.npy', mode='w+', dtype=bool, shape=(n_chunks,))
+        done[:] = False
+        done.flush()
+
+        json.dump(meta, open(meta_file, 'w'), indent=1)
+
+    tasks = [(i, np.array(params[i * chunk_size:(i + 1) * chunk_size])) for i in range(n_chunks) if not done[i]]
+    print(f'{len(tasks)} of {n_chunks} chunks left to run')
+
+    if tasks:
+        with Pool(processes) as pool:
+            for chunk_no, chunk_sigma in pool.imap_unordered(_run_chunk, tasks):
+                sigma[chunk_no * chunk_size:chunk_no * chunk_size + len(chunk_sigma)] = chunk_sigma
+                sigma.flush()
+                done[chunk_no] = True
+                done.flush()
+                print(f'chunk {chunk_no} done ({int(np.sum(done))}/{n_chunks})')
+
+    return (params, sigma, done)
+
+
+def build_lut(path, n_samples, chunk_size=64, processes=None, method='sobol', seed=0):
+    """Builds (or resumes building) an on-disk lookup table of forward runs over a space-filling sample
+
+    See run_checkpointed for the on-disk layout and resume behaviour.
+
+    Args:
+        path: directory for the table.
+        n_samples: number of parameter vectors in the table.
+        chunk_size: number of vectors per worker task (and per checkpoint).
+        processes: size of the process pool, defaults to os.cpu_count().
+        method: sampling method passed to sample_parameter_space.
+        seed: sampling seed.
+    """
+
+    sample = sample_parameter_space(n_samples, method=method, seed=seed)
+    run_checkpointed(path, sample, chunk_size, processes, meta={'method': method, 'seed': seed})
+
+    return (LookupTable(path))
+
+
+class LookupTable(object):
+    """Read-only view of a table written by build_lut
+
+    The arrays stay memory-mapped, so queries stream through the table block by block rather than loading it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.meta = json.load(open(f'{path}/meta.json'))
+        self.params = np.load(f'{path}/params.npy', mmap_mode='r')
+        self.sigma = np.load(f'{path}/sigma.npy', mmap_mode='r')
+        self.done = np.load(f'{path}/done.npy', mmap_mode='r')
+
+    def __len__(self):
+        return (self.params.shape[0])
+
+    def query(self, signature, k=10, block_size=65536):
+        """Returns the k entries whose modelled signature best matches an observation
+
+        Args:
+            signature: an obs_dict from get_obs_dict, a (channel, angle) array or an ObservationCube (matched on
+                its time-mean signature).
+            k: number of matches to return.
+            block_size: rows scored per block.
+
+        Returns:
+            (params, sigma, costs) for the k best entries, sorted by cost (as defined by cost_fn).
+        """
+
+        if isinstance(signature, ObservationCube):
+            signature = signature.mean()
+
+        signature = inverter_tools.obs_dict_to_array(signature)
+
+        chunk_size = self.meta['chunk_size']
+        best_index, best_cost = np.array([], dtype=np.int64), np.array([])
+
+        for start in range(0, len(self), block_size):
+            block = np.asarray(self.sigma[start:start + block_size], dtype=float)
+            costs = inverter_tools.batch_cost(block, signature)
+
+            # Rows in chunks that were never run are still NaN; keep them out of the ranking
+            finished = np.asarray(self.done)[(start + np.arange(len(block))) // chunk_size]
+            costs[~finished] = np.inf
+
+            best_index = np.concatenate([best_index, start + np.arange(len(block))])
+            best_cost = np.concatenate([best_cost, costs])
+
+            keep = np.argsort(best_cost, kind='stable')[:k]
+            best_index, best_cost = best_index[keep], best_cost[keep]
+
+        return (np.array(self.params[best_index]), np.array(self.sigma[best_index], dtype=float), best_cost)
+
+    def match_cube(self, cube, block_size=1024):
+        """Best table entry for every timestep of an ObservationCube, scored as one matrix op per block
+
+        Returns:
+            (params, costs): (T, 12) best parameters and (T,) their costs.
+        """
+
+        chunk_size = self.meta['chunk_size']
+        best_cost = np.full(len(cube), np.inf)
+        best_index = np.zeros(len(cube), dtype=np.int64)
+
+        for start in range(0, len(self), block_size):
+            block = np.asarray(self.sigma[start:start + block_size], dtype=float)
+            costs = cube.cost_matrix(block)
+
+            finished = np.asarray(self.done)[(start + np.arange(len(block))) // chunk_size]
+            costs[~finished] = np.inf
+
+            block_best = np.argmin(costs, axis=0)
+            block_cost = costs[block_best, np.arange(len(cube))]
+            improved = block_cost < best_cost
+            best_cost[improved] = block_cost[improved]
+            best_index[improved] = start + block_best[improved]
+
+        return (np.array(self.params[best_index]), best_cost)
+
+
+if __name__ == '__main__':
+    # python lookup_table.py <path> <n_samples> [chunk_size] [processes]
+    build_lut(sys.argv[1],
+              int(sys.argv[2]),
+              chunk_size=int(sys.argv[3]) if len(sys.argv) > 3 else 64,
+              processes=int(sys.argv[4]) if len(sys.argv) > 4 else None)
@@ -0,0 +1,205 @@
+import glob
+import os
+import time
+import numpy as np
+import pandas as pd
+
+_magic = b'MINLOG1'
+
+
+def record_dtype(n_params):
+    return (np.dtype([('params', '<f8', (n_params,)),
+                      ('cost', '<f8'),
+                      ('timestamp', '<f8'),
+                      ('n_evals', '<i8'),
+                      ('accepted', '?'),
+                      ('chain', '<i4')]))
+
+
+class MinimaLog(object):
+    """Append-only log of basinhopping minima, one fixed-width binary record per hop
+
+    The file starts with a one-line header giving the parameter count, followed by packed records (params, cost,
+    unix timestamp, forward evaluations so far, accepted flag, chain number). Every record goes out in a single
+    write on an O_APPEND descriptor, so hops cost O(1) I/O, several processes can share a log, and a crash can at
+    worst leave a partial final record, which read_minima drops and reopening the log cuts off.
+
+    Args:
+        path: log file, created if it doesn't exist and appended to otherwise.
+        n_params: length of the parameter vectors.
+    """
+
+    magic = _magic
+    record_dtype = staticmethod(record_dtype)
+
+    def __init__(self, path, n_params=12):
+        self.path = path
+        self.dtype = self.record_dtype(n_params)
+
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        if os.fstat(self._fd).st_size == 0:
+            os.write(self._fd, self.magic + f' {n_params}\n'.encode())
+        elif _read_header(path, self.magic) != n_params:
+            raise ValueError(f'{path} holds records with a different number of parameters')
+        else:
+            self._drop_partial_record()
+
+    def _drop_partial_record(self):
+        # Records appended after a crash's fragment would all read back shifted, so cut it off before writing
+        with open(self.path, 'rb') as f:
+            header_length = len(f.readline())
+
+        size = os.fstat(self._fd).st_size
+        n_records = (size - header_length) // self.dtype.itemsize
+        if header_length + n_records * self.dtype.itemsize != size:
+            os.ftruncate(self._fd, header_length + n_records * self.dtype.itemsize)
+
+    def append(self, params, cost, accepted=True, n_evals=-1, chain=0, timestamp=None):
+        record = np.zeros(1, dtype=self.dtype)
+        record['params'] = params
+        record['cost'] = cost
+        record['timestamp'] = time.time() if timestamp is None else timestamp
+        record['n_evals'] = n_evals
+        record['accepted'] = accepted
+        record['chain'] = chain
+
+        self._write(record)
+
+    def _write(self, record):
+        os.write(self._fd, record.tobytes())
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return (self)
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getstate__(self):
+        # Reopened by each process it is sent to
+        return ({'path': self.path, 'n_params': self.dtype['params'].shape[0]})
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['n_params'])
+
+
+def forward_record_dtype(n_params, n_signature=44):
+    # 44 = 4 channels x 11 angles, the flattened (channel, angle) output of run_model
+    return (np.dtype([('params', '<f8', (n_params,)),
+                      ('sigma', '<f4', (n_signature,)),
+                      ('timestamp', '<f8')]))
+
+
+class ForwardLog(MinimaLog):
+    """Append-only archive of forward runs (params and flattened dB signature), in the MinimaLog file format
+
+    Set inverter_tools.forward_log to one to archive every full-fidelity forward run a search evaluates; the
+    archives feed signature_index.
+    """
+
+    magic = b'FWDLOG1'
+    record_dtype = staticmethod(forward_record_dtype)
+
+    def append(self, params, sigma, timestamp=None):
+        record = np.zeros(1, dtype=self.dtype)
+        record['params'] = params
+        record['sigma'] = np.ravel(sigma)
+        record['timestamp'] = time.time() if timestamp is None else timestamp
+
+        self._write(record)
+
+
+def _read_header(path, magic=_magic):
+    with open(path, 'rb') as f:
+        header = f.readline()
+
+    if not header.startswith(magic):
+        raise ValueError(f'{path} is not a {magic.decode()} log')
+
+    return (int(header.split()[1]))
+
+
+def read_records(path, log_class=MinimaLog):
+    """Reads one log (of the given MinimaLog class) into a structured array, ignoring a trailing partial record"""
+
+    n_params = _read_header(path, log_class.magic)
+    dtype = log_class.record_dtype(n_params)
+
+    with open(path, 'rb') as f:
+        f.readline()
+        data = f.read()
+
+    n_records = len(data) // dtype.itemsize
+
+    return (np.frombuffer(data[:n_records * dtype.itemsize], dtype=dtype))
+
+
+def read_minima(paths):
+    """Loads one or many minima logs into one DataFrame
+
+    Args:
+        paths: a path, a glob pattern or a list of either.
+
+    Returns:
+        A DataFrame with columns params, cost, datetime, n_evals, accepted, chain and job (the log file name without
+        extension), in time order.
+    """
+
+    if isinstance(paths, str):
+        paths = [paths]
+
+    files = sorted(set(f for p in paths for f in (glob.glob(p) or [p])))
+
+    frames = []
+    for f in files:
+        records = read_records(f)
+        frames.append(pd.DataFrame({'params': list(np.array(records['params'])),
+                                    'cost': records['cost'],
+                                    'datetime': pd.to_datetime(records['timestamp'], unit='s'),
+                                    'n_evals': records['n_evals'],
+                                    'accepted': records['accepted'],
+                                    'chain': records['chain'],
+                                    'job': os.path.splitext(os.path.basename(f))[0]}))
+
+    if not frames:
+        return (pd.DataFrame(columns=['params', 'cost', 'datetime', 'n_evals', 'accepted', 'chain', 'job']))
+
+    return (pd.concat(frames, ignore_index=True).sort_values('datetime', ignore_index=True))
+
+
+def best_minimum(paths):
+    """Returns (params, cost) of the lowest-cost record across one or many logs"""
+
+    df = read_minima(paths)
+    best = df['cost'].idxmin()
+
+    return (df.loc[best, 'params'], df.loc[best, 'cost'])
+
+
+def distinct_minima(paths, n, bounds, tolerance=0.05):
+    """Returns up to n minima from one or many logs, best first, that lie in different basins
+
+    A minimum is skipped if every parameter is within `tolerance` (as a fraction of the parameter's range in
+    bounds) of a better minimum already chosen.
+
+    Returns:
+        (params, costs) as an (m, n_params) array and an (m,) array, m <= n.
+    """
+
+    df = read_minima(paths).sort_values('cost', ignore_index=True)
+    lows, highs = np.array(bounds, dtype=float).T
+
+    chosen, costs = [], []
+    for params, cost in zip(df['params'], df['cost']):
+        unit = (np.asarray(params) - lows) / (highs - lows)
+        if all(np.max(np.abs(unit - other)) > tolerance for other in chosen):
+            chosen.append(unit)
+            costs.append(cost)
+            if len(chosen) == n:
+                break
+
+    return (lows + np.array(chosen).reshape(-1, len(lows)) * (highs - lows), np.array(costs))
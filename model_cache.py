@@ -0,0 +1,107 @@
+from collections import OrderedDict
+import numpy as np
+import profiling
+
+
+class ForwardCache(object):
+    """In-process LRU cache of forward-model results keyed on a quantized parameter vector
+
+    Parameter vectors are snapped to a grid of spacing `tolerances` (a scalar or one value per parameter) before
+    being used as a key, so two vectors that agree to within a tolerance in every dimension share an entry. The
+    tolerances must stay well below the finite-difference step used by the local minimizers (~1.5e-8 for SLSQP and
+    1e-8 for L-BFGS-B), otherwise perturbed gradient points collapse onto the base point and the gradient vanishes.
+
+    The cache is bounded by both an entry count and an approximate memory cap. The least-recently used entry is
+    evicted once either is exceeded.
+
+    Args:
+        tolerances: quantization step, either a scalar or a sequence with one value per parameter.
+        max_entries: maximum number of cached results.
+        max_bytes: approximate cap on the memory held by cached result arrays.
+    """
+
+    def __init__(self, tolerances=1e-10, max_entries=100000, max_bytes=256 * 2 ** 20):
+        self.tolerances = tolerances
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._store = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, params, extra=None):
+        quantized = np.round(np.asarray(params, dtype=float) / np.asarray(self.tolerances, dtype=float))
+        return (tuple(quantized.astype(np.int64)), extra)
+
+    def get(self, params, extra=None):
+        key = self.key(params, extra)
+        try:
+            results = self._store[key]
+        except KeyError:
+            self.misses += 1
+            profiling.count('cache_misses')
+            return (None)
+
+        self._store.move_to_end(key)
+        self.hits += 1
+        profiling.count('cache_hits')
+
+        return (_copy_results(results))
+
+    def put(self, params, results, extra=None):
+        key = self.key(params, extra)
+        stored = _copy_results(results)
+
+        if key in self._store:
+            self.nbytes -= _results_nbytes(self._store.pop(key))
+
+        self._store[key] = stored
+        self.nbytes += _results_nbytes(stored)
+
+        while self._store and ((len(self._store) > self.max_entries) or (self.nbytes > self.max_bytes)):
+            _, evicted = self._store.popitem(last=False)
+            self.nbytes -= _results_nbytes(evicted)
+            self.evictions += 1
+            profiling.count('cache_evictions')
+
+    def cached_call(self, fn, params, extra=None):
+        """Returns fn(params) from the cache, running and storing it on a miss"""
+
+        results = self.get(params, extra)
+        if results is None:
+            results = fn(params)
+            self.put(params, results, extra)
+
+        return (results)
+
+    def clear(self):
+        self._store.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return ({'entries': len(self._store),
+                 'nbytes': self.nbytes,
+                 'hits': self.hits,
+                 'misses': self.misses,
+                 'evictions': self.evictions,
+                 'hit_rate': self.hits / lookups if lookups else 0.0})
+
+    def __len__(self):
+        return (len(self._store))
+
+
+def _copy_results(results):
+    # ModelResult (or anything else with its own copy of one array) or a dictionary of per-channel arrays
+    if hasattr(results, 'sigma'):
+        return (results.copy())
+
+    return ({k: np.array(v, dtype=float) for k, v in results.items()})
+
+
+def _results_nbytes(results):
+    if hasattr(results, 'nbytes'):
+        return (results.nbytes)
+
+    return (sum(v.nbytes for v in results.values()))
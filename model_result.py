@@ -0,0 +1,69 @@
+import numpy as np
+
+
+class ModelResult(object):
+    """Compact forward-model result: one contiguous (channel, angle) float array plus channel metadata
+
+    Reads like the old results dictionary (keys(), items(), result['Ka_HV'] gives that channel's row), so cost_fn,
+    plot_mod_and_obs and plot_result take it unchanged, but it holds a single array instead of one per channel. A
+    result can be a view into one row of a batch array, so batches are split without copying; stacking results back
+    into a batch copies each of them once.
+
+    Args:
+        sigma: (channel, angle) backscatter in dB.
+        channels: channel names for the first axis.
+        angles: incidence angles for the second axis.
+    """
+
+    __slots__ = ('sigma', 'channels', 'angles')
+
+    def __init__(self, sigma, channels, angles):
+        self.sigma = sigma
+        self.channels = channels
+        self.angles = angles
+
+    def __getitem__(self, channel):
+        return (self.sigma[self.channels.index(channel)])
+
+    def __contains__(self, channel):
+        return (channel in self.channels)
+
+    def __iter__(self):
+        return (iter(self.channels))
+
+    def __len__(self):
+        return (len(self.channels))
+
+    def keys(self):
+        return (list(self.channels))
+
+    def values(self):
+        return (list(self.sigma))
+
+    def items(self):
+        return (list(zip(self.channels, self.sigma)))
+
+    def copy(self):
+        return (ModelResult(self.sigma.copy(), self.channels, self.angles))
+
+    def to_dict(self):
+        return ({channel: np.array(row) for channel, row in zip(self.channels, self.sigma)})
+
+    @property
+    def nbytes(self):
+        return (self.sigma.nbytes)
+
+    @staticmethod
+    def stack(results, out=None):
+        """Stacks results into an (N, channel, angle) array, or into `out` to reuse a preallocated buffer"""
+
+        return (np.stack([result.sigma for result in results], out=out))
+
+    @classmethod
+    def from_batch(cls, sigma_batch, channels, angles):
+        """Splits an (N, channel, angle) array into N results that are views of its rows"""
+
+        return ([cls(sigma, channels, angles) for sigma in sigma_batch])
+
+    def __repr__(self):
+        return (f'ModelResult({dict(self.items())})')
@@ -0,0 +1,177 @@
+import datetime
+from multiprocessing import Manager, Pool
+import numpy as np
+from scipy.optimize import basinhopping
+from inverter_classes import BoundedTakeStep, MyBounds
+import inverter_tools
+from inverter_tools import calculate_cost, get_initial_bounds
+from lookup_table import sample_parameter_space
+import profiling
+
+
+def get_start_points(n_chains, initial_guess=None, bounds=None, seed=0):
+    """Returns n_chains diverse starting points: the initial guess(es) (if given) followed by a Latin hypercube sample"""
+
+    if bounds is None:
+        bounds = get_initial_bounds()
+
+    starts = sample_parameter_space(n_chains, bounds=bounds, method='lhs', seed=seed)
+    if initial_guess is not None:
+        guesses = np.atleast_2d(initial_guess)[:n_chains]
+        starts[:len(guesses)] = guesses
+
+    return (starts)
+
+
+def run_chain(task):
+    """Runs one basinhopping chain, reporting each minimum to the shared best. Executed in a pool worker."""
+
+    profiling.start_task(task['profile'])
+
+    chain_no = task['chain_no']
+    shared, lock = task['shared'], task['lock']
+    bounds = task['bounds']
+    patience = task['patience']
+
+    # Every chain needs its own random stream, the step-taker draws from the global one
+    np.random.seed(task['seed'])
+
+    space = task['space']
+
+    records = []
+    state = {'best': np.inf, 'stale': 0}
+
+    def share_minimum(x, f, accepted):
+        # Records, logs and the shared best hold the full parameter vector
+        if space is not None:
+            x = space.to_full(x)
+
+        # A surrogate's cost is replaced by the true one before anything sees it
+        if task['verify'] is not None:
+            f = task['verify'](x, task['obs_dict'])
+
+        records.append((np.array(x), f, datetime.datetime.now()))
+        if task['minima_log'] is not None:
+            task['minima_log'].append(x, f, accepted=accepted, n_evals=inverter_tools.forward_runs, chain=chain_no)
+
+        with lock:
+            if f < shared['best_cost']:
+                shared['best_cost'] = f
+                shared['best_params'] = np.array(x)
+                shared['best_chain'] = chain_no
+            global_best = shared['best_cost']
+
+        if f < state['best']:
+            state['best'], state['stale'] = f, 0
+        else:
+            state['stale'] += 1
+
+        # A chain that has stopped improving and trails another chain's minimum gives its core back
+        if (patience is not None) and (state['stale'] >= patience) and (state['best'] > global_best):
+            print(f'chain {chain_no} stopping: no improvement in {patience} hops')
+            return (True)
+
+    take_step = BoundedTakeStep(bounds)
+
+    fit = basinhopping(task['func'],
+                       x0=task['x0'],
+                       stepsize=1,
+                       T=task['T'],
+                       niter=task['niter'],
+                       minimizer_kwargs={
+                           'method': task['method'],
+                           'args': (task['obs_dict'],),
+                           'bounds': bounds,
+                           'jac': task['jac'],
+                       },
+                       take_step=take_step,
+                       accept_test=MyBounds(bounds),
+                       callback=share_minimum,
+                       seed=task['seed'],
+                       )
+
+    x = fit.x if space is None else space.to_full(fit.x)
+    fun = fit.fun if task['verify'] is None else task['verify'](x, task['obs_dict'])
+
+    return (chain_no, x, fun, records, take_step.acceptance_stats(), profiling.collect())
+
+
+def run_multistart(obs_dict,
+                   n_chains,
+                   niter,
+                   initial_guess=None,
+                   processes=None,
+                   func=calculate_cost,
+                   method='SLSQP',
+                   T=5,
+                   seed=0,
+                   patience=None,
+                   jac=False,
+                   minima_log=None,
+                   space=None,
+                   verify=None):
+    """Runs n_chains basinhopping chains concurrently on a process pool within one node
+
+    Chains start from diverse points (see get_start_points) and publish every minimum they find to a shared
+    global best. With `patience` set, a chain that has gone that many hops without improving and is behind the
+    global best stops early. Pass jac=True when func returns (cost, gradient), e.g. a FiniteDifferenceJacobian.
+    If a MinimaLog is given, every chain appends its minima to it (tagged with the chain number) as it goes.
+    With a ParameterSpace, func works on its free vector (e.g. space.wrap(calculate_cost)); initial_guess and
+    everything returned stay full vectors. initial_guess may hold several vectors (e.g. signature index matches),
+    which start the first chains. When func is a surrogate (e.g. an EmulatorCost), pass verify(full params,
+    obs_dict) returning the true cost (e.g. EmulatorCost.verify): every minimum is re-scored with it before it is
+    recorded, logged or shared.
+
+    Returns:
+        A dictionary with the merged minima of all chains (list of (params, cost, datetime), in time order), the
+        global best params and cost, the chain that found it and each chain's final result.
+    """
+
+    if space is None:
+        bounds = get_initial_bounds()
+    else:
+        bounds = space.free_bounds
+        initial_guess = None if initial_guess is None else [space.to_free(g) for g in np.atleast_2d(initial_guess)]
+
+    starts = get_start_points(n_chains, initial_guess, bounds, seed)
+
+    with Manager() as manager:
+        shared = manager.dict(best_cost=np.inf, best_params=None, best_chain=None)
+        lock = manager.Lock()
+
+        tasks = [{'chain_no': i,
+                  'x0': starts[i],
+                  'seed': seed + i,
+                  'niter': niter,
+                  'T': T,
+                  'method': method,
+                  'func': func,
+                  'obs_dict': obs_dict,
+                  'bounds': bounds,
+                  'patience': patience,
+                  'jac': jac,
+                  'minima_log': minima_log,
+                  'space': space,
+                  'verify': verify,
+                  'profile': profiling.enabled,
+                  'shared': shared,
+                  'lock': lock} for i in range(n_chains)]
+
+        with Pool(processes or n_chains) as pool:
+            chain_results = pool.map(run_chain, tasks)
+
+        # The chains' cost evaluations ran in the workers, so their timings and counters are gathered here
+        for result in chain_results:
+            profiling.absorb(result[-1])
+        chain_results = [result[:-1] for result in chain_results]
+
+        best = dict(shared)
+
+    minima = sorted([record for _, _, _, records, _ in chain_results for record in records], key=lambda r: r[2])
+
+    return ({'minima': minima,
+             'best_params': best['best_params'],
+             'best_cost': best['best_cost'],
+             'best_chain': best['best_chain'],
+             'chains': [{'chain_no': chain_no, 'x': x, 'fun': fun, 'n_minima': len(records), 'acceptance': acceptance}
+                        for chain_no, x, fun, records, acceptance in chain_results]})
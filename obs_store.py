@@ -0,0 +1,145 @@
+import json
+import os
+import itertools
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+bands = ['Ka', 'Ku']
+pols = ['VV', 'HH', 'HV']
+
+
+def source_file(path_to_obs, band, site_number):
+    return (f'{path_to_obs}/{band}_RS{site_number} Site.xlsx')
+
+
+def read_sheet(path_to_obs, site_number, band, pol, resampler='3H'):
+    """Parses one Excel sheet and resamples it (the slow path the cache exists to avoid)"""
+
+    df = pd.read_excel(source_file(path_to_obs, band, site_number),
+                       index_col='Unnamed: 0',
+                       sheet_name=pol,
+                       parse_dates=True)
+
+    return (df.resample(resampler).mean())
+
+
+def site_cache_dir(cache_dir, site_number, resampler):
+    return (f'{cache_dir}/RS{site_number}_{resampler}')
+
+
+def build_site_cache(path_to_obs, site_number, resampler='3H', cache_dir=None):
+    """Converts the six sheets (2 bands x 3 pols) of one site into .npy arrays
+
+    Each sheet becomes a times array (int64 ns), a columns array (incidence angles) and a values array
+    (time x angle). A manifest records the source file modification times and the resampler the arrays were made
+    with, which is what is_cache_valid checks.
+    """
+
+    if cache_dir is None:
+        cache_dir = f'{path_to_obs}/cache'
+
+    out_dir = site_cache_dir(cache_dir, site_number, resampler)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Array tasks can all find the cache missing at once: each builds in its own directory and renames it into
+    # place, so a reader never sees a half-written cache (the manifest is written last)
+    build_dir = tempfile.mkdtemp(prefix=f'{os.path.basename(out_dir)}.', dir=cache_dir)
+
+    for band, pol in itertools.product(bands, pols):
+        df = read_sheet(path_to_obs, site_number, band, pol, resampler)
+        key = f'{band}_{pol}'
+
+        columns = np.asarray(df.columns)
+        if columns.dtype == object:
+            columns = columns.astype(str)
+
+        np.save(f'{build_dir}/{key}_times.npy', df.index.values.astype('datetime64[ns]').astype(np.int64))
+        np.save(f'{build_dir}/{key}_columns.npy', columns)
+        np.save(f'{build_dir}/{key}_values.npy', df.values.astype(np.float64))
+
+    manifest = {'resampler': resampler,
+                'mtimes': {band: os.path.getmtime(source_file(path_to_obs, band, site_number)) for band in bands}}
+    json.dump(manifest, open(f'{build_dir}/manifest.json', 'w'))
+
+    try:
+        os.replace(build_dir, out_dir)
+    except OSError:
+        # out_dir is already there: a stale cache, or another task's build that finished first
+        if is_cache_valid(path_to_obs, site_number, resampler, cache_dir):
+            shutil.rmtree(build_dir, ignore_errors=True)
+            return
+
+        stale_dir = f'{build_dir}.stale'
+        os.replace(out_dir, stale_dir)
+        os.replace(build_dir, out_dir)
+        shutil.rmtree(stale_dir, ignore_errors=True)
+
+
+def is_cache_valid(path_to_obs, site_number, resampler='3H', cache_dir=None):
+    if cache_dir is None:
+        cache_dir = f'{path_to_obs}/cache'
+
+    manifest_file = f'{site_cache_dir(cache_dir, site_number, resampler)}/manifest.json'
+    if not os.path.exists(manifest_file):
+        return (False)
+
+    manifest = json.load(open(manifest_file))
+    if manifest['resampler'] != resampler:
+        return (False)
+
+    for band in bands:
+        if manifest['mtimes'].get(band) != os.path.getmtime(source_file(path_to_obs, band, site_number)):
+            return (False)
+
+    return (True)
+
+
+def load_site(path_to_obs, site_number, resampler='3H', start_date=None, end_date=None, interpolate=False,
+              cache_dir=None):
+    """Returns the resampled signatures of one site, building the cache first if it is missing or stale
+
+    Arrays are memory-mapped and only the rows between start_date and end_date (inclusive) are copied out.
+
+    Returns:
+        (signatures, start_dates, end_dates), keyed like prep_obs ('{band}_{pol}_RS{site_number}'). The start and
+        end dates are those of the full cached series, not of the window.
+    """
+
+    if cache_dir is None:
+        cache_dir = f'{path_to_obs}/cache'
+
+    if not is_cache_valid(path_to_obs, site_number, resampler, cache_dir):
+        build_site_cache(path_to_obs, site_number, resampler, cache_dir)
+
+    in_dir = site_cache_dir(cache_dir, site_number, resampler)
+    signatures, start_dates, end_dates = {}, {}, {}
+
+    for band, pol in itertools.product(bands, pols):
+        key = f'{band}_{pol}'
+        times = np.load(f'{in_dir}/{key}_times.npy', mmap_mode='r')
+        values = np.load(f'{in_dir}/{key}_values.npy', mmap_mode='r')
+        columns = np.load(f'{in_dir}/{key}_columns.npy')
+
+        # Interpolation has to see the whole series to match the uncached result at the window edges
+        first, last = 0, len(times)
+        if not interpolate:
+            if start_date is not None:
+                first = np.searchsorted(times, pd.Timestamp(start_date).value, side='left')
+            if end_date is not None:
+                last = np.searchsorted(times, pd.Timestamp(end_date).value, side='right')
+
+        df = pd.DataFrame(np.array(values[first:last]),
+                          index=pd.DatetimeIndex(np.array(times[first:last]).astype('datetime64[ns]')),
+                          columns=columns)
+
+        if interpolate:
+            df = df.interpolate(method='linear').loc[start_date:end_date]
+
+        full_key = f'{key}_RS{site_number}'
+        signatures[full_key] = df
+        start_dates[full_key] = pd.Timestamp(int(times[0]))
+        end_dates[full_key] = pd.Timestamp(int(times[-1]))
+
+    return (signatures, start_dates, end_dates)
@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+import inverter_tools
+
+
+class ObservationCube(object):
+    """Dense time x channel x angle array of observed backscatter (dB) with a NaN mask
+
+    Channels follow inverter_tools.channels, so a model output from results_to_array or run_model_batch lines up
+    with a timestep slice directly. Costs are the same as cost_fn (sum over channels of the mean squared error over
+    angles, with 1000 for anything NaN) but computed for many timesteps or many model outputs in one operation.
+
+    Args:
+        data: (T, channel, angle) array.
+        times: length-T sequence of timestamps.
+        channels: channel names for the second axis.
+        angles: incidence angles for the third axis.
+    """
+
+    def __init__(self, data, times, channels=None, angles=None):
+        self.data = np.asarray(data, dtype=float)
+        self.times = pd.DatetimeIndex(times)
+        self.channels = list(inverter_tools.channels if channels is None else channels)
+        self.angles = np.asarray(inverter_tools.default_angles if angles is None else angles)
+
+    @classmethod
+    def from_signatures(cls, signatures, site_no, start_date=None, end_date=None, channels=None):
+        """Builds a cube from prep_obs signatures (keys like 'Ku_HV_RS2') for one site and window"""
+
+        channels = list(inverter_tools.channels if channels is None else channels)
+        frames = [signatures[f'{channel}_RS{site_no}'].loc[start_date:end_date] for channel in channels]
+
+        times = frames[0].index
+        for frame in frames[1:]:
+            times = times.union(frame.index)
+
+        data = np.stack([frame.reindex(times).values for frame in frames], axis=1)
+
+        return (cls(data, times, channels, np.asarray(frames[0].columns, dtype=float)))
+
+    @classmethod
+    def from_obs_dict(cls, obs_dict, time=None, channels=None):
+        """Wraps a single obs_dict (e.g. from get_obs_dict) as a one-timestep cube"""
+
+        channels = list(inverter_tools.channels if channels is None else channels)
+        data = np.array([[obs_dict[f'{channel}_Mean'] for channel in channels]], dtype=float)
+
+        return (cls(data, [pd.Timestamp(time) if time is not None else pd.NaT], channels))
+
+    def __len__(self):
+        return (self.data.shape[0])
+
+    def __getitem__(self, timestep):
+        return (self.data[timestep])
+
+    def window(self, start, stop):
+        """Cube of timesteps start to stop - 1 (a view of this cube's data)"""
+
+        return (ObservationCube(self.data[start:stop], self.times[start:stop], self.channels, self.angles))
+
+    @property
+    def mask(self):
+        """True where an observation exists"""
+
+        return (~np.isnan(self.data))
+
+    def empty_timesteps(self):
+        """Indices of timesteps with no observation in any channel"""
+
+        return (np.flatnonzero(~self.mask.any(axis=(1, 2))))
+
+    def obs_dict(self, timestep):
+        """Returns one timestep in the dictionary form cost_fn and plot_mod_and_obs take"""
+
+        return ({f'{channel}_Mean': self.data[timestep, c] for c, channel in enumerate(self.channels)})
+
+    def mean(self):
+        """Time-mean signature (as get_obs_dict computes), as a (channel, angle) array"""
+
+        with np.errstate(invalid='ignore'):
+            return (np.nanmean(self.data, axis=0))
+
+    def cost(self, sigma, timestep=None):
+        """Vectorized cost_fn
+
+        With a single (channel, angle) model output, scores it against every timestep and returns a (T,) array.
+        With an (N, channel, angle) batch and a timestep, scores the batch against that timestep and returns (N,).
+        """
+
+        sigma = np.asarray(sigma, dtype=float)
+
+        if timestep is not None:
+            return (inverter_tools.batch_cost(sigma, self.data[timestep]))
+
+        return (inverter_tools.batch_cost(self.data, sigma))
+
+    def cost_matrix(self, sigma):
+        """Scores an (N, channel, angle) batch against all timesteps at once and returns an (N, T) array"""
+
+        sigma = np.asarray(sigma, dtype=float)
+
+        return (inverter_tools.batch_cost(sigma[:, None], self.data[None]))
@@ -0,0 +1,267 @@
+""" Online track mode: fits each new resample bin as KuKa scans arrive
+
+Usage:
+    python online_track.py <state_dir> <watch_dir> [--site=2] [--resampler=3H] [--interval=60] [--once] [--flush]
+        [--start_track=<.track log>] [--minima=<search-mode minima logs>] [--jac=forward|off]
+        [--fix=name:value,...] [--log=name,...]
+
+New scans are CSV records with columns time, band, pol and one column per incidence angle (named like the Excel
+sheets), appended to any *.csv file in watch_dir. Each poll reads only the bytes added since the last one and
+adds the records to running per-angle sums for the newest resample bin. A bin is fitted once, with one local
+minimization warm-started from the last fitted state, when the first record of a later bin closes it; --flush also
+fits the open bin after every poll that changed it, and --once fits it before exiting. Nothing is re-read or
+re-resampled, and the state (read offsets, the open bin and, through the track log, the last fit) persists in
+state_dir, so a restarted tracker carries on where it stopped. Fits go to {state_dir}/online.track, one record per
+fit; read_track keeps the last fit of each bin.
+"""
+
+import glob
+import io
+import json
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+from scipy.optimize import minimize
+import inverter_tools
+import profiling
+from inverter_classes import FiniteDifferenceJacobian
+from minima_log import best_minimum
+from track_log import TrackLog, last_state
+from track_mode import track_space
+
+
+def read_appended(path, offset=0, header=None):
+    """Reads the complete CSV lines added to path since byte `offset`
+
+    Returns:
+        (records, new offset, header): a DataFrame of the new records (None if there are none), the offset to read
+        from next time and the file's header line (read from the file when header is None).
+    """
+
+    if os.path.getsize(path) < offset:
+        # Truncated or replaced: start again from the top
+        offset, header = 0, None
+
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+
+    # A line still being written is left for the next poll
+    end = data.rfind(b'\n') + 1
+    data = data[:end]
+
+    if header is None:
+        if not end:
+            return (None, offset, header)
+        header_end = data.find(b'\n') + 1
+        header, data = data[:header_end].decode(), data[header_end:]
+
+    if not data:
+        return (None, offset + end, header)
+
+    records = pd.read_csv(io.StringIO(header + data.decode()), parse_dates=['time'])
+
+    return (records, offset + end, header)
+
+
+class OnlineTracker(object):
+    """Incremental track mode state: open resample bin, file offsets and last fitted parameters
+
+    Args:
+        state_dir: directory holding the state file and the track log.
+        site_no: KuKa site the records come from (recorded in the state).
+        space: ParameterSpace to fit in, defaults to track_mode.track_space().
+        cost_function: function of the free vector and an obs_dict; defaults to the wrapped calculate_cost.
+        jac: True if cost_function also returns the gradient.
+        resampler: resample bin width, as given to prep_obs.
+    """
+
+    def __init__(self, state_dir, site_no=2, space=None, cost_function=None, local_method='L-BFGS-B', jac=False,
+                 resampler='3H'):
+        os.makedirs(state_dir, exist_ok=True)
+        self.state_path = f'{state_dir}/online_state.json'
+        self.track_path = f'{state_dir}/online.track'
+
+        self.space = track_space() if space is None else space
+        self.cost_function = self.space.wrap(inverter_tools.calculate_cost) if cost_function is None \
+            else cost_function
+        self.local_method = local_method
+        self.jac = jac
+        self.bin_width = pd.Timedelta(resampler)
+
+        self.state = {'site': site_no, 'resampler': resampler, 'origin': None, 'bin': None, 'pending': False,
+                      'offsets': {}, 'headers': {}, 'late_records': 0}
+        self.sums = np.zeros((len(inverter_tools.channels), len(inverter_tools.default_angles)))
+        self.counts = np.zeros_like(self.sums)
+
+        if os.path.exists(self.state_path):
+            self._load()
+
+        _, self.x, _ = last_state(self.track_path)
+
+    def _load(self):
+        state = json.load(open(self.state_path))
+        if (state['site'], state['resampler']) != (self.state['site'], self.state['resampler']):
+            raise ValueError(f'{self.state_path} belongs to site {state["site"]} at {state["resampler"]}')
+
+        self.sums = np.array(state.pop('sums'))
+        self.counts = np.array(state.pop('counts'))
+        self.state = state
+
+    def save(self):
+        state = dict(self.state, sums=self.sums.tolist(), counts=self.counts.tolist())
+
+        # Written aside and renamed so that a crash never leaves a half-written state
+        json.dump(state, open(f'{self.state_path}.tmp', 'w'))
+        os.replace(f'{self.state_path}.tmp', self.state_path)
+
+    def start_from(self, x0):
+        """Sets the state to warm-start from if nothing has been fitted yet"""
+
+        if self.x is None:
+            self.x = np.asarray(x0, dtype=float)
+
+    def ingest(self, records):
+        """Adds new scan records to the open bin
+
+        Records for a later bin close the open one (fitting it first if it changed since its last fit). Records for
+        bins that are already closed are counted in state['late_records'] and otherwise ignored.
+        """
+
+        angle_columns = {float(c): c for c in records.columns if c not in ('time', 'band', 'pol')}
+        columns = [angle_columns.get(float(a)) for a in inverter_tools.default_angles]
+
+        for record in records.to_dict('records'):
+            channel = f"{record['band']}_{record['pol']}"
+            if channel not in inverter_tools.channels:
+                continue
+
+            record_bin = pd.Timestamp(record['time']).floor(self.bin_width)
+            open_bin = pd.Timestamp(self.state['bin']) if self.state['bin'] is not None else None
+
+            if (open_bin is not None) and (record_bin < open_bin):
+                self.state['late_records'] += 1
+                continue
+
+            if (open_bin is None) or (record_bin > open_bin):
+                if self.state['pending']:
+                    self.fit()
+                self.state['bin'] = record_bin.isoformat()
+                if self.state['origin'] is None:
+                    self.state['origin'] = record_bin.isoformat()
+                self.sums[:], self.counts[:] = 0, 0
+
+            values = np.array([record[c] if c is not None else np.nan for c in columns], dtype=float)
+            observed = ~np.isnan(values)
+            c = inverter_tools.channels.index(channel)
+            self.sums[c, observed] += values[observed]
+            self.counts[c, observed] += 1
+            self.state['pending'] = True
+
+    def obs_dict(self):
+        """The open bin's mean signature (as resample().mean() gives it)"""
+
+        with np.errstate(invalid='ignore'):
+            mean = np.where(self.counts > 0, self.sums / np.maximum(self.counts, 1), np.nan)
+
+        return ({f'{channel}_Mean': mean[c] for c, channel in enumerate(inverter_tools.channels)})
+
+    def fit(self):
+        """One warm-started local fit of the open bin, appended to the track log"""
+
+        if self.x is None:
+            raise ValueError('No state to warm-start from: call start_from() first')
+
+        bin_time = pd.Timestamp(self.state['bin'])
+        timestep = int((bin_time - pd.Timestamp(self.state['origin'])) / self.bin_width)
+        obs_dict = self.obs_dict()
+
+        with TrackLog(self.track_path, n_params=len(self.space)) as log:
+            if np.isnan(inverter_tools.obs_dict_to_array(obs_dict)).all():
+                log.append(timestep, bin_time, self.x, np.nan, skipped=True, n_evals=inverter_tools.forward_runs)
+            else:
+                fit = minimize(self.cost_function,
+                               self.space.to_free(self.x),
+                               args=(obs_dict,),
+                               bounds=self.space.free_bounds,
+                               jac=self.jac,
+                               method=self.local_method)
+
+                self.x = self.space.to_full(fit.x)
+                log.append(timestep, bin_time, self.x, fit.fun, nfev=fit.nfev, n_evals=inverter_tools.forward_runs)
+                print(f'{bin_time}: cost {fit.fun} after {fit.nfev} cost evaluations')
+
+        self.state['pending'] = False
+        profiling.maybe_report()
+
+    def poll(self, directory, pattern='*.csv', flush=False):
+        """Ingests whatever was appended to the watched files since the last poll
+
+        Bins closed by the new records are fitted as they close; with flush the open bin is fitted too, if it changed.
+
+        Returns:
+            The number of new records.
+        """
+
+        n_records = 0
+
+        for path in sorted(glob.glob(f'{directory}/{pattern}')):
+            name = os.path.basename(path)
+            records, offset, header = read_appended(path, self.state['offsets'].get(name, 0),
+                                                    self.state['headers'].get(name))
+            self.state['offsets'][name], self.state['headers'][name] = offset, header
+
+            if records is not None:
+                self.ingest(records)
+                n_records += len(records)
+
+        if flush and self.state['pending']:
+            self.fit()
+
+        self.save()
+
+        return (n_records)
+
+    def watch(self, directory, interval=60, pattern='*.csv', once=False, flush=False):
+        while True:
+            n_records = self.poll(directory, pattern, flush=flush or once)
+            if n_records:
+                print(f'{n_records} new records, open bin {self.state["bin"]}', flush=True)
+
+            if once:
+                return
+
+            time.sleep(interval)
+
+
+if __name__ == '__main__':
+    positional, options = inverter_tools.parse_options(sys.argv)
+
+    space = track_space(options)
+
+    if options.get('jac', 'forward') != 'off':
+        cost_function, jac = FiniteDifferenceJacobian(space.free_bounds, space=space), True
+    else:
+        cost_function, jac = space.wrap(inverter_tools.calculate_cost), False
+
+    tracker = OnlineTracker(positional[0],
+                            site_no=int(options.get('site', 2)),
+                            space=space,
+                            cost_function=cost_function,
+                            jac=jac,
+                            resampler=options.get('resampler', '3H'))
+
+    # Carry on from the last state of a batch track, if it has one
+    x0 = last_state(options['start_track'])[1] if 'start_track' in options else None
+    if ('start_track' in options) and (x0 is None):
+        print(f"{options['start_track']} has no fitted timestep; starting from the best search-mode minimum")
+
+    if x0 is not None:
+        tracker.start_from(x0)
+    elif tracker.x is None:
+        tracker.start_from(best_minimum(options.get('minima', 'output/first_run_*.minima'))[0])
+
+    tracker.watch(positional[1], interval=float(options.get('interval', 60)), once='--once' in sys.argv,
+                  flush='--flush' in sys.argv)
@@ -0,0 +1,186 @@
+import numpy as np
+
+
+class Parameter(object):
+    """One geophysical input to the forward model
+
+    Args:
+        name: keyword of run_model it feeds.
+        bounds: (low, high) in physical units.
+        default: starting value used when no other guess is given.
+        transform: 'linear', or 'log' to let the minimizers work in log space (for scale-like parameters).
+        fixed: if not None, the parameter is held at this value and hidden from the minimizers.
+    """
+
+    def __init__(self, name, bounds, default, transform='linear', fixed=None):
+        if transform not in ('linear', 'log'):
+            raise ValueError(f'Unknown transform {transform} for {name}')
+        if (transform == 'log') and (bounds[0] <= 0):
+            raise ValueError(f'{name} needs positive bounds to be log-scaled')
+
+        self.name = name
+        self.bounds = tuple(bounds)
+        self.default = default
+        self.transform = transform
+        self.fixed = fixed
+
+    def forward(self, value):
+        """Physical value -> minimizer coordinate"""
+
+        return (np.log(value) if self.transform == 'log' else value)
+
+    def inverse(self, value):
+        """Minimizer coordinate -> physical value"""
+
+        return (np.exp(value) if self.transform == 'log' else value)
+
+    def copy(self, **changes):
+        attributes = {'name': self.name, 'bounds': self.bounds, 'default': self.default,
+                      'transform': self.transform, 'fixed': self.fixed}
+        attributes.update(changes)
+
+        return (Parameter(**attributes))
+
+
+class ParameterSpace(object):
+    """Declarative description of the inversion's parameter vector
+
+    The full vector (all parameters, physical units, in declaration order) is what run_from_params and the logs
+    use. The minimizers see the free vector: fixed parameters removed and transforms applied. to_free/to_full
+    convert between the two, and wrap() turns a function of the full vector into one of the free vector.
+    """
+
+    def __init__(self, parameters):
+        self.parameters = list(parameters)
+
+    @property
+    def names(self):
+        return ([p.name for p in self.parameters])
+
+    @property
+    def free_parameters(self):
+        return ([p for p in self.parameters if p.fixed is None])
+
+    @property
+    def free_names(self):
+        return ([p.name for p in self.free_parameters])
+
+    @property
+    def n_free(self):
+        return (len(self.free_parameters))
+
+    def __len__(self):
+        return (len(self.parameters))
+
+    @property
+    def bounds(self):
+        """Physical bounds of the full vector"""
+
+        return ([p.bounds for p in self.parameters])
+
+    @property
+    def free_bounds(self):
+        """Bounds of the free vector, in minimizer coordinates"""
+
+        return ([(p.forward(p.bounds[0]), p.forward(p.bounds[1])) for p in self.free_parameters])
+
+    @property
+    def default(self):
+        """Full vector of defaults (fixed parameters at their fixed values)"""
+
+        return (np.array([p.default if p.fixed is None else p.fixed for p in self.parameters], dtype=float))
+
+    def to_free(self, full):
+        full = np.asarray(full, dtype=float)
+        return (np.array([p.forward(v) for p, v in zip(self.parameters, full) if p.fixed is None]))
+
+    def to_full(self, free):
+        free = iter(np.asarray(free, dtype=float))
+        return (np.array([p.inverse(next(free)) if p.fixed is None else p.fixed for p in self.parameters]))
+
+    def as_dict(self, full):
+        return (dict(zip(self.names, np.asarray(full, dtype=float))))
+
+    def _replace(self, changes):
+        unknown = set(changes) - set(self.names)
+        if unknown:
+            raise KeyError(f'Unknown parameters: {sorted(unknown)}')
+
+        return (ParameterSpace([p.copy(**changes[p.name]) if p.name in changes else p for p in self.parameters]))
+
+    def fix(self, **values):
+        """Returns a copy with the given parameters held at fixed values"""
+
+        return (self._replace({name: {'fixed': float(value)} for name, value in values.items()}))
+
+    def free(self, *names):
+        """Returns a copy with the given parameters released again"""
+
+        return (self._replace({name: {'fixed': None} for name in names}))
+
+    def with_bounds(self, **bounds):
+        return (self._replace({name: {'bounds': tuple(b)} for name, b in bounds.items()}))
+
+    def with_transform(self, transform, *names):
+        return (self._replace({name: {'transform': transform} for name in names}))
+
+    def wrap(self, func):
+        """Returns func as a (picklable) function of the free vector"""
+
+        return (FreeParameterFunction(func, self))
+
+    def __repr__(self):
+        lines = [f'{p.name:<20} {str(p.bounds):<16} {p.transform:<7}' + (f'fixed at {p.fixed}' if p.fixed is not None
+                                                                          else '')
+                 for p in self.parameters]
+        return ('\n'.join(lines))
+
+
+class FreeParameterFunction(object):
+    """func(full_vector, *args) seen as a function of the free vector"""
+
+    def __init__(self, func, space):
+        self.func = func
+        self.space = space
+
+    def __call__(self, x, *args):
+        return (self.func(self.space.to_full(x), *args))
+
+
+def default_space():
+    """The twelve-dimensional space used throughout (the order run_from_params and the logs use)"""
+
+    return (ParameterSpace([Parameter('snow_depth', (0.08, 0.6), 0.25),
+                            Parameter('ice_thickness', (0.6, 2.5), 0.7),
+                            Parameter('ice_salinity', (0.05, 3), 0.5),
+                            Parameter('ice_density', (790, 920), 830),
+                            Parameter('temp', (255, 270), 260),
+                            Parameter('snow_CL_e3', (0.1, 0.4), 0.3),
+                            Parameter('ice_CL_e3', (0.1, 1), 0.34),
+                            Parameter('snow_density', (250, 400), 350),
+                            # Parameter('snow_sal', (0, 1), 0),
+                            Parameter('snow_roughness_rms', (0.3, 1.5), 0.5),
+                            Parameter('snow_roughness_CL', (8, 120), 20),
+                            Parameter('ice_roughness_rms', (0.1, 2.3), 2.1),
+                            Parameter('ice_roughness_CL', (10, 150), 120)]))
+
+
+def parse_space_options(options, space=None):
+    """Applies command-line style options to a space
+
+    Args:
+        options: dictionary that may hold 'fix' ('name:value,name:value') and 'log' ('name,name').
+        space: the space to start from, defaults to default_space().
+    """
+
+    if space is None:
+        space = default_space()
+
+    if options.get('fix'):
+        space = space.fix(**{name: float(value) for name, value in
+                             (item.split(':') for item in options['fix'].split(','))})
+
+    if options.get('log'):
+        space = space.with_transform('log', *options['log'].split(','))
+
+    return (space)
@@ -0,0 +1,328 @@
+""" Posterior sampling: affine-invariant ensemble MCMC over the parameter space
+
+Usage:
+    python posterior.py <path> <n_steps> [-hpc] [--walkers=32] [--processes=n] [--burn=0.5] [--seed=0]
+        [--start=<search-mode minima logs>] [--fix=name:value,...] [--log=name,...]
+        [--emulator=<n_train> | --lut=<lookup table> [--lut_points=500]]
+
+Treats the cost as a Gaussian misfit, with the per-angle noise of every channel taken from the *_SD columns of
+the site's own sheet (RS{site} Site) of Legs1and2_Time_series_average.xlsx, under a uniform prior on the space's
+box (in its free coordinates, so log-scaled parameters get a log-uniform prior). The chains are checkpointed to
+`path` after every step and resume from there (see run_sampler); the report gives the posterior mean, standard
+deviation and 5-95% range of every parameter and the effective samples per second.
+"""
+
+import json
+import os
+import sys
+import time
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+import inverter_tools
+from emulator import RBFEmulator, train_emulator
+from lookup_table import LookupTable
+from minima_log import best_minimum
+from parameter_space import parse_space_options
+
+
+def load_noise(path_to_obs, site_no, channels=None):
+    """Observation standard deviations (dB) at one site as a (channel, angle) array, from the *_SD columns of the
+    RS{site_no} Site sheet of Legs1and2_Time_series_average.xlsx"""
+
+    channels = inverter_tools.channels if channels is None else channels
+    df = pd.read_excel(f'{path_to_obs}/Legs1and2_Time_series_average.xlsx',
+                       sheet_name=f'RS{site_no} Site').set_index('IA')
+    df = df.reindex(inverter_tools.default_angles)
+
+    return (np.array([df[f'{channel}_SD'].values for channel in channels], dtype=float))
+
+
+def log_likelihood(sigma, obs, noise):
+    """Gaussian log likelihood (up to a constant) of an (..., channel, angle) model output, skipping NaN observations
+
+    A model output with any NaN (a failed run) gets -inf.
+    """
+
+    sigma = np.asarray(sigma, dtype=float)
+    observed = ~np.isnan(obs)
+    z2 = np.where(observed, ((sigma - np.where(observed, obs, 0)) / noise) ** 2, 0)
+    log_l = -0.5 * np.sum(z2, axis=(-2, -1))
+
+    return (np.where(np.isnan(sigma).any(axis=(-2, -1)), -np.inf, log_l))
+
+
+class PooledForward(object):
+    """Forward model for batches of full parameter vectors, spread over a persistent process pool"""
+
+    def __init__(self, processes=None):
+        self.processes = processes or os.cpu_count()
+        self.pool = Pool(self.processes)
+
+    def __call__(self, params):
+        params = np.atleast_2d(params)
+        chunks = np.array_split(params, min(self.processes, len(params)))
+
+        return (np.concatenate(self.pool.map(inverter_tools.run_model_batch, chunks)))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+class EmulatedForward(object):
+    """Forward model backed by an RBFEmulator (e.g. fitted to the lookup-table entries nearest the observation)"""
+
+    def __init__(self, emulator):
+        self.emulator = emulator
+
+    def __call__(self, params):
+        return (self.emulator.predict(np.atleast_2d(params)))
+
+    def close(self):
+        pass
+
+
+class LogPosterior(object):
+    """Log posterior of free-coordinate points: Gaussian likelihood under a uniform prior on the space's free box
+
+    Points outside the box get -inf without running the forward model; the others are run as one batch.
+    """
+
+    def __init__(self, obs, noise, space, forward):
+        self.obs = inverter_tools.obs_dict_to_array(obs)
+        self.noise = noise
+        self.space = space
+        self.forward = forward
+        self.lows, self.highs = np.array(space.free_bounds, dtype=float).T
+
+    def __call__(self, points):
+        points = np.atleast_2d(points)
+        log_p = np.full(len(points), -np.inf)
+        inside = np.all((points >= self.lows) & (points <= self.highs), axis=1)
+
+        if inside.any():
+            full = np.array([self.space.to_full(p) for p in points[inside]])
+            log_p[inside] = log_likelihood(self.forward(full), self.obs, self.noise)
+
+        return (log_p)
+
+
+def initial_walkers(x0, n_walkers, space, scale=0.01, seed=0):
+    """A small ball of walkers around the full vector x0, in free coordinates and inside the box"""
+
+    rng = np.random.default_rng(seed)
+    lows, highs = np.array(space.free_bounds, dtype=float).T
+    centre = np.clip(space.to_free(x0), lows, highs)
+    walkers = centre + scale * (highs - lows) * rng.standard_normal((n_walkers, len(lows)))
+
+    return (np.clip(walkers, lows, highs))
+
+
+def stretch_move(walkers, log_p, log_prob, rng, a=2.0):
+    """One Goodman & Weare stretch-move step, updating each half of the ensemble against the other
+
+    Each half's proposals are scored in one log_prob call, which is where the pool parallelism comes in.
+
+    Returns:
+        (walkers, log_p, n_accepted)
+    """
+
+    walkers, log_p = walkers.copy(), log_p.copy()
+    n_walkers, ndim = walkers.shape
+    halves = (np.arange(0, n_walkers, 2), np.arange(1, n_walkers, 2))
+    n_accepted = 0
+
+    for active, other in (halves, halves[::-1]):
+        z = ((a - 1) * rng.random(len(active)) + 1) ** 2 / a
+        partners = walkers[rng.choice(other, len(active))]
+        proposals = partners + z[:, None] * (walkers[active] - partners)
+
+        proposal_log_p = log_prob(proposals)
+        with np.errstate(invalid='ignore'):
+            log_accept = (ndim - 1) * np.log(z) + proposal_log_p - log_p[active]
+        accept = np.log(rng.random(len(active))) < log_accept
+
+        walkers[active[accept]] = proposals[accept]
+        log_p[active[accept]] = proposal_log_p[accept]
+        n_accepted += int(np.sum(accept))
+
+    return (walkers, log_p, n_accepted)
+
+
+def run_sampler(path, log_prob, p0, n_steps, a=2.0, seed=0, meta=None):
+    """Runs (or resumes) the ensemble sampler, checkpointing every step to disk
+
+    `path` holds memory-mapped .npy files in the style of run_checkpointed: chain (step, walker, free dim),
+    log_prob (step, walker), accepted and wall (seconds) per step and done (one flag per step). Each step is
+    flushed before it is flagged, and step i draws from a generator seeded with (seed, i), so a resumed run
+    continues exactly as an uninterrupted one would.
+
+    Args:
+        log_prob: function of an (N, ndim) array of free-coordinate points returning (N,) log probabilities.
+        p0: (n_walkers, ndim) starting positions (ignored on resume).
+        meta: extra JSON-serialisable description stored (and checked on resume) in meta.json.
+
+    Returns:
+        (chain, log_prob, done) memory maps.
+    """
+
+    os.makedirs(path, exist_ok=True)
+    meta_file = f'{path}/meta.json'
+    p0 = np.asarray(p0, dtype=float)
+    n_walkers, ndim = p0.shape
+
+    meta = dict(meta or {})
+    meta.update({'n_steps': n_steps, 'n_walkers': n_walkers, 'ndim': ndim, 'a': a, 'seed': seed})
+
+    arrays = {'chain': ((n_steps, n_walkers, ndim), np.float64),
+              'log_prob': ((n_steps, n_walkers), np.float64),
+              'accepted': ((n_steps,), np.int32),
+              'wall': ((n_steps,), np.float64),
+              'done': ((n_steps,), bool)}
+
+    if os.path.exists(meta_file):
+        stored_meta = json.load(open(meta_file))
+        if json.loads(json.dumps(meta)) != stored_meta:
+            raise ValueError(f'{path} holds a different run: {stored_meta}')
+        stored = {name: np.load(f'{path}/{name}.npy', mmap_mode='r+') for name in arrays}
+    else:
+        stored = {}
+        for name, (shape, dtype) in arrays.items():
+            stored[name] = np.lib.format.open_memmap(f'{path}/{name}.npy', mode='w+', dtype=dtype, shape=shape)
+            stored[name][:] = 0
+            stored[name].flush()
+        json.dump(meta, open(meta_file, 'w'), indent=1)
+
+    done = stored['done']
+    first = int(np.sum(done))
+
+    if first:
+        walkers, log_p = np.array(stored['chain'][first - 1]), np.array(stored['log_prob'][first - 1])
+        print(f'resuming at step {first} of {n_steps}')
+    else:
+        walkers, log_p = p0, log_prob(p0)
+
+    for step in range(first, n_steps):
+        t0 = time.perf_counter()
+        walkers, log_p, n_accepted = stretch_move(walkers, log_p, log_prob, np.random.default_rng([seed, step]), a)
+
+        stored['chain'][step] = walkers
+        stored['log_prob'][step] = log_p
+        stored['accepted'][step] = n_accepted
+        stored['wall'][step] = time.perf_counter() - t0
+        for name in ('chain', 'log_prob', 'accepted', 'wall'):
+            stored[name].flush()
+        done[step] = True
+        done.flush()
+
+        if step % 10 == 0:
+            print(f'step {step}: acceptance {n_accepted / n_walkers:.2f}, best log posterior {np.max(log_p):.2f}',
+                  flush=True)
+
+    return (stored['chain'], stored['log_prob'], done)
+
+
+def autocorrelation_time(x, c=5):
+    """Integrated autocorrelation time of a (step, walker) series, averaged over walkers (Sokal's window)"""
+
+    n = len(x)
+    x = x - x.mean(axis=0)
+    f = np.fft.rfft(x, n=2 * n, axis=0)
+    acf = np.fft.irfft(f * np.conj(f), axis=0)[:n].mean(axis=1)
+    if acf[0] == 0:
+        return (np.nan)
+    acf /= acf[0]
+
+    taus = 2 * np.cumsum(acf) - 1
+    windows = np.arange(n) < c * taus
+    window = np.argmin(windows) if not windows.all() else n - 1
+
+    return (float(taus[window]))
+
+
+def summarise(path, space, burn=0.5):
+    """Posterior summary of a (possibly still running) sampler in path
+
+    Args:
+        burn: fraction of the finished steps discarded as burn-in.
+
+    Returns:
+        A dictionary with, per parameter name, mean, std, 5th and 95th percentiles (physical units, fixed
+        parameters excluded) and the autocorrelation time, plus the acceptance fraction, the effective sample
+        count (smallest over parameters) and effective samples per second of sampling wall time.
+    """
+
+    done = np.load(f'{path}/done.npy')
+    n_done = int(np.sum(done))
+    chain = np.load(f'{path}/chain.npy', mmap_mode='r')[int(burn * n_done):n_done]
+    accepted = np.load(f'{path}/accepted.npy')[:n_done]
+    wall = np.load(f'{path}/wall.npy')[:n_done]
+
+    n_steps, n_walkers, ndim = chain.shape
+    full = np.array([space.to_full(p) for p in chain.reshape(-1, ndim)]).reshape(n_steps, n_walkers, -1)
+    free_index = [space.names.index(name) for name in space.free_names]
+
+    report = {}
+    taus = []
+    for d, name in enumerate(space.free_names):
+        samples = full[:, :, free_index[d]]
+        tau = autocorrelation_time(np.asarray(chain[:, :, d]))
+        taus.append(tau)
+        report[name] = {'mean': float(np.mean(samples)),
+                        'std': float(np.std(samples)),
+                        'p05': float(np.percentile(samples, 5)),
+                        'p95': float(np.percentile(samples, 95)),
+                        'tau': tau}
+
+    effective_samples = n_steps * n_walkers / np.nanmax(taus) if n_steps else 0.0
+    report['acceptance'] = float(np.sum(accepted) / (n_done * n_walkers)) if n_done else 0.0
+    report['effective_samples'] = float(effective_samples)
+    report['effective_samples_per_s'] = float(effective_samples / np.sum(wall)) if np.sum(wall) else 0.0
+
+    return (report)
+
+
+if __name__ == '__main__':
+    CL_input = inverter_tools.CL_parse(sys.argv)
+    path = str(CL_input['task_id'])
+    n_steps = CL_input['niter']
+
+    path_to_obs = '/home/ucfarm0/inverse_smrt/inverter/vishnu_real_data' if CL_input['hpc'] else 'vishnu_real_data'
+    start_date, end_date = '2019-11-29 09:00:00', '2019-12-01 06:00:00'
+    site_no = 2
+
+    space = parse_space_options(CL_input)
+    obs_dict = inverter_tools.get_obs_dict(start_date, end_date, site_no, path_to_obs)
+    noise = load_noise(path_to_obs, site_no)
+    seed = int(CL_input.get('seed', 0))
+
+    if 'emulator' in CL_input:
+        emulator, report = train_emulator(int(CL_input['emulator']), obs=inverter_tools.obs_dict_to_array(obs_dict))
+        print(f'Emulator hold-out check: {report}')
+        forward = EmulatedForward(emulator)
+    elif 'lut' in CL_input:
+        # Local surrogate on the table entries that best match the observation
+        lut_params, lut_sigma, _ = LookupTable(CL_input['lut']).query(obs_dict, k=int(CL_input.get('lut_points', 500)))
+        forward = EmulatedForward(RBFEmulator(space.bounds).fit(lut_params, lut_sigma))
+    else:
+        forward = PooledForward(int(CL_input['processes']) if 'processes' in CL_input else None)
+
+    x0 = best_minimum(CL_input['start'])[0] if 'start' in CL_input else space.default
+    p0 = initial_walkers(x0, int(CL_input.get('walkers', 32)), space, seed=seed)
+
+    log_prob = LogPosterior(obs_dict, noise, space, forward)
+    try:
+        run_sampler(path, log_prob, p0, n_steps, seed=seed,
+                    meta={'site': site_no, 'start_date': start_date, 'end_date': end_date,
+                          'free_names': space.free_names, 'forward': type(forward).__name__})
+    finally:
+        forward.close()
+
+    report = summarise(path, space, burn=float(CL_input.get('burn', 0.5)))
+    json.dump(report, open(f'{path}/summary.json', 'w'), indent=1)
+    for name in space.free_names:
+        print(f"{name:<20} {report[name]['mean']:10.3f} +/- {report[name]['std']:.3f} "
+              f"[{report[name]['p05']:.3f}, {report[name]['p95']:.3f}] tau {report[name]['tau']:.1f}")
+    print(f"acceptance {report['acceptance']:.2f}, {report['effective_samples']:.0f} effective samples, "
+          f"{report['effective_samples_per_s']:.3f} per second")
@@ -0,0 +1,155 @@
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Opt-in: call enable() or set INVERTER_PROFILE=1 before running
+enabled = os.environ.get('INVERTER_PROFILE', '0') not in ('', '0')
+
+report_interval = 600  # seconds between periodic summaries
+
+_timings = defaultdict(lambda: [0, 0.0, 0.0])  # stage -> [calls, total seconds, max seconds]
+_counters = defaultdict(int)
+_started = time.time()
+_last_report = time.time()
+
+
+def enable(interval=None):
+    global enabled, report_interval
+    enabled = True
+    if interval is not None:
+        report_interval = interval
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    global _started, _last_report
+    _timings.clear()
+    _counters.clear()
+    _started = _last_report = time.time()
+
+
+@contextmanager
+def _timed(stage):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - t0
+        timing = _timings[stage]
+        timing[0] += 1
+        timing[1] += elapsed
+        timing[2] = max(timing[2], elapsed)
+
+
+@contextmanager
+def _untimed():
+    yield
+
+
+def timer(stage):
+    """Context manager adding the wall time of the block to `stage` (a no-op unless profiling is enabled)"""
+
+    if enabled:
+        return (_timed(stage))
+
+    return (_untimed())
+
+
+def count(name, n=1):
+    if enabled:
+        _counters[name] += n
+
+
+def start_task(enable_profiling):
+    """Called at the start of a pool task: profiles as the parent does, from a fresh start
+
+    A forked worker starts with a copy of its parent's timings, so they are cleared to make collect() cover only
+    the task's own work.
+    """
+
+    global enabled
+    enabled = enable_profiling
+    reset()
+
+
+def collect():
+    """Returns the summary of a pool task's work (None unless profiling is enabled), to be passed to absorb()"""
+
+    return (summary() if enabled else None)
+
+
+def absorb(other):
+    """Adds another process's summary (a pool task's collect()) to this process's timings and counters
+
+    Stage totals then add up the time spent in every process, so their fraction of wall time can exceed 1.
+    """
+
+    if other is None:
+        return
+
+    for stage, t in other['stages'].items():
+        timing = _timings[stage]
+        timing[0] += t['calls']
+        timing[1] += t['total_s']
+        timing[2] = max(timing[2], t['max_s'])
+
+    for name, n in other['counters'].items():
+        _counters[name] += n
+
+
+def summary(extra=None):
+    """Returns the timings and counters collected so far as a JSON-serialisable dictionary"""
+
+    wall = time.time() - _started
+    stages = {stage: {'calls': calls,
+                      'total_s': total,
+                      'mean_s': total / calls if calls else 0.0,
+                      'max_s': longest,
+                      'fraction_of_wall': total / wall if wall else 0.0}
+              for stage, (calls, total, longest) in _timings.items()}
+
+    result = {'wall_s': wall, 'stages': stages, 'counters': dict(_counters)}
+    if extra:
+        result.update(extra)
+
+    return (result)
+
+
+def format_summary(extra=None):
+    s = summary(extra)
+    lines = [f"profile after {s['wall_s']:.0f} s:"]
+
+    for stage, t in sorted(s['stages'].items(), key=lambda item: -item[1]['total_s']):
+        lines.append(f"  {stage:<24} {t['calls']:>8} calls {t['total_s']:>10.2f} s "
+                     f"({100 * t['fraction_of_wall']:.1f}%) mean {1e3 * t['mean_s']:.1f} ms")
+
+    for name, n in sorted(s['counters'].items()):
+        lines.append(f'  {name:<24} {n:>8}')
+
+    for name in (extra or {}):
+        lines.append(f'  {name:<24} {extra[name]}')
+
+    return ('\n'.join(lines))
+
+
+def maybe_report(extra=None):
+    """Prints a summary to the job log if report_interval seconds have passed since the last one"""
+
+    global _last_report
+
+    if enabled and (time.time() - _last_report > report_interval):
+        _last_report = time.time()
+        print(format_summary(extra), flush=True)
+
+
+def dump(path, extra=None):
+    """Writes the machine-readable profile to path (no-op unless profiling is enabled)"""
+
+    if enabled:
+        json.dump(summary(extra), open(path, 'w'), indent=1, default=str)
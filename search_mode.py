@@ -1,14 +1,23 @@
 import datetime
-from inverter_classes import MyBounds, MyTakeStep
-from inverter_tools import calculate_cost, CL_parse, get_initial_bounds, get_obs_dict
+from inverter_classes import BoundedTakeStep, FiniteDifferenceJacobian, LeastSquaresMinimizer, MyBounds
+from inverter_tools import calculate_cost, CL_parse, get_obs_dict, obs_dict_to_array
 try:
     from scipy_dev import scipy
 except:
     pass
 
-from scipy.optimize import basinhopping
+from scipy.optimize import basinhopping, minimize
+import numpy as np
 import scipy
 import pickle
+import inverter_tools
+import profiling
+from lookup_table import LookupTable
+from minima_log import ForwardLog, MinimaLog
+from signature_index import SignatureIndex, start_candidates
+from emulator import EmulatorCost, train_emulator
+from multistart import run_multistart
+from parameter_space import parse_space_options
 import sys
 
 CL_input = CL_parse(sys.argv)
@@ -16,26 +25,23 @@ job_name = str(CL_input['task_id'])
 niter = CL_input['niter']
 hpc = CL_input['hpc']
 
+if 'profile' in CL_input:
+    # --profile=<seconds between summaries in the job log>
+    profiling.enable(interval=float(CL_input['profile']))
+
 print(f'scipy v{scipy.__version__}')
 print(f'job_name: {job_name}')
 print(f'hops: {niter}')
 print(f"hpc: {hpc}")
 
-initial_guess = [0.25, # Snow Depth
-                 0.7, # Ice Thickness
-                 0.5, # Ice Salinity
-                 830, # Ice Density
-                 260, # Temperature
-                 0.3, # Snow MCL
-                 0.34, # Ice MCL
-                 350, # Snow Density
-#                  0, # Snow Salinity
-                 0.5, # Snow RMS
-                 20, # Snow RCL
-                 2.1, # Ice RMS
-                 120] # Ice RCL
-
-initial_bounds = get_initial_bounds()
+# --fix=name:value,... holds parameters out of the search, --log=name,... hops them in log space
+space = parse_space_options(CL_input)
+print(space)
+
+initial_guess = space.default
+
+# The minimizers only see the free parameters (in their transformed coordinates)
+initial_bounds = space.free_bounds
 
 start_date, end_date = '2019-11-29 09:00:00', '2019-12-01 06:00:00'
 site_no = 2
@@ -49,32 +55,173 @@ else:
 
 obs_dict = get_obs_dict(start_date,end_date,site_no,path_to_obs)
 
+if 'lut' in CL_input:
+    # Warm start from the closest precomputed forward run instead of the hand-written guess
+    lut_params, lut_sigma, lut_costs = LookupTable(CL_input['lut']).query(obs_dict, k=1)
+    initial_guess = space.to_full(space.to_free(lut_params[0]))  # Keeps any fixed values
+    print(f'LUT start cost: {lut_costs[0]}')
+
+start_guesses = None
+
+if 'index' in CL_input:
+    # Nearest simulated signatures (from LUTs and past searches) as start points, one per chain
+    index = SignatureIndex.load(CL_input['index'])
+    start_guesses, index_costs = start_candidates(index, obs_dict, space, k=int(CL_input.get('chains', 1)))
+    initial_guess = start_guesses[0]
+    print(f'signature index start costs: {index_costs}')
+
+if 'archive' in CL_input:
+    # Every forward run this search evaluates is archived for the next signature index build
+    inverter_tools.forward_log = ForwardLog(CL_input['archive'], n_params=len(space))
+
+if ('jac' in CL_input) and ('emulator' in CL_input):
+    raise ValueError('--jac and --emulator are mutually exclusive: the finite-difference gradient runs SMRT '
+                     'and would bypass the surrogate')
+
+if (CL_input.get('local') == 'lsq') and ('emulator' in CL_input):
+    raise ValueError('--local=lsq and --emulator are mutually exclusive: the least-squares minimizer runs SMRT '
+                     'residuals and would bypass the surrogate')
+
+emulator_cost = None
+cost_function = space.wrap(calculate_cost)
+
+if 'emulator' in CL_input:
+    # Run the global search on an RBF surrogate, using SMRT only to verify minima and refine the surrogate
+    emulator, report = train_emulator(int(CL_input['emulator']), obs=obs_dict_to_array(obs_dict))
+    print(f'Emulator hold-out check: {report}')
+    emulator_cost = EmulatorCost(emulator)
+    cost_function = space.wrap(emulator_cost)
+    n_refine = int(CL_input.get('refine', 4))
+
+minimizer_jac = False
+local_method = CL_input.get('local', 'SLSQP')
+
+if local_method == 'lsq':
+    # Bounded Gauss-Newton/LM on the residual vector with Broyden Jacobian updates
+    local_method = LeastSquaresMinimizer(initial_bounds, space=space)
+
+if 'jac' in CL_input:
+    # Cost and gradient from one batched SMRT call per local-minimizer iteration. Chains already occupy the
+    # pool workers (which can't start pools of their own), so only a single chain spreads the gradient points.
+    jac_processes = int(CL_input['processes']) if ('processes' in CL_input) and ('chains' not in CL_input) else None
+    cost_function = FiniteDifferenceJacobian(initial_bounds,
+                                             central=(CL_input['jac'] == 'central'),
+                                             processes=jac_processes,
+                                             space=space)
+    minimizer_jac = True
+
+# --fidelity=low runs the hops on the cheap model and polishes accepted minima at full fidelity
+fidelity = CL_input.get('fidelity', 'full')
+cost_args = (obs_dict,)
+fidelity_discrepancies = []
+
+if fidelity != 'full':
+    # The least-squares minimizer runs its own full-fidelity residuals and never sees cost_args, and chains always
+    # run at full fidelity
+    if (emulator_cost is None) and not minimizer_jac and not isinstance(local_method, LeastSquaresMinimizer) \
+            and ('chains' not in CL_input):
+        cost_args = (obs_dict, fidelity)
+    else:
+        print(f'--fidelity={fidelity} only applies to a single chain on the plain SMRT cost with a scipy local '
+              f'minimizer; running at full fidelity')
+        fidelity = 'full'
+
 running_data = []
+minima_log = MinimaLog(f'{output_location}{job_name}.minima', n_params=len(space))
 
 def store_minima(x, f, accepted):
+    if emulator_cost is not None:
+        emulated_f = f
+        f = emulator_cost.verify(space.to_full(x), obs_dict)
+        print(f'emulated cost {emulated_f}, true cost {f}')
+        if n_refine:
+            emulator_cost.emulator.refine(n_refine)
+
+    if fidelity != 'full':
+        coarse_f = f
+        f = calculate_cost(space.to_full(x), obs_dict)
+        fidelity_discrepancies.append((coarse_f, f))
+        print(f'{fidelity} fidelity cost {coarse_f}, full fidelity cost {f}')
+
+        if accepted:
+            polished = minimize(space.wrap(calculate_cost), x, args=(obs_dict,), method='SLSQP',
+                                bounds=initial_bounds)
+            print(f'polished at full fidelity: {f} -> {polished.fun}')
+            x, f = polished.x, polished.fun
+
+    # Minima are stored and logged as full parameter vectors
+    x = space.to_full(x)
     running_data.append((x, f, datetime.datetime.now()))
-    pickle.dump(running_data, open(f'{output_location}{job_name}.p', 'wb') )
+    minima_log.append(x, f, accepted=accepted, n_evals=inverter_tools.forward_runs)
 
 t_start = datetime.datetime.now()
 
-print('running bh')
-fit2 = basinhopping(calculate_cost,
-                    x0 = initial_guess,
-                    stepsize=1,
-                    T=5,
-                    niter=niter,
-                    minimizer_kwargs={
-                        'method':'SLSQP',
-                        'args':(obs_dict,), # Passes through the observations for the cost function calculation
-                        'bounds':initial_bounds, # Stops the local minimizer exceeding bounds
-                                        },
-                    take_step=MyTakeStep(initial_bounds), # Ensures that parameter-space is evenly stepped through
-                    accept_test=MyBounds(initial_bounds), # Stops the basin hopping step exceeding bounds
-                    callback=store_minima,
-                    disp=True,
-                  )
-
-print(running_data)
+if 'chains' in CL_input:
+    # Several chains on one node, all appending to the same minima log (always at full fidelity)
+    print(f"running {CL_input['chains']} bh chains")
+    merged = run_multistart(obs_dict,
+                            n_chains=int(CL_input['chains']),
+                            niter=niter,
+                            initial_guess=initial_guess if start_guesses is None else start_guesses,
+                            processes=int(CL_input['processes']) if 'processes' in CL_input else None,
+                            func=cost_function,
+                            jac=minimizer_jac,
+                            method=local_method,
+                            minima_log=minima_log,
+                            space=space,
+                            verify=None if emulator_cost is None else emulator_cost.verify,
+                            patience=int(CL_input['patience']) if 'patience' in CL_input else None)
+    pickle.dump(merged, open(f'{output_location}{job_name}_chains.p', 'wb'))
+
+    print(f"best cost {merged['best_cost']} from chain {merged['best_chain']}")
+    print(merged['best_params'])
+
+else:
+    print('running bh')
+    take_step = BoundedTakeStep(initial_bounds)
+    fit2 = basinhopping(cost_function,
+                        x0 = space.to_free(initial_guess),
+                        stepsize=1,
+                        T=5,
+                        niter=niter,
+                        minimizer_kwargs={
+                            'method':local_method,
+                            'args':cost_args, # Passes through the observations for the cost function calculation
+                            'bounds':initial_bounds, # Stops the local minimizer exceeding bounds
+                            'jac':minimizer_jac, # True when cost_function also returns the gradient
+                                            },
+                        take_step=take_step, # Proposes in-bounds hops and adapts the step per parameter
+                        accept_test=MyBounds(initial_bounds), # Stops the basin hopping step exceeding bounds
+                        callback=store_minima,
+                        disp=True,
+                      )
+
+    print(running_data)
+    if emulator_cost is not None:
+        print(f'SMRT-verified minimum: {min(running_data, key=lambda r: r[1])[1]} '
+              f'({emulator_cost.n_verified} verification runs)')
+    print(fit2)
+    print(inverter_tools.print_params(space.to_full(fit2.x)))
+    print(f'Hop acceptance: {take_step.acceptance_stats()}')
+    if isinstance(local_method, LeastSquaresMinimizer):
+        print(f'{local_method.n_forward} forward runs in least-squares local fits')
+    if fidelity_discrepancies:
+        coarse, full = np.array(fidelity_discrepancies).T
+        print(f'{fidelity} vs full fidelity cost: mean abs difference {np.mean(np.abs(coarse - full))}, '
+              f'best hop by {fidelity} fidelity is best by full fidelity: {np.argmin(coarse) == np.argmin(full)}')
+
+minima_log.close()
+if minimizer_jac:
+    cost_function.close()
+if inverter_tools.forward_log is not None:
+    inverter_tools.forward_log.close()
+
+if profiling.enabled:
+    cache_stats = {'forward_cache': inverter_tools.forward_cache.stats(),
+                   'submodel_caches': {name: info._asdict()
+                                       for name, info in inverter_tools.submodel_cache_info().items()}}
+    print(profiling.format_summary(cache_stats))
+    profiling.dump(f'{output_location}{job_name}_profile.json', cache_stats)
+
 print('Time Elapsed:')
 print(datetime.datetime.now()-t_start)
-print(fit2)
\ No newline at end of file
@@ -28,3 +28,6 @@
 
 source /home/ucfarm0/inverse_smrt/bin/activate
 python /home/ucfarm0/inverse_smrt/inverter/search_mode.py jan_2021_$SGE_TASK_ID 100 -hpc
+
+# Alternatively, run all chains in one task on a multi-core node (set -pe smp to the chain count and drop -t):
+# python /home/ucfarm0/inverse_smrt/inverter/search_mode.py jan_2021 100 -hpc --chains=$NSLOTS
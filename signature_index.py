@@ -0,0 +1,150 @@
+import glob
+import sys
+import numpy as np
+from scipy.spatial import cKDTree
+import inverter_tools
+from lookup_table import LookupTable
+from minima_log import ForwardLog, read_records
+from observations import ObservationCube
+
+
+class SignatureIndex(object):
+    """KD-tree over simulated dB signatures (4 channels x 11 angles, flattened) for instant warm starts
+
+    Without PCA the Euclidean distance in signature space orders entries exactly as cost_fn does, so the nearest
+    neighbour is the lowest-cost entry. With n_components the tree is built on that many principal components,
+    which keeps queries fast as the archive grows; the neighbours are then re-ranked by their exact cost.
+    Observed NaNs are filled with the archive mean for the tree search and left out of the re-ranking cost.
+
+    Args:
+        params: (N, n_params) parameter vectors.
+        sigma: (N, channel, angle) forward-model output for them. Runs with any NaN are dropped.
+        n_components: optional number of principal components to index.
+    """
+
+    def __init__(self, params, sigma, n_components=None):
+        sigma = np.asarray(sigma, dtype=float)
+        self.shape = tuple(sigma.shape[1:]) if sigma.ndim == 3 else (len(inverter_tools.channels), -1)
+        sigma = sigma.reshape(len(sigma), -1)
+        valid = ~np.isnan(sigma).any(axis=1)
+
+        self.params = np.asarray(params, dtype=float)[valid]
+        self.sigma = sigma[valid]
+        self.mean = self.sigma.mean(axis=0)
+        self.components = None
+
+        if n_components:
+            _, _, vt = np.linalg.svd(self.sigma - self.mean, full_matrices=False)
+            self.components = vt[:n_components]
+
+        self._build()
+
+    def _build(self):
+        self.tree = cKDTree(self._features(self.sigma))
+
+    def _features(self, signatures):
+        centred = signatures - self.mean
+        return (centred if self.components is None else centred @ self.components.T)
+
+    def __len__(self):
+        return (len(self.params))
+
+    def query(self, signature, k=10, oversample=4):
+        """Returns the k entries whose signature best matches an observation
+
+        Args:
+            signature: an obs_dict from get_obs_dict, a (channel, angle) array or an ObservationCube (matched on
+                its time-mean signature).
+            k: number of matches to return.
+            oversample: with PCA or missing observations, k * oversample tree neighbours are re-ranked.
+
+        Returns:
+            (params, sigma, costs) for the k best entries, sorted by cost, like LookupTable.query.
+        """
+
+        if isinstance(signature, ObservationCube):
+            signature = signature.mean()
+
+        obs = inverter_tools.obs_dict_to_array(signature).reshape(-1)
+        missing = np.isnan(obs)
+        exact = (self.components is None) and not missing.any()
+
+        n_neighbours = min(len(self), k if exact else k * oversample)
+        _, index = self.tree.query(self._features(np.where(missing, self.mean, obs)), k=n_neighbours)
+        index = np.atleast_1d(index)
+
+        # cost_fn over the observed angles only
+        sigma = self.sigma[index].reshape(len(index), *self.shape)
+        obs = obs.reshape(self.shape)
+        observed = ~np.isnan(obs)
+        squared = np.where(observed, (sigma - np.where(observed, obs, 0)) ** 2, 0)
+        costs = np.sum(np.sum(squared, axis=-1) / np.maximum(observed.sum(axis=-1), 1), axis=-1)
+
+        order = np.argsort(costs, kind='stable')[:k]
+
+        return (self.params[index[order]], sigma[order], costs[order])
+
+    def save(self, path):
+        np.savez(path,
+                 params=self.params,
+                 sigma=self.sigma,
+                 mean=self.mean,
+                 components=np.empty((0, self.sigma.shape[1])) if self.components is None else self.components,
+                 shape=np.array(self.shape))
+
+    @classmethod
+    def load(cls, path):
+        """Loads an index written by save(), rebuilding the tree (no SVD is repeated)"""
+
+        data = np.load(path)
+        index = cls.__new__(cls)
+        index.params, index.sigma, index.mean = data['params'], data['sigma'], data['mean']
+        index.components = data['components'] if len(data['components']) else None
+        index.shape = tuple(data['shape'])
+        index._build()
+
+        return (index)
+
+    @classmethod
+    def from_sources(cls, luts=(), forward_logs=(), n_components=None):
+        """Builds an index from lookup tables (finished chunks only) and ForwardLog archives (paths or globs)"""
+
+        params, sigma = [], []
+
+        for path in luts:
+            lut = LookupTable(path)
+            finished = np.repeat(np.asarray(lut.done), lut.meta['chunk_size'])[:len(lut)]
+            params.append(np.asarray(lut.params)[finished])
+            sigma.append(np.asarray(lut.sigma, dtype=float)[finished].reshape(int(finished.sum()), -1))
+
+        for path in sorted(set(f for p in forward_logs for f in (glob.glob(p) or [p]))):
+            records = read_records(path, ForwardLog)
+            params.append(np.array(records['params']))
+            sigma.append(np.array(records['sigma'], dtype=float))
+
+        if not params:
+            raise ValueError('No lookup tables or forward logs to index')
+
+        sigma = np.concatenate(sigma).reshape(-1, len(inverter_tools.channels), len(inverter_tools.default_angles))
+
+        return (cls(np.concatenate(params), sigma, n_components))
+
+
+def start_candidates(index, signature, space, k=1):
+    """The k best index matches to a signature as full vectors of `space` (clipped to its bounds, fixed values set)"""
+
+    params, _, costs = index.query(signature, k=k)
+    lows, highs = np.array(space.bounds, dtype=float).T
+
+    return ([space.to_full(space.to_free(np.clip(p, lows, highs))) for p in params], costs)
+
+
+if __name__ == '__main__':
+    # python signature_index.py <out.npz> [--lut=path,path] [--archives=glob,glob] [--components=n]
+    positional, options = inverter_tools.parse_options(sys.argv)
+
+    index = SignatureIndex.from_sources(luts=options['lut'].split(',') if 'lut' in options else (),
+                                        forward_logs=options['archives'].split(',') if 'archives' in options else (),
+                                        n_components=int(options['components']) if 'components' in options else None)
+    index.save(positional[0])
+    print(f'indexed {len(index)} forward runs')
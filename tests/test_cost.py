@@ -0,0 +1,52 @@
+import numpy as np
+from inverter_tools import batch_cost, channels, cost_fn, default_angles, obs_dict_to_array
+from model_result import ModelResult
+
+
+def _obs_dict(rng):
+    return ({f'{channel}_Mean': rng.normal(-15, 5, len(default_angles)) for channel in channels})
+
+
+def _batch(rng, n=6):
+    return (rng.normal(-15, 5, size=(n, len(channels), len(default_angles))))
+
+
+def test_batch_cost_matches_cost_fn_per_member():
+    rng = np.random.default_rng(0)
+    obs_dict = _obs_dict(rng)
+    sigma = _batch(rng)
+
+    costs = batch_cost(sigma, obs_dict_to_array(obs_dict))
+
+    assert costs.shape == (len(sigma),)
+    for member, cost in zip(sigma, costs):
+        # The per-channel dictionary path and the ModelResult path
+        assert np.isclose(cost, cost_fn(dict(zip(channels, member)), obs_dict))
+        assert np.isclose(cost, cost_fn(ModelResult(member, channels, default_angles), obs_dict))
+
+
+def test_any_nan_in_a_member_costs_1000():
+    rng = np.random.default_rng(1)
+    obs_dict = _obs_dict(rng)
+    sigma = _batch(rng)
+    sigma[2, 1, 4] = np.nan
+    sigma[4] = np.nan
+
+    costs = batch_cost(sigma, obs_dict_to_array(obs_dict))
+    expected = [cost_fn(dict(zip(channels, member)), obs_dict) for member in sigma]
+
+    np.testing.assert_allclose(costs, expected)
+    assert costs[2] == costs[4] == 1000
+    assert np.all(costs[[0, 1, 3, 5]] < 1000)
+
+
+def test_nan_observation_costs_1000_in_both():
+    rng = np.random.default_rng(2)
+    obs_dict = _obs_dict(rng)
+    obs_dict[f'{channels[0]}_Mean'][3] = np.nan
+    sigma = _batch(rng, n=3)
+
+    costs = batch_cost(sigma, obs_dict_to_array(obs_dict))
+
+    np.testing.assert_array_equal(costs, 1000)
+    assert all(cost_fn(dict(zip(channels, member)), obs_dict) == 1000 for member in sigma)
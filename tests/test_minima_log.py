@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+from minima_log import ForwardLog, MinimaLog, read_records, record_dtype
+
+
+def test_read_records_drops_a_partial_last_record(tmp_path):
+    path = str(tmp_path / 'run.minima')
+    with MinimaLog(path, n_params=3) as log:
+        log.append([1, 2, 3], 0.5, n_evals=10)
+        log.append([4, 5, 6], 0.25, accepted=False, n_evals=20, chain=1)
+
+    # A crash part-way through the third write
+    with open(path, 'ab') as f:
+        f.write(b'\x01' * (record_dtype(3).itemsize // 2))
+
+    records = read_records(path)
+
+    assert len(records) == 2
+    np.testing.assert_array_equal(records['params'], [[1, 2, 3], [4, 5, 6]])
+    np.testing.assert_array_equal(records['cost'], [0.5, 0.25])
+    np.testing.assert_array_equal(records['n_evals'], [10, 20])
+    np.testing.assert_array_equal(records['accepted'], [True, False])
+    np.testing.assert_array_equal(records['chain'], [0, 1])
+
+
+def test_reopening_cuts_off_a_partial_record_before_appending(tmp_path):
+    path = str(tmp_path / 'run.minima')
+    with MinimaLog(path, n_params=3) as log:
+        log.append([1, 2, 3], 0.5)
+
+    with open(path, 'ab') as f:
+        f.write(b'\x01' * (record_dtype(3).itemsize // 2))
+
+    with MinimaLog(path, n_params=3) as log:
+        log.append([4, 5, 6], 0.25, chain=1)
+
+    records = read_records(path)
+
+    assert len(records) == 2
+    np.testing.assert_array_equal(records['params'], [[1, 2, 3], [4, 5, 6]])
+    np.testing.assert_array_equal(records['cost'], [0.5, 0.25])
+    np.testing.assert_array_equal(records['chain'], [0, 1])
+
+
+def test_forward_log_drops_a_partial_last_record(tmp_path):
+    path = str(tmp_path / 'runs.fwd')
+    with ForwardLog(path, n_params=2) as log:
+        log.append([1, 2], np.arange(44).reshape(4, 11))
+
+    with open(path, 'ab') as f:
+        f.write(b'\x01' * 7)
+
+    records = read_records(path, ForwardLog)
+
+    assert len(records) == 1
+    np.testing.assert_array_equal(records['sigma'][0], np.arange(44))
+
+
+def test_log_with_a_different_parameter_count_is_rejected(tmp_path):
+    path = str(tmp_path / 'run.minima')
+    MinimaLog(path, n_params=3).close()
+
+    with pytest.raises(ValueError):
+        MinimaLog(path, n_params=4)
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from parameter_space import default_space, parse_space_options
+
+
+def _space():
+    return (default_space().fix(temp=262, snow_density=300).with_transform('log', 'snow_depth', 'ice_salinity'))
+
+
+def test_full_to_free_and_back():
+    space = _space()
+    full = space.default
+    free = space.to_free(full)
+
+    assert len(free) == len(space) - 2
+    assert space.free_names[0] == 'snow_depth'
+    assert free[0] == pytest.approx(np.log(full[0]))
+    np.testing.assert_allclose(space.to_full(free), full)
+
+
+def test_free_to_full_and_back_sets_the_fixed_values():
+    space = _space()
+    lows, highs = np.array(space.free_bounds).T
+    free = np.random.default_rng(0).uniform(lows, highs)
+
+    full = space.to_full(free)
+
+    assert space.as_dict(full)['temp'] == 262
+    assert space.as_dict(full)['snow_density'] == 300
+    np.testing.assert_allclose(space.to_free(full), free)
+
+
+def test_log_scaled_bounds_and_wrap():
+    space = _space()
+    snow_depth = space.free_names.index('snow_depth')
+
+    np.testing.assert_allclose(space.free_bounds[snow_depth], np.log(default_space().bounds[0]))
+    free = space.to_free(space.default)
+    np.testing.assert_allclose(space.wrap(lambda full, scale: scale * full)(free, 2), 2 * space.default)
+
+
+def test_parse_space_options_matches_the_api():
+    space = parse_space_options({'fix': 'temp:262,snow_density:300', 'log': 'snow_depth,ice_salinity'})
+
+    assert space.free_names == _space().free_names
+    np.testing.assert_allclose(space.free_bounds, _space().free_bounds)
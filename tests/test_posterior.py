@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+from posterior import autocorrelation_time, stretch_move
+
+variances = np.array([1.0, 4.0])
+
+
+def gaussian_log_prob(x):
+    return (-0.5 * np.sum(x ** 2 / variances, axis=1))
+
+
+def test_stretch_move_samples_a_gaussian():
+    rng = np.random.default_rng(0)
+    walkers = rng.normal(size=(32, 2))
+    log_p = gaussian_log_prob(walkers)
+
+    chain, n_accepted = [], 0
+    for _ in range(2000):
+        walkers, log_p, accepted = stretch_move(walkers, log_p, gaussian_log_prob, rng)
+        chain.append(walkers)
+        n_accepted += accepted
+
+    samples = np.concatenate(chain[1000:])
+
+    assert 0.2 < n_accepted / (2000 * 32) < 0.9
+    np.testing.assert_allclose(samples.mean(axis=0), 0, atol=0.2)
+    np.testing.assert_allclose(samples.std(axis=0), np.sqrt(variances), rtol=0.15)
+    np.testing.assert_allclose(log_p, gaussian_log_prob(walkers))
+
+
+def test_autocorrelation_time_of_an_ar1_series():
+    # x_t = phi x_{t-1} + noise has an integrated autocorrelation time of (1 + phi) / (1 - phi)
+    rng = np.random.default_rng(0)
+    phi, n_steps = 0.5, 20000
+    noise = rng.normal(size=(n_steps, 8))
+
+    x = np.empty_like(noise)
+    x[0] = noise[0]
+    for t in range(1, n_steps):
+        x[t] = phi * x[t - 1] + noise[t]
+
+    assert autocorrelation_time(x) == pytest.approx((1 + phi) / (1 - phi), rel=0.15)
+    assert autocorrelation_time(noise) == pytest.approx(1, abs=0.15)
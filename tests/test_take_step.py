@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+from inverter_classes import BoundedTakeStep
+
+bounds = [(0, 1), (10, 20), (-5, 5)]
+
+
+@pytest.mark.parametrize('step_fraction', [0.5, 1.0, 7.3])
+def test_proposals_stay_in_bounds(step_fraction):
+    # Fractions above 1 make steps several times longer than the range, which fold back more than once
+    np.random.seed(0)
+    take_step = BoundedTakeStep(bounds, dim_fraction=1.0)
+    take_step.step_fractions[:] = step_fraction
+    lows, highs = np.array(bounds, dtype=float).T
+
+    x = np.array([0.99, 10.0, 0.0])
+    for _ in range(2000):
+        x = take_step(x)
+        assert np.all(x >= lows) and np.all(x <= highs)
+
+
+def test_only_moved_dimensions_change():
+    np.random.seed(1)
+    take_step = BoundedTakeStep(bounds, dim_fraction=0.3)
+    x = np.array([0.5, 15.0, 0.0])
+
+    for _ in range(200):
+        x_new = take_step(x)
+        assert take_step._moved.any()
+        np.testing.assert_array_equal(x_new[~take_step._moved], x[~take_step._moved])
+
+
+def test_report_widens_accepted_and_narrows_rejected_dimensions():
+    take_step = BoundedTakeStep(bounds, step_fraction=0.2, interval=10, factor=0.5, min_fraction=0.06)
+
+    # Dimension 0 is always accepted, dimension 1 always rejected, dimension 2 never moved
+    for _ in range(10):
+        take_step._moved = np.array([True, False, False])
+        take_step.report(accept=True)
+        take_step._moved = np.array([False, True, False])
+        take_step.report(accept=False)
+
+    np.testing.assert_allclose(take_step.step_fractions, [0.4, 0.1, 0.2])
+
+    for _ in range(20):
+        take_step._moved = np.array([True, True, False])
+        take_step.report(accept=False)
+
+    # Narrowed twice more, but not below min_fraction
+    np.testing.assert_allclose(take_step.step_fractions, [0.1, 0.06, 0.2])
+
+    stats = take_step.acceptance_stats()
+    assert stats['proposed'] == 40
+    assert stats['accepted'] == 10
+    np.testing.assert_array_equal(stats['dim_accept_rates'][:2], [10 / 30, 0])
+
+
+def test_report_caps_steps_at_the_full_range():
+    take_step = BoundedTakeStep(bounds, step_fraction=0.8, interval=5, factor=0.5)
+
+    for _ in range(5):
+        take_step._moved = np.array([True, False, False])
+        take_step.report(accept=True)
+
+    assert take_step.step_fractions[0] == 1.0
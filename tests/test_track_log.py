@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+from track_log import TrackLog, last_state, read_track, track_record_dtype
+
+times = pd.date_range('2019-11-29 09:00', periods=4, freq='3H')
+
+
+def test_resume_after_a_fragment(tmp_path):
+    path = str(tmp_path / 'run.track')
+    with TrackLog(path, n_params=2) as log:
+        log.append(0, times[0], [0.1, 1.0], 0.5, nfev=10)
+        log.append(1, times[1], [0.2, 2.0], 0.4, nfev=12)
+
+    # Pre-empted part-way through writing timestep 2
+    with open(path, 'ab') as f:
+        f.write(b'\x01' * (track_record_dtype(2).itemsize - 3))
+
+    assert last_state(path)[0] == 2
+
+    # The resumed job refits timestep 2 and carries on
+    with TrackLog(path, n_params=2) as log:
+        log.append(2, times[2], [0.3, 3.0], 0.3, nfev=8)
+        log.append(3, times[3], [0.4, 4.0], 0.2, skipped=True)
+
+    next_timestep, params, last_time = last_state(path)
+    df = read_track(path)
+
+    assert next_timestep == 4
+    np.testing.assert_array_equal(params, [0.3, 3.0])
+    assert last_time == times[3]
+    assert list(df['timestep']) == [0, 1, 2, 3]
+    assert list(df['obs_time']) == list(times)
+    np.testing.assert_array_equal(df['cost'], [0.5, 0.4, 0.3, 0.2])
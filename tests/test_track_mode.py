@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+import pytest
+from parameter_space import Parameter, ParameterSpace
+from track_mode import stitch, window_bounds
+
+space = ParameterSpace([Parameter('a', (0, 1), 0.5), Parameter('b', (0, 10), 5)])
+
+
+def _track(params, costs=None):
+    """A read_track-like DataFrame with one record per timestep from the window's start"""
+
+    params = np.asarray(params, dtype=float)
+    return (pd.DataFrame({'timestep': np.arange(len(params)),
+                          'params': list(params),
+                          'cost': np.ones(len(params)) if costs is None else costs,
+                          'skipped': np.zeros(len(params), dtype=bool)}))
+
+
+@pytest.mark.parametrize('n_timesteps, n_windows, overlap', [(100, 4, 4), (37, 3, 2), (13, 5, 1), (10, 1, 0)])
+def test_windows_cover_the_series_with_the_requested_overlap(n_timesteps, n_windows, overlap):
+    windows = window_bounds(n_timesteps, n_windows, overlap)
+
+    assert len(windows) == n_windows
+    assert windows[0][0] == 0
+    assert windows[-1][1] == n_timesteps
+    for (_, stop), (next_start, _) in zip(windows, windows[1:]):
+        assert stop - next_start == overlap
+
+
+def test_overlap_as_long_as_the_window_is_rejected():
+    with pytest.raises(ValueError):
+        window_bounds(10, 5, 10)
+
+
+def test_stitch_hands_over_where_the_windows_first_agree():
+    windows = window_bounds(10, 2, 4)
+    assert windows == [(0, 7), (3, 10)]
+
+    first = np.tile([0.2, 2.0], (7, 1))
+    second = np.tile([0.2, 2.0], (7, 1))
+    second[:2] = [0.9, 9.0]  # timesteps 3 and 4 still in another basin
+
+    result = stitch(windows, [_track(first), _track(second)], space)
+
+    assert result['handovers'] == [5]
+    assert result['disagreements'] == []
+    assert result['params'].shape == (10, 2)
+    assert not np.isnan(result['params']).any()
+    np.testing.assert_array_equal(result['params'][:5], first[:5])
+    np.testing.assert_array_equal(result['params'][5:], second[2:])
+
+
+def test_stitch_reports_windows_that_never_agree():
+    windows = window_bounds(10, 2, 4)
+    first = np.tile([0.2, 2.0], (7, 1))
+    second = np.tile([0.9, 9.0], (7, 1))
+
+    result = stitch(windows, [_track(first), _track(second, costs=np.full(7, 2.0))], space)
+
+    # Middle of the overlap (timesteps 3-6)
+    assert result['handovers'] == [5]
+    assert len(result['disagreements']) == 1
+    disagreement = result['disagreements'][0]
+    assert disagreement['windows'] == (0, 1)
+    assert disagreement['overlap'] == (3, 6)
+    assert disagreement['min_distance'] == pytest.approx(0.7)
+    assert disagreement['mean_costs'] == (1.0, 2.0)
+    np.testing.assert_array_equal(result['costs'], [1] * 5 + [2] * 5)
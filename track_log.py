@@ -0,0 +1,93 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+from minima_log import MinimaLog, read_records
+
+
+def track_record_dtype(n_params):
+    return (np.dtype([('timestep', '<i4'),
+                      ('obs_time', '<f8'),
+                      ('params', '<f8', (n_params,)),
+                      ('cost', '<f8'),
+                      ('nfev', '<i8'),
+                      ('n_evals', '<i8'),
+                      ('skipped', '?'),
+                      ('timestamp', '<f8')]))
+
+
+class TrackLog(MinimaLog):
+    """Append-only checkpoint of a track-mode run, one fixed-width record per completed timestep
+
+    Same file layout and crash behaviour as MinimaLog. Each record holds the timestep index, the observation time
+    (unix seconds), the fitted full parameter vector, its cost, the local minimizer's cost evaluations, the forward
+    runs so far and whether the timestep was skipped for having no observations. Resuming a track is reading the
+    last record back.
+    """
+
+    magic = b'TRKLOG1'
+    record_dtype = staticmethod(track_record_dtype)
+
+    def append(self, timestep, obs_time, params, cost, nfev=0, n_evals=-1, skipped=False, timestamp=None):
+        record = np.zeros(1, dtype=self.dtype)
+        record['timestep'] = timestep
+        record['obs_time'] = pd.Timestamp(obs_time).timestamp()
+        record['params'] = params
+        record['cost'] = cost
+        record['nfev'] = nfev
+        record['n_evals'] = n_evals
+        record['skipped'] = skipped
+        record['timestamp'] = time.time() if timestamp is None else timestamp
+
+        self._write(record)
+
+
+def read_track(path):
+    """Loads a track log into a DataFrame (one row per timestep, in timestep order)
+
+    A timestep written twice (by a job that was killed between fitting and moving on) keeps its last record.
+    """
+
+    columns = ['timestep', 'obs_time', 'params', 'cost', 'nfev', 'n_evals', 'skipped', 'datetime']
+
+    if not os.path.exists(path):
+        return (pd.DataFrame(columns=columns))
+
+    records = read_records(path, TrackLog)
+    df = pd.DataFrame({'timestep': records['timestep'],
+                       'obs_time': pd.to_datetime(records['obs_time'], unit='s'),
+                       'params': list(np.array(records['params'])),
+                       'cost': records['cost'],
+                       'nfev': records['nfev'],
+                       'n_evals': records['n_evals'],
+                       'skipped': records['skipped'],
+                       'datetime': pd.to_datetime(records['timestamp'], unit='s')}, columns=columns)
+
+    return (df.drop_duplicates('timestep', keep='last').sort_values('timestep', ignore_index=True))
+
+
+def last_state(path):
+    """Returns (next timestep, last fitted params or None, observation time of the last record or None)"""
+
+    df = read_track(path)
+    if df.empty:
+        return (0, None, None)
+
+    fitted = df[~df['skipped']]
+    params = fitted['params'].iloc[-1] if not fitted.empty else None
+
+    return (int(df['timestep'].iloc[-1]) + 1, params, df['obs_time'].iloc[-1])
+
+
+def resume_point(path, cube):
+    """Returns (first timestep to run, full params to start from or None) for tracking `cube` into the log at path
+
+    Raises a ValueError if the log was written for a different series.
+    """
+
+    first_timestep, params, last_time = last_state(path)
+
+    if first_timestep and ((first_timestep > len(cube)) or (last_time != cube.times[first_timestep - 1])):
+        raise ValueError(f'{path} was written for a different series (site, window or resampler)')
+
+    return (first_timestep, params)
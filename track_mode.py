@@ -1,115 +1,392 @@
+""" Track mode: follows the search-mode minimum through the resampled time series of one site
+
+Usage:
+    python track_mode.py <track_name> <max timesteps for this job, 0 for all> [-hpc] [--site=2] [--start=<date>]
+        [--end=<date>] [--minima=<search-mode minima logs>] [--jac=forward|central|off] [--local=lsq]
+        [--processes=n] [--fix=name:value,...] [--log=name,...] [--profile=<seconds>]
+        [--index=<signature index>] [--windows=K [--overlap=4] [--lut=<lookup table>]] [--ensemble=M]
+
+Every timestep is checkpointed to {track_name}.track (see track_log) as soon as it is fitted. Running the same
+command again resumes from the timestep after the last record, so a pre-empted job loses at most one fit and a
+season-long series can be covered by a chain of jobs. Timesteps with no observations in any channel are recorded
+as skipped without running the minimizer. A new track starts from the best search-mode minimum, or with --index
+from the simulated signature nearest the first observed timestep (see signature_index).
+
+With --windows the series is split into K overlapping windows that are tracked concurrently on a process pool
+(each checkpointed to {track_name}_w{k}.track) and then stitched together, see track_windows.
+
+With --ensemble M members, started from the best distinct search-mode minima, are tracked together and pruned
+and respawned by cost (each checkpointed to {track_name}_m{j}.track), see ensemble_track. The pickle then holds the
+best trajectory and the runner-up from a different basin.
+"""
+
+import datetime
 import pickle
-import pandas as pd
+import sys
+from multiprocessing import Pool
 import numpy as np
-from scipy_dev import scipy
+try:
+    from scipy_dev import scipy
+except:
+    import scipy
 from scipy.optimize import minimize
-print(scipy.__version__)
 import inverter_tools
-import itertools
+import profiling
+from ensemble_track import best_trajectories, ensemble_starts, track_ensemble
+from inverter_classes import FiniteDifferenceJacobian, LeastSquaresMinimizer
+from inverter_tools import CL_parse
+from lookup_table import LookupTable
+from minima_log import best_minimum
+from observations import ObservationCube
+from signature_index import SignatureIndex, start_candidates
+from parameter_space import parse_space_options
+from track_log import TrackLog, read_track, resume_point
+
+
+def track_space(options=None):
+    """Search-mode space with tighter bounds around the plausible state at the site, plus any --fix/--log options"""
+
+    space = inverter_tools.parameter_space.with_bounds(snow_depth=(0.08, 0.4),
+                                                       ice_thickness=(0.6, 1.5),
+                                                       ice_salinity=(0.1, 3))
+
+    return (parse_space_options(options or {}, space))
+
+
+def load_cube(path_to_obs, site_no, start_date=None, end_date=None):
+    signatures, _, _ = inverter_tools.prep_obs(path_to_obs, sites=[site_no], start_date=start_date,
+                                               end_date=end_date)
 
-path_to_obs = '/home/robbie/Dropbox/inverter/vishnu_real_data'
-path_to_pickles = '/home/robbie/Dropbox/KuKa_modelling/fitting/'
-track_file_name = 'test_track.p'
+    return (ObservationCube.from_signatures(signatures, site_no, start_date, end_date))
 
 
-signatures, start_dates, end_dates = inverter_tools.prep_obs(path_to_obs)
+def search_mode_start(minima):
+    """Best minimum over all search-mode logs matching `minima`"""
 
-df = signatures['Ku_HH_RS2']
+    x0, x0_cost = best_minimum(minima)
+    print(f'starting from search-mode minimum, cost {x0_cost}')
 
-print(df.iloc[0])
-print(df.iloc[-1])
-print('===================')
+    return (x0)
 
-for i in range(df.shape[0]):
-    if np.isnan(df.iloc[i]).any():
-        print(df.iloc[i])
 
-start_date, end_date = '2019-11-29 09:00:00', '2019-12-02 09:00:00'
-site_no = 2
+def track(cube, x0, log, space, cost_function, local_method='L-BFGS-B', jac=False, first_timestep=0,
+          max_steps=None, label=''):
+    """Fits timesteps first_timestep onwards, each warm-started from the previous fit, checkpointing each to log
 
-def get_obs_dict(signatures,timestep):
+    Args:
+        cube: ObservationCube of the series.
+        x0: full parameter vector to start from.
+        log: TrackLog the timesteps are appended to.
+        space: ParameterSpace the minimizer works in; cost_function takes its free vector.
+        max_steps: stop after this many timesteps (None runs to the end of the series).
+        label: prefix for the progress lines (to tell windows apart).
 
-    obs_dict = {}
-    for freq, pol in itertools.product(['Ku','Ka'],['VV','HV','HH']):
-        var = signatures[f'{freq}_{pol}_RS{site_no}'][str(start_date):str(end_date)]
-        obs_dict[f'{freq}_{pol}_Mean'] = np.array(var.iloc[timestep])
+    Returns:
+        The next timestep to run (len(cube) once the series is complete).
+    """
 
-    return(obs_dict)
+    empty = set(cube.empty_timesteps())
+    last = len(cube) if max_steps is None else min(len(cube), first_timestep + max_steps)
+    x = space.to_free(x0)
 
-obs_dict_0 = get_obs_dict(signatures, 0)
+    for timestep in range(first_timestep, last):
+        obs_time = cube.times[timestep]
 
-min_costs = []
-min_params = []
+        if timestep in empty:
+            print(f'{label}Timestep {timestep} ({obs_time}): no observations, skipped')
+            log.append(timestep, obs_time, space.to_full(x), np.nan, skipped=True,
+                       n_evals=inverter_tools.forward_runs)
+            continue
 
-for i in range(1, 10):
-    data = pickle.load(open(f'{path_to_pickles}first_run_{i}.p', 'rb'))
-    df = pd.DataFrame(data, columns=['params', 'cost', 'datetime'])
+        print(f'{label}Timestep {timestep} ({obs_time}) minimizing...')
 
-    # Get index of minimum cost
-    min_cost = np.min(df['cost'])
-    min_index = list(df['cost']).index(min_cost)
-    best_params = df.iloc[min_index][0]
+        fit = minimize(cost_function,
+                       x,
+                       args=(cube.obs_dict(timestep),),
+                       bounds=space.free_bounds,
+                       jac=jac,
+                       method=local_method)
 
-    min_costs.append(min_cost)
-    min_params.append(best_params)
+        x = fit.x
+        log.append(timestep, obs_time, space.to_full(x), fit.fun, nfev=fit.nfev, n_evals=inverter_tools.forward_runs)
 
-total_min_cost = np.min(min_costs)
-total_min_index = min_costs.index(total_min_cost)
-total_min_params = min_params[total_min_index]
+        print(f'{label}{fit.fun}')
+        print(f'{label}{fit.nfev} cost evaluations')
+        profiling.maybe_report()
 
-print(total_min_cost)
-print(inverter_tools.print_params(total_min_params))
+    return (last)
 
-initial_bounds = [(0.08,0.4), # Snow Depth
-                 (0.6,1.5), # Ice Thickness
-                 (0.1,3), # Ice Salinity
-                 (790,920), # Ice Density
-                 (255,270), # Temperature
-                 (0.1,0.4), # Snow MCL
-                 (0.1,1), # Ice MCL
-                 (250,400), # Snow Density
-#                  (0,1), # Snow Salinity
-                 (0.3,1.5), # Snow RMS
-                 (8,120), # Snow RCL
-                 (0.1,2.3), # Ice RMS
-                 (10,150)] # Ice RCL
 
-bds = inverter_tools.print_params(initial_bounds)
+def window_bounds(n_timesteps, n_windows, overlap):
+    """(start, stop) of n_windows equal windows covering the series, consecutive windows sharing `overlap` timesteps"""
 
-mod = inverter_tools.print_params(total_min_params)
+    length = int(np.ceil((n_timesteps + (n_windows - 1) * overlap) / n_windows))
+    stride = length - overlap
+    if stride <= 0:
+        raise ValueError(f'An overlap of {overlap} leaves nothing new in windows of {length} timesteps')
 
-# Update iteratively
+    return ([(k * stride, min(n_timesteps, k * stride + length)) for k in range(n_windows)])
 
-initial_guess_for_next_round = total_min_params.copy()
 
-iterative_best_params = []
-iterative_best_fun = []
+def run_window(task):
+    """Tracks one window from its seed (or its checkpoint), executed in a pool worker"""
 
-for round in range(0, 25):
-    # Get observations to match this round
+    profiling.start_task(task['profile'])
 
-    obs_dict = get_obs_dict(signatures, round)
+    cube, space = task['cube'], task['space']
+    first_timestep, x0 = resume_point(task['track_path'], cube)
+    if x0 is None:
+        x0 = task['seed']
 
-    # Fit the model to the new observations
+    with TrackLog(task['track_path'], n_params=len(space)) as log:
+        next_timestep = track(cube, x0, log, space, task['cost_function'], task['local_method'], jac=task['jac'],
+                              first_timestep=first_timestep, max_steps=task['max_steps'],
+                              label=f"[w{task['window_no']}] ")
 
-    print(f'Round {round} minimizing...')
+    return (task['window_no'], next_timestep, profiling.collect())
 
-    updated_fit = minimize(inverter_tools.calculate_cost,
-                           initial_guess_for_next_round,
-                           args=(obs_dict,),
-                           bounds=initial_bounds,
-                           method='L-BFGS-B')
 
+def stitch(windows, tracks, space, tolerance=0.05):
+    """Joins the tracks of overlapping windows into one trajectory
 
-    initial_guess_for_next_round = updated_fit.x
+    Consecutive windows hand over at the first overlapping timestep that both fitted with parameters agreeing to
+    within `tolerance` (the largest difference as a fraction of any parameter's range). Windows that never agree in
+    their overlap have converged to different basins: they hand over in the middle of the overlap and are reported.
 
-    iterative_best_params.append(initial_guess_for_next_round)
-    iterative_best_fun.append(updated_fit.fun)
-    print(updated_fit.fun)
+    Args:
+        windows: (start, stop) of each window, in order.
+        tracks: read_track DataFrame of each window (timesteps counted from the window's start).
 
-res_dict = {
-                'best_params' : iterative_best_params,
-                'best_costs' : iterative_best_fun,
-            }
+    Returns:
+        A dictionary with the stitched params (T, n_params), costs (T,) and skipped flags (T,), the handover
+        timesteps and a list of disagreements (windows, overlap, closest distance and each window's mean cost there).
+    """
 
-pickle.dump(res_dict, open(f'{track_file_name}.p', 'wb'))
\ No newline at end of file
+    n_timesteps = windows[-1][1]
+    lows, highs = np.array(space.bounds, dtype=float).T
+
+    per_window = []
+    for (start, stop), df in zip(windows, tracks):
+        params = np.full((n_timesteps, len(space)), np.nan)
+        costs = np.full(n_timesteps, np.nan)
+        skipped = np.zeros(n_timesteps, dtype=bool)
+        if not df.empty:
+            timesteps = start + df['timestep'].values
+            params[timesteps] = np.stack(df['params'].values)
+            costs[timesteps] = df['cost'].values
+            skipped[timesteps] = df['skipped'].values
+        per_window.append((params, costs, skipped))
+
+    handovers, disagreements = [], []
+    for k in range(len(windows) - 1):
+        overlap = np.arange(windows[k + 1][0], windows[k][1])
+        (params_a, costs_a, _), (params_b, costs_b, _) = per_window[k], per_window[k + 1]
+
+        distance = np.max(np.abs(params_a[overlap] - params_b[overlap]) / (highs - lows), axis=1)
+        comparable = ~np.isnan(costs_a[overlap]) & ~np.isnan(costs_b[overlap])
+        agree = np.flatnonzero(comparable & (distance <= tolerance))
+
+        if not overlap.size:
+            handovers.append(windows[k + 1][0])
+        elif agree.size:
+            handovers.append(int(overlap[agree[0]]))
+        else:
+            handovers.append(int(overlap[len(overlap) // 2]))
+            with np.errstate(invalid='ignore'):
+                disagreements.append({'windows': (k, k + 1),
+                                      'overlap': (int(overlap[0]), int(overlap[-1])),
+                                      'min_distance': float(np.nanmin(distance)) if comparable.any() else np.nan,
+                                      'mean_costs': (float(np.nanmean(costs_a[overlap][comparable]))
+                                                     if comparable.any() else np.nan,
+                                                     float(np.nanmean(costs_b[overlap][comparable]))
+                                                     if comparable.any() else np.nan)})
+
+    params = np.full((n_timesteps, len(space)), np.nan)
+    costs = np.full(n_timesteps, np.nan)
+    skipped = np.zeros(n_timesteps, dtype=bool)
+    for k, (start, stop) in enumerate(zip([0] + handovers, handovers + [n_timesteps])):
+        params[start:stop], costs[start:stop], skipped[start:stop] = [a[start:stop] for a in per_window[k]]
+
+    return ({'params': params, 'costs': costs, 'skipped': skipped,
+             'handovers': handovers, 'disagreements': disagreements})
+
+
+def track_windows(cube, seeds, space, cost_function, stem, local_method='L-BFGS-B', jac=False, overlap=4,
+                  processes=None, max_steps=None, tolerance=0.05):
+    """Time-parallel track mode: tracks len(seeds) overlapping windows concurrently and stitches them
+
+    Each window starts from its own seed (e.g. a lookup-table match to the window's signature, or the search-mode
+    minimum) and is checkpointed to {stem}_w{k}.track, so a rerun resumes every window where it stopped. The cost
+    function must not start a pool of its own (the windows already occupy the workers).
+
+    Returns:
+        The stitch dictionary (see stitch) plus the windows and the next timestep of each window.
+    """
+
+    windows = window_bounds(len(cube), len(seeds), overlap)
+    tasks = [{'window_no': k,
+              'cube': cube.window(start, stop),
+              'seed': seeds[k],
+              'space': space,
+              'cost_function': cost_function,
+              'local_method': local_method,
+              'jac': jac,
+              'max_steps': max_steps,
+              'profile': profiling.enabled,
+              'track_path': f'{stem}_w{k}.track'} for k, (start, stop) in enumerate(windows)]
+
+    with Pool(processes or len(windows)) as pool:
+        results = pool.map(run_window, tasks)
+
+    # The windows were fitted in the workers, so their timings and counters are gathered here
+    progress = {}
+    for window_no, next_timestep, profile in results:
+        progress[window_no] = next_timestep
+        profiling.absorb(profile)
+
+    stitched = stitch(windows, [read_track(task['track_path']) for task in tasks], space, tolerance)
+    stitched['windows'] = windows
+    stitched['complete'] = [progress[k] >= stop - start for k, (start, stop) in enumerate(windows)]
+
+    return (stitched)
+
+
+if __name__ == '__main__':
+    CL_input = CL_parse(sys.argv)
+    track_name = str(CL_input['task_id'])
+    max_steps = CL_input['niter'] or None
+    hpc = CL_input['hpc']
+
+    if 'profile' in CL_input:
+        profiling.enable(interval=float(CL_input['profile']))
+
+    print(f'scipy v{scipy.__version__}')
+
+    if hpc:
+        path_to_obs = '/home/ucfarm0/inverse_smrt/inverter/vishnu_real_data'
+        output_location = ''
+    else:
+        path_to_obs = 'vishnu_real_data'
+        output_location = 'output/'
+
+    site_no = int(CL_input.get('site', 2))
+    cube = load_cube(path_to_obs, site_no, CL_input.get('start'), CL_input.get('end'))
+    print(f'site {site_no}: {len(cube)} timesteps from {cube.times[0]} to {cube.times[-1]}, '
+          f'{len(cube.empty_timesteps())} without observations')
+
+    space = track_space(CL_input)
+    print(space)
+
+    # Cost and gradient from one batched SMRT call per iteration (default), or bounded least squares on the residuals
+    jac_mode = CL_input.get('jac', 'forward')
+    use_least_squares = CL_input.get('local') == 'lsq'
+    jac = (jac_mode != 'off') and not use_least_squares
+    processes = int(CL_input['processes']) if 'processes' in CL_input else None
+
+    if jac:
+        # Windows and ensemble members already occupy the pool workers (which can't start pools of their own)
+        pooled = ('windows' in CL_input) or ('ensemble' in CL_input)
+        cost_function = FiniteDifferenceJacobian(space.free_bounds,
+                                                 central=(jac_mode == 'central'),
+                                                 processes=None if pooled else processes,
+                                                 space=space)
+    else:
+        cost_function = space.wrap(inverter_tools.calculate_cost)
+
+    local_method = LeastSquaresMinimizer(space.free_bounds, space=space) if use_least_squares else 'L-BFGS-B'
+
+    stem = f'{output_location}{track_name}'
+    minima = CL_input.get('minima', f'{output_location}first_run_*.minima')
+    t_start = datetime.datetime.now()
+
+    if 'windows' in CL_input:
+        n_windows = int(CL_input['windows'])
+        overlap = int(CL_input.get('overlap', 4))
+
+        if ('lut' in CL_input) or ('index' in CL_input):
+            # Each window starts from the table or index entry closest to its own mean signature
+            source = SignatureIndex.load(CL_input['index']) if 'index' in CL_input else LookupTable(CL_input['lut'])
+            seeds = [start_candidates(source, cube.window(start, stop), space)[0][0]
+                     for start, stop in window_bounds(len(cube), n_windows, overlap)]
+        else:
+            seeds = [search_mode_start(minima)] * n_windows
+
+        stitched = track_windows(cube, seeds, space, cost_function, stem, local_method, jac=jac, overlap=overlap,
+                                 processes=processes, max_steps=max_steps)
+
+        print(f"windows {stitched['windows']}, handovers at {stitched['handovers']}")
+        for disagreement in stitched['disagreements']:
+            print(f'windows {disagreement} converged to different basins')
+        if not all(stitched['complete']):
+            print('some windows stopped early; run again to continue')
+
+        res_dict = {'best_params': list(stitched['params']),
+                    'best_costs': list(stitched['costs']),
+                    'times': list(cube.times),
+                    'skipped': list(stitched['skipped']),
+                    'windows': stitched['windows'],
+                    'handovers': stitched['handovers'],
+                    'disagreements': stitched['disagreements']}
+
+    elif 'ensemble' in CL_input:
+        members, reserve = ensemble_starts(minima, int(CL_input['ensemble']), space)
+        print(f'tracking an ensemble of {len(members)} distinct minima, {len(reserve)} in reserve')
+
+        next_timestep = track_ensemble(cube, members, reserve, space, cost_function, stem, local_method, jac=jac,
+                                       processes=processes, max_steps=max_steps)
+
+        if next_timestep < len(cube):
+            print(f'stopped before timestep {next_timestep} of {len(cube)}; run again to continue')
+
+        trajectories = best_trajectories(stem, len(members), len(cube), space.bounds)
+        res_dict = {'best_params': list(trajectories['best_params']),
+                    'best_costs': list(trajectories['best_costs']),
+                    'runner_up_params': list(trajectories['runner_up_params']),
+                    'runner_up_costs': list(trajectories['runner_up_costs']),
+                    'times': list(cube.times)}
+
+    else:
+        track_path = f'{stem}.track'
+        first_timestep, x0 = resume_point(track_path, cube)
+
+        if first_timestep:
+            print(f'resuming at timestep {first_timestep}')
+
+        if (x0 is None) and ('index' in CL_input):
+            first_observed = min(set(range(len(cube))) - set(cube.empty_timesteps()))
+            candidates, index_costs = start_candidates(SignatureIndex.load(CL_input['index']),
+                                                       cube.obs_dict(first_observed), space)
+            x0 = candidates[0]
+            print(f'starting from the signature index, cost {index_costs[0]} at timestep {first_observed}')
+        elif x0 is None:
+            x0 = search_mode_start(minima)
+
+        print(inverter_tools.print_params(x0))
+
+        with TrackLog(track_path, n_params=len(space)) as log:
+            next_timestep = track(cube, x0, log, space, cost_function, local_method, jac=jac,
+                                  first_timestep=first_timestep, max_steps=max_steps)
+
+        if next_timestep < len(cube):
+            print(f'stopped before timestep {next_timestep} of {len(cube)}; run again to continue')
+
+        # Whole track so far, in the form earlier track pickles had
+        df = read_track(track_path)
+        res_dict = {'best_params': list(df['params']),
+                    'best_costs': list(df['cost']),
+                    'times': list(df['obs_time']),
+                    'skipped': list(df['skipped'])}
+
+    pickle.dump(res_dict, open(f'{stem}.p', 'wb'))
+    if jac:
+        cost_function.close()
+
+    if profiling.enabled:
+        cache_stats = {'forward_cache': inverter_tools.forward_cache.stats(),
+                       'submodel_caches': {name: info._asdict()
+                                           for name, info in inverter_tools.submodel_cache_info().items()}}
+        print(profiling.format_summary(cache_stats))
+        profiling.dump(f'{stem}_profile.json', cache_stats)
+
+    print('Time Elapsed:')
+    print(datetime.datetime.now() - t_start)